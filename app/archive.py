@@ -0,0 +1,155 @@
+# archive.py
+# 冷存储归档：过期消息按会话、按天追加到 zlib 压缩的段文件里，读取时用 mmap 只解压需要的块
+#
+# 目录结构：
+#   <archive_path>/<context_type>_<context_id>/<YYYYMMDD>.seg   多个压缩块首尾相接，每块是一批消息的 JSONL
+#   <archive_path>/<context_type>_<context_id>/index.jsonl      每个块一行：所在日期、偏移、长度、条数、时间范围
+# 先写块再追加索引行，写到一半中断时段文件末尾多出的字节不会被引用；同一条消息可能被重复归档，读取时按 _id 去重
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+from bson import ObjectId
+
+COMPRESSION_LEVEL = 9
+INDEX_FILE = 'index.jsonl'
+
+
+def day_of(timestamp):
+    return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+
+class MessageArchive:
+    def __init__(self, root):
+        self.root = root
+        self._indexes = {}  # 会话键 -> (index.jsonl 的修改时间和大小, 块列表)
+        self._lock = threading.Lock()
+
+    def _context_dir(self, key):
+        context_type, context_id = key
+        return os.path.join(self.root, f"{context_type}_{context_id}")
+
+    def append(self, key, messages):
+        """把一个会话的消息按天各追加为一个压缩块，返回写入的条数"""
+        by_day = {}
+        for msg in messages:
+            by_day.setdefault(day_of(msg.get('timestamp', 0)), []).append(msg)
+        directory = self._context_dir(key)
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            entries = []
+            for day, day_messages in sorted(by_day.items()):
+                day_messages.sort(key=lambda msg: msg.get('timestamp', 0))
+                lines = ''.join(json.dumps(dict(msg, _id=str(msg['_id'])), ensure_ascii=False) + '\n' for msg in day_messages)
+                block = zlib.compress(lines.encode('utf-8'), COMPRESSION_LEVEL)
+                with open(os.path.join(directory, f"{day}.seg"), 'ab') as segment:
+                    offset = segment.seek(0, os.SEEK_END)
+                    segment.write(block)
+                    segment.flush()
+                    os.fsync(segment.fileno())
+                entries.append({
+                    'day': day, 'offset': offset, 'length': len(block), 'count': len(day_messages),
+                    'first': day_messages[0].get('timestamp', 0), 'last': day_messages[-1].get('timestamp', 0),
+                })
+            with open(os.path.join(directory, INDEX_FILE), 'a', encoding='utf-8') as index_file:
+                index_file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+        return len(messages)
+
+    def blocks(self, key):
+        """会话的全部块，按时间正序"""
+        path = os.path.join(self._context_dir(key), INDEX_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return []
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._indexes.get(key)
+            if cached and cached[0] == version:
+                return cached[1]
+        with open(path, 'r', encoding='utf-8') as index_file:
+            entries = [json.loads(line) for line in index_file if line.strip()]
+        entries.sort(key=lambda entry: (entry['first'], entry['day'], entry['offset']))
+        with self._lock:
+            self._indexes[key] = (version, entries)
+        return entries
+
+    def _read_blocks(self, key, entries):
+        """按给定顺序解压各块，逐条返回消息"""
+        directory = self._context_dir(key)
+        segments = {}
+        try:
+            for entry in entries:
+                segment = segments.get(entry['day'])
+                if segment is None:
+                    with open(os.path.join(directory, f"{entry['day']}.seg"), 'rb') as f:
+                        segment = segments[entry['day']] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                data = zlib.decompress(segment[entry['offset']:entry['offset'] + entry['length']])
+                for line in data.decode('utf-8').splitlines():
+                    msg = json.loads(line)
+                    msg['_id'] = ObjectId(msg['_id'])
+                    yield msg
+        finally:
+            for segment in segments.values():
+                segment.close()
+
+    def iter_messages(self, key):
+        """按时间正序逐条返回会话的全部归档消息"""
+        seen = set()
+        for msg in self._read_blocks(key, self.blocks(key)):
+            if msg['_id'] not in seen:
+                seen.add(msg['_id'])
+                yield msg
+
+    def read_recent(self, key, limit, before=None):
+        """最近的 limit 条归档消息（早于 before），按时间正序返回"""
+        messages = {}
+        for entry in reversed(self.blocks(key)):
+            if len(messages) >= limit:
+                break
+            if before is not None and entry['first'] >= before:
+                continue
+            for msg in self._read_blocks(key, [entry]):
+                if before is None or msg.get('timestamp', 0) < before:
+                    messages[msg['_id']] = msg
+        recent = sorted(messages.values(), key=lambda msg: msg.get('timestamp', 0))
+        return recent[-limit:] if limit else []
+
+    def fetch(self, key, message_ids):
+        """按 _id 读取归档消息；_id 里的生成时间决定了它所在的段，只解压这些天的块"""
+        wanted = set(message_ids)
+        days = set()
+        for message_id in wanted:
+            generated = message_id.generation_time.timestamp()
+            days.update((day_of(generated), day_of(generated - 1)))  # 时间戳在 _id 生成之前写入，可能跨过零点
+        entries = [entry for entry in self.blocks(key) if entry['day'] in days]
+        found = {}
+        for msg in self._read_blocks(key, entries):
+            if msg['_id'] in wanted:
+                found[msg['_id']] = msg
+        return list(found.values())
+
+    def stats(self):
+        """归档占用的磁盘空间和消息数"""
+        contexts = 0
+        messages = 0
+        size = 0
+        if not os.path.isdir(self.root):
+            return {'contexts': 0, 'messages': 0, 'bytes': 0}
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if not os.path.isdir(directory):
+                continue
+            contexts += 1
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                size += os.path.getsize(path)
+                if filename == INDEX_FILE:
+                    with open(path, 'r', encoding='utf-8') as index_file:
+                        messages += sum(json.loads(line)['count'] for line in index_file if line.strip())
+        return {'contexts': contexts, 'messages': messages, 'bytes': size}
+
@@ -6,6 +6,7 @@ from commands.reset import handle_reset_command
 from commands.character import handle_character_command
 from commands.model import handle_model_command
 from commands.r18 import handle_r18_command  
+from commands.search import handle_search_command
 
 async def handle_command(command, msg_type, recipient_id, send_msg, context_type, context_id):
     parts = command.split(' ', 1)
@@ -15,7 +16,7 @@ async def handle_command(command, msg_type, recipient_id, send_msg, context_type
     if main_command == 'help':
         await handle_help_command(msg_type, recipient_id, send_msg)
     elif main_command == 'reset':
-        await handle_reset_command(msg_type, recipient_id, send_msg)
+        await handle_reset_command(msg_type, recipient_id, context_type, context_id, send_msg)
     elif main_command == 'character':
         await handle_character_command(msg_type, recipient_id, send_msg)
     elif main_command == 'music_list':
@@ -38,6 +39,8 @@ async def handle_command(command, msg_type, recipient_id, send_msg, context_type
                 await send_msg(msg_type, recipient_id, "请在 clear 后输入一个有效的数字。")
                 return
         await handle_clear_history_command(msg_type, recipient_id, context_type, context_id, send_msg, count)
+    elif main_command == 'search':
+        await handle_search_command(msg_type, recipient_id, context_type, context_id, send_msg, args)
     elif main_command == 'model':
         if args:  # model 命令需要一个额外的参数
             new_model = args
@@ -43,7 +43,61 @@ class Config:
         self.R18 = self.config_data.get('r18')
         self.ADMIN_TITLES = self.config_data.get('admin_titles')
         self.MESSAGE_QUEUE_SIZE = self.config_data.get('message_queue_size', 10)
+        self.QUEUE_OVERFLOW_POLICY = self.config_data.get('queue_overflow_policy', 'block')
+        self.MAX_ACTIVE_CONTEXTS = self.config_data.get('max_active_contexts', 10)
+        self.CONTEXT_TOKEN_BUDGET = self.config_data.get('context_token_budget', 4000)
+        self.SUMMARY_ENABLED = self.config_data.get('summary_enabled', False)
+        self.SUMMARY_KEEP_TURNS = self.config_data.get('summary_keep_turns', 10)
+        self.SUMMARY_MIN_TURNS = self.config_data.get('summary_min_turns', 10)
+        self.SUMMARY_MAX_BATCH = self.config_data.get('summary_max_batch', 30)
+        self.SUMMARY_MAX_CHARS = self.config_data.get('summary_max_chars', 500)
+        self.SUMMARY_INTERVAL = self.config_data.get('summary_interval', 5)
+        self.SUMMARY_MODEL = self.config_data.get('summary_model')
+        self.RESPONSE_CACHE_ENABLED = self.config_data.get('response_cache_enabled', False)
+        self.RESPONSE_CACHE_SIZE = self.config_data.get('response_cache_size', 1000)
+        self.RESPONSE_CACHE_TTL = self.config_data.get('response_cache_ttl', {'default': 300, 'private': 300, 'group': 600})
+        self.RESPONSE_CACHE_CONTEXT_MESSAGES = self.config_data.get('response_cache_context_messages', 2)
+        self.RESPONSE_CACHE_EXCLUDE = self.config_data.get('response_cache_exclude', ['admin'])
+        self.STREAM_REPLY = self.config_data.get('stream_reply', False)
+        self.STREAM_MIN_INTERVAL = self.config_data.get('stream_min_interval', 1.5)
+        self.MODEL_HTTP_LIMIT = self.config_data.get('model_http_limit', 100)
+        self.MODEL_HTTP_LIMIT_PER_HOST = self.config_data.get('model_http_limit_per_host', 20)
+        self.MODEL_HTTP_KEEPALIVE = self.config_data.get('model_http_keepalive', 60)
+        self.MODEL_HTTP_DNS_TTL = self.config_data.get('model_http_dns_ttl', 300)
+        self.MODEL_HTTP_WARMUP = self.config_data.get('model_http_warmup', 2)
+        self.JOURNAL_ENABLED = self.config_data.get('journal_enabled', True)
+        self.JOURNAL_PATH = self.config_data.get('journal_path', 'data/journal')
+        self.JOURNAL_FSYNC_INTERVAL = self.config_data.get('journal_fsync_interval', 0.05)
+        self.JOURNAL_MAX_REPLAY_AGE = self.config_data.get('journal_max_replay_age', 600)
+        self.WORKER_PROCESSES = self.config_data.get('worker_processes', 1)
+        self.MIN_TASK_WORKERS = self.config_data.get('min_task_workers', 2)
+        self.SHUTDOWN_DRAIN_TIMEOUT = self.config_data.get('shutdown_drain_timeout', 15)
+        self.MAILBOX_IDLE_TIMEOUT = self.config_data.get('mailbox_idle_timeout', 300)
+        self.QUEUE_MAX_AGE = self.config_data.get('queue_max_age', 0)
+        self.CONTEXT_WEIGHTS = self.config_data.get('context_weights', {})
+        self.MAX_INFLIGHT_PER_CONTEXT = self.config_data.get('max_inflight_per_context', 2)
+        self.DB_BACKEND = self.config_data.get('db_backend', 'mongodb')
+        self.SQLITE_PATH = self.config_data.get('sqlite_path', 'data/chatbot.db')
+        self.MONGO_URI = self.config_data.get('mongo_uri', 'mongodb://mongo:27017/')
+        self.MONGO_DB_NAME = self.config_data.get('mongo_db_name', 'chatbot_db')
+        self.MONGO_POOL_SIZE = self.config_data.get('mongo_pool_size', 20)
+        self.DB_EXECUTOR_WORKERS = self.config_data.get('db_executor_workers', 4)
+        self.DB_FLUSH_SIZE = self.config_data.get('db_flush_size', 50)
+        self.USER_FLUSH_INTERVAL = self.config_data.get('user_flush_interval', 5.0)
+        self.RETENTION = self.config_data.get('retention', {})
+        self.ARCHIVE_ENABLED = self.config_data.get('archive_enabled', True)
+        self.ARCHIVE_PATH = self.config_data.get('archive_path', 'data/archive')
+        self.MESSAGE_COMPRESS_THRESHOLD = self.config_data.get('message_compress_threshold', 1024)
+        self.MIGRATION_BATCH_SIZE = self.config_data.get('migration_batch_size', 1000)
+        self.CONTEXT_CACHE_TURNS = self.config_data.get('context_cache_turns', 20)
+        self.CONTEXT_CACHE_MAX_BYTES = self.config_data.get('context_cache_max_bytes', 32 * 1024 * 1024)
+        self.SEARCH_INDEX_MAX_BYTES = self.config_data.get('search_index_max_bytes', 64 * 1024 * 1024)
+        self.DB_FLUSH_INTERVAL = self.config_data.get('db_flush_interval', 1.0)
         self.CONNECTION_TYPE = self.config_data.get('connection_type', 'http')
+        self.HTTP_MAX_BODY_SIZE = self.config_data.get('http_max_body_size', 4 * 1024 * 1024)
+        self.HTTP_KEEPALIVE_TIMEOUT = self.config_data.get('http_keepalive_timeout', 60)
+        self.HTTP_QUICK_REPLY = self.config_data.get('http_quick_reply', False)
+        self.HTTP_QUICK_REPLY_TIMEOUT = self.config_data.get('http_quick_reply_timeout', 1.5)
         self.ENABLE_TIME = self.config_data.get('enable_time')
         self.DISABLE_TIME = self.config_data.get('disable_time')
         with open(DIALOGUES_PATH, 'r', encoding='utf-8') as f:
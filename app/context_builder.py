@@ -0,0 +1,54 @@
+# context_builder.py
+# 按 token 预算组装发给模型的上下文：系统提示 + 从新到旧尽量多的历史对话 + 当前消息
+import re
+
+CJK = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+MESSAGE_OVERHEAD = 4  # 每条消息的角色和分隔符大约占用的 token
+
+
+def estimate_tokens(text):
+    """粗略估计 token 数：中日韩字符和全角标点大约一个字一个 token，其余字符大约四个一个 token"""
+    if not text:
+        return 0
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def turn_tokens(turn):
+    """一轮对话（用户消息加回复）的估计 token 数，文档上保存过就直接使用"""
+    tokens = turn.get('tokens')
+    if tokens is None:
+        tokens = estimate_tokens(turn.get('user_input')) + estimate_tokens(turn.get('response_text')) + 2 * MESSAGE_OVERHEAD
+    return tokens
+
+
+def build_messages(system_prompt, turns, user_message, budget, summary=None):
+    """返回 (messages, 估计的 token 数)
+
+    turns 是按时间正序的历史对话；从最近一轮往前取，直到放不下为止。
+    系统提示、会话摘要和当前消息总是保留，即使它们本身已经超出预算；已经并入摘要的轮次不再重复发送。
+    """
+    used = estimate_tokens(user_message) + MESSAGE_OVERHEAD
+    if system_prompt:
+        used += estimate_tokens(system_prompt) + MESSAGE_OVERHEAD
+    summary_text = None
+    if summary:
+        summary_text = f"之前对话的摘要：\n{summary['text']}"
+        used += estimate_tokens(summary_text) + MESSAGE_OVERHEAD
+        turns = [turn for turn in turns if (turn.get('timestamp') or 0) > summary['until']]
+    selected = []
+    for turn in reversed(turns):
+        tokens = turn_tokens(turn)
+        if used + tokens > budget:
+            break
+        used += tokens
+        selected.append(turn)
+
+    # 摘要接在系统提示后面，有的接口只接受一条系统消息
+    system_text = "\n\n".join(text for text in (system_prompt, summary_text) if text)
+    messages = [{"role": "system", "content": system_text}] if system_text else []
+    for turn in reversed(selected):
+        messages.append({"role": "user", "content": turn['user_input']})
+        messages.append({"role": "assistant", "content": turn['response_text']})
+    messages.append({"role": "user", "content": user_message})
+    return messages, used
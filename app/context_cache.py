@@ -0,0 +1,132 @@
+# context_cache.py
+# 会话缓存：每个会话保留最近若干轮对话的环形缓冲，整体按 LRU 淘汰并受总内存上限约束
+import threading
+from collections import OrderedDict, deque
+
+
+def estimate_size(doc):
+    """粗略估计一轮对话占用的内存（字节）"""
+    return 2 * (len(doc.get('user_input') or '') + len(doc.get('response_text') or '')) + 256
+
+
+class _Conversation:
+    __slots__ = ('turns', 'complete', 'size')
+
+    def __init__(self):
+        self.turns = deque()
+        self.complete = False  # 为 True 表示缓冲里就是该会话的全部历史
+        self.size = 0
+
+
+class ConversationCache:
+    def __init__(self, turns_per_context=20, max_bytes=32 * 1024 * 1024):
+        self.turns_per_context = turns_per_context
+        self.max_bytes = max_bytes
+        self._conversations = OrderedDict()
+        self._owners = {}  # _id -> 会话键
+        self._loading = {}  # 会话键 -> 加载期间是否有新写入
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, limit):
+        """命中时返回最近 limit 轮（按时间正序），未命中返回 None"""
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None or (len(conversation.turns) < limit and not conversation.complete):
+                self.misses += 1
+                return None
+            self._conversations.move_to_end(key)
+            self.hits += 1
+            turns = list(conversation.turns)
+            return turns[-limit:] if limit else []
+
+    def begin_load(self, key):
+        with self._lock:
+            self._loading[key] = False
+
+    def finish_load(self, key, docs, complete):
+        """用数据库查询结果（按时间正序）填充会话；加载失败或期间有新写入则放弃，避免缓存漏掉消息"""
+        with self._lock:
+            if self._loading.pop(key, True) or docs is None:
+                return
+            self._remove(key)
+            conversation = _Conversation()
+            conversation.complete = complete and len(docs) <= self.turns_per_context
+            self._conversations[key] = conversation
+            for doc in docs[-self.turns_per_context:]:
+                self._push(key, conversation, doc)
+            self._evict()
+
+    def append(self, key, doc):
+        """写入新的一轮对话；只更新已缓存的会话，冷会话等下次读取时再从数据库加载"""
+        with self._lock:
+            if key in self._loading:
+                self._loading[key] = True
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return
+            self._push(key, conversation, doc)
+            self._conversations.move_to_end(key)
+            self._evict()
+
+    def discard(self, doc_id):
+        """某条消息被删除时，作废包含它的会话"""
+        with self._lock:
+            key = self._owners.get(doc_id)
+            if key is not None:
+                self._remove(key)
+            for loading_key in self._loading:
+                self._loading[loading_key] = True
+
+    def clear(self):
+        with self._lock:
+            self._conversations.clear()
+            self._owners.clear()
+            self._size = 0
+            for loading_key in self._loading:
+                self._loading[loading_key] = True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'contexts': len(self._conversations),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def _push(self, key, conversation, doc):
+        if len(conversation.turns) >= self.turns_per_context:
+            oldest = conversation.turns.popleft()
+            conversation.complete = False
+            self._forget(conversation, oldest)
+        size = estimate_size(doc)
+        conversation.turns.append(doc)
+        conversation.size += size
+        self._size += size
+        self._owners[doc['_id']] = key
+
+    def _forget(self, conversation, doc):
+        size = estimate_size(doc)
+        conversation.size -= size
+        self._size -= size
+        self._owners.pop(doc['_id'], None)
+
+    def _remove(self, key):
+        conversation = self._conversations.pop(key, None)
+        if conversation is not None:
+            for doc in conversation.turns:
+                self._owners.pop(doc['_id'], None)
+            self._size -= conversation.size
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._conversations) > 1:
+            key = next(iter(self._conversations))
+            self._remove(key)
+            self.evictions += 1
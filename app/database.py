@@ -1,19 +1,70 @@
 # database.py
+import asyncio
+import functools
 import time
-from bson import ObjectId
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from app.logger import logger
 import pymongo
 from app.config import Config
+from app.context_cache import ConversationCache
+from app.message_codec import field, projection, context_type_code, encode_message, decode_message
+from app.migrations import run_migrations
+from app.archive import MessageArchive
+from app.search_index import SearchIndex
+from app.storage import Storage, MessageWriteBuffer, UserRegistry
 import schedule
 
 config = Config.get_instance()
 
-class MongoDB:
-    def __init__(self, uri="mongodb://mongo:27017/", db_name="chatbot_db"):
-        self.client = MongoClient(uri)
+# messages 集合以紧凑格式保存（见 app/message_codec.py），查询和索引使用存储字段名
+TS = field('timestamp')
+
+# messages 集合的索引：最近消息按会话倒序读取，过期清理按时间范围筛选
+MESSAGE_INDEXES = [
+    ([(field('context_type'), pymongo.ASCENDING), (field('context_id'), pymongo.ASCENDING), (TS, pymongo.DESCENDING)], 'context_ts'),
+    ([(field('context_type'), pymongo.ASCENDING), (field('user_id'), pymongo.ASCENDING), (TS, pymongo.DESCENDING)], 'user_ts'),
+    ([(TS, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 'ts_id'),
+]
+
+# 过期清理分批读取时需要的字段
+EXPIRING_MESSAGE_PROJECTION = projection('user_id', 'context_type', 'context_id', 'timestamp')
+
+# get_recent_messages 只需要这些字段
+RECENT_MESSAGE_PROJECTION = projection('user_input', 'response_text', 'timestamp', 'tokens')
+
+# 进程内共享的 MongoClient（自带连接池）
+_clients = {}
+_indexed_databases = set()
+_shared_lock = threading.Lock()
+
+def get_mongo_client(uri):
+    with _shared_lock:
+        if uri not in _clients:
+            _clients[uri] = MongoClient(uri, maxPoolSize=config.MONGO_POOL_SIZE)
+        return _clients[uri]
+
+class MongoDB(Storage):
+    """MongoDB 存储后端；写缓冲等后台线程属于实例，进程内请通过 get_database() 共用一个实例"""
+
+    def __init__(self, uri=None, db_name=None):
+        uri = uri or config.MONGO_URI
+        db_name = db_name or config.MONGO_DB_NAME
+        self.client = get_mongo_client(uri)
         self.db = self.client[db_name]
-        self.ensure_indexes()
+        super().__init__(
+            MessageWriteBuffer(self.write_messages, flush_size=config.DB_FLUSH_SIZE, flush_interval=config.DB_FLUSH_INTERVAL),
+            UserRegistry(self.write_users, flush_interval=config.USER_FLUSH_INTERVAL),
+            ConversationCache(turns_per_context=config.CONTEXT_CACHE_TURNS, max_bytes=config.CONTEXT_CACHE_MAX_BYTES),
+            SearchIndex(max_bytes=config.SEARCH_INDEX_MAX_BYTES),
+            MessageArchive(config.ARCHIVE_PATH) if config.ARCHIVE_ENABLED else None
+        )
+        # 索引每个进程只需要确认一次
+        if (uri, db_name) not in _indexed_databases:
+            _indexed_databases.add((uri, db_name))
+            self.ensure_indexes()
 
     def get_collection(self, collection_name):
         return self.db[collection_name]
@@ -22,25 +73,61 @@ class MongoDB:
         try:
             users_collection = self.get_collection('users')
             users_collection.create_index('user_id', unique=True)
+            messages_collection = self.get_collection('messages')
+            for keys, name in MESSAGE_INDEXES:
+                messages_collection.create_index(keys, name=name, background=True)
         except Exception as e:
             logger.error(f"Error ensuring indexes: {e}")
 
-    def insert_user_info(self, user_info):
-        try:
-            users_collection = self.get_collection('users')
-            # 尝试找到已有的用户信息
-            existing_user = users_collection.find_one({'user_id': user_info['user_id']})
-            if existing_user:
-                # 更新现有的用户信息
-                result = users_collection.update_one(
-                    {'user_id': user_info['user_id']},
-                    {'$set': user_info}
-                )
+    def check_query_plans(self):
+        """对热点查询执行 explain()，没有走索引或需要内存排序时给出警告"""
+        messages_collection = self.get_collection('messages')
+        expiry_time = time.time() - 86400
+        hot_queries = {
+            'recent_group_messages': messages_collection.find(
+                self._recent_messages_query(0, 'group', 0), RECENT_MESSAGE_PROJECTION
+            ).sort(TS, -1).limit(10),
+            'recent_private_messages': messages_collection.find(
+                self._recent_messages_query(0, 'private', 0), RECENT_MESSAGE_PROJECTION
+            ).sort(TS, -1).limit(10),
+            'expiring_messages': self._expiring_messages_cursor(expiry_time, None, 500, [config.ADMIN_ID], []),
+        }
+        problems = {}
+        for name, cursor in hot_queries.items():
+            try:
+                winning_plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+            except Exception as e:
+                logger.error(f"Error explaining query {name}: {e}")
+                continue
+            stages = _plan_stages(winning_plan.get('queryPlan', winning_plan))
+            issues = []
+            if 'COLLSCAN' in stages:
+                issues.append('collection scan')
+            if 'SORT' in stages:
+                issues.append('in-memory sort')
+            if issues:
+                problems[name] = issues
+                logger.warning(f"Query {name} is not served by an index ({', '.join(issues)}), plan stages: {stages}")
             else:
-                # 插入新的用户信息
-                result = users_collection.insert_one(user_info)
-        except Exception as e:
-            logger.error(f"Error inserting/updating user info: {e}")
+                logger.debug(f"Query {name} uses index, plan stages: {stages}")
+        return problems
+
+    def write_messages(self, documents):
+        try:
+            threshold = config.MESSAGE_COMPRESS_THRESHOLD
+            self.get_collection('messages').insert_many([encode_message(doc, threshold) for doc in documents], ordered=False)
+            return len(documents)
+        except BulkWriteError as e:
+            # 重复键等单条错误不影响同批次其他文档，也不需要重试
+            logger.error(f"Error flushing chat messages: {e.details.get('writeErrors', [])[:3]}")
+            return e.details.get('nInserted', 0)
+
+    def write_users(self, users):
+        operations = [
+            pymongo.UpdateOne({'user_id': user_id}, {'$set': user_info}, upsert=True)
+            for user_id, user_info in users.items()
+        ]
+        self.get_collection('users').bulk_write(operations, ordered=False)
 
     def deduplicate_users(self):
         try:
@@ -61,24 +148,6 @@ class MongoDB:
         except Exception as e:
             logger.error(f"Error deduplicating users: {e}")
 
-    def insert_chat_message(self, user_id, user_input, response_text, context_type, context_id):
-        try:
-            if response_text:  # 仅保存有回复的消息
-                messages_collection = self.get_collection('messages')
-                message_data = {
-                    'user_id': user_id,
-                    'user_input': user_input,
-                    'response_text': response_text,
-                    'context_type': context_type,  # "group" 或 "private"
-                    'context_id': context_id,
-                    # 'username': username,
-                    'timestamp': time.time()  # 添加时间戳
-                }
-                result = messages_collection.insert_one(message_data)
-                # logger.info(f"Inserted chat message: {result.inserted_id}")
-        except Exception as e:
-            logger.error(f"Error inserting chat message: {e}")
-
     def get_context(self, context_type, context_id):
         try:
             contexts_collection = self.get_collection('contexts')
@@ -102,81 +171,93 @@ class MongoDB:
         except Exception as e:
             logger.error(f"Error updating context: {e}")
 
-    def get_recent_messages(self, user_id, context_type, context_id, limit=10):
-        try:
-            messages_collection = self.get_collection('messages')
-            query = {"context_type": context_type}
-            
-            if context_type == 'private':
-                query["user_id"] = user_id
-            elif context_type == 'group':
-                if context_id:
-                    query["context_id"] = context_id
-                else:
-                    logger.warning("Context ID is required for group messages.")
-                    return []
-
-            messages = messages_collection.find(query).sort("timestamp", -1).limit(limit)
-            messages_list = []
-
-             # 确保字段存在默认值，并跳过未回复的消息
-            for msg in reversed(list(messages)):
-                user_input = msg.get('user_input', '(no user input)')
-                response_text = msg.get('response_text', '(no response)')
-                if user_input and response_text and response_text != '(no response)':
-                    msg["_id"] = str(msg["_id"])  # 将 ObjectId 转换为字符串
-                    messages_list.append({"_id": msg['_id'], "role": "user", "content": user_input})
-                    messages_list.append({"_id": msg['_id'], "role": "assistant", "content": response_text})
-
-            return messages_list
-        except Exception as e:
-            logger.error(f"Error getting recent messages: {e}")
+    def _recent_messages_query(self, user_id, context_type, context_id):
+        query = {field('context_type'): context_type_code(context_type)}
+        if context_type == 'private':
+            query[field('user_id')] = user_id
+        elif context_type == 'group':
+            query[field('context_id')] = context_id
+        return query
+
+    def fetch_recent_messages(self, user_id, context_type, context_id, limit):
+        query = self._recent_messages_query(user_id, context_type, context_id)
+        messages_collection = self.get_collection('messages')
+        return [decode_message(doc) for doc in messages_collection.find(query, RECENT_MESSAGE_PROJECTION).sort(TS, -1).limit(limit)]
+
+    def iter_context_messages(self, user_id, context_type, context_id):
+        query = self._recent_messages_query(user_id, context_type, context_id)
+        messages_collection = self.get_collection('messages')
+        return (decode_message(doc) for doc in messages_collection.find(query, RECENT_MESSAGE_PROJECTION).sort(TS, 1).batch_size(1000))
+
+    def fetch_messages_by_ids(self, message_ids):
+        if not message_ids:
             return []
+        cursor = self.get_collection('messages').find({"_id": {"$in": list(message_ids)}}, RECENT_MESSAGE_PROJECTION)
+        return [decode_message(doc) for doc in cursor]
 
     def clean_empty_responses(self):
         try:
             messages_collection = self.db['messages']
-            query = {"$or": [{"response_text": {"$exists": False}}, {"response_text": ""}]}
+            # 紧凑格式不保存空正文，所以没有回复字段的就是空回复
+            response = field('response_text')
+            query = {"$or": [{TS: {"$exists": True}, response: {"$exists": False}}, {response: ""}]}
             result = messages_collection.delete_many(query)
             logger.info(f"Deleted {result.deleted_count} documents containing empty responses")
         except Exception as e:
             logger.error(f"Error cleaning empty responses: {e}")
 
-    def clean_old_messages(self, days=1, exempt_user_ids=None, exempt_context_ids=None):
+    def run_migrations(self):
+        """执行尚未完成的数据库迁移"""
         try:
-            if exempt_user_ids is None:
-                exempt_user_ids = [config.ADMIN_ID]
-            if exempt_context_ids is None:
-                exempt_context_ids = []
+            return run_migrations(self.db, batch_size=config.MIGRATION_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Error running migrations: {e}")
+            return []
 
-            messages_collection = self.db['messages']
+    def _expiring_messages_cursor(self, cutoff, after, limit, exempt_user_ids, exempt_context_ids):
+        query = {
+            TS: {"$lt": cutoff},
+            field('user_id'): {"$nin": exempt_user_ids},
+            field('context_id'): {"$nin": exempt_context_ids}
+        }
+        if after is not None:
+            # 按 (timestamp, _id) 做键集分页，从上一批的最后一条之后继续
+            last_timestamp, last_id = after
+            query["$or"] = [
+                {TS: {"$gt": last_timestamp}},
+                {TS: last_timestamp, "_id": {"$gt": last_id}}
+            ]
+        return self.db['messages'].find(query, EXPIRING_MESSAGE_PROJECTION).sort(
+            [(TS, pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+        ).limit(limit)
 
-            # 首先补全缺失的 context_type 和 context_id
-            update_ops = []
-            for message in messages_collection.find({"context_type": {"$exists": False}}):
-                message_type = 'private' if 'group_id' not in message else 'group'
-                context_id = message['user_id'] if message_type == 'private' else message.get('group_id')
-                update_ops.append(
-                    pymongo.UpdateOne(
-                        {'_id': message['_id']},
-                        {'$set': {'context_type': message_type, 'context_id': context_id}}
-                    )
-                )
-            if update_ops:
-                result = messages_collection.bulk_write(update_ops)
-                logger.info(f"Updated {result.matched_count} documents with context_type and context_id")
+    def find_expiring_messages(self, cutoff, after=None, limit=500, exempt_user_ids=(), exempt_context_ids=()):
+        """按时间顺序取一批早于 cutoff 的消息，after 为上一批最后一条的 (timestamp, _id)"""
+        cursor = self._expiring_messages_cursor(cutoff, after, limit, list(exempt_user_ids), list(exempt_context_ids))
+        return [decode_message(doc) for doc in cursor]
 
-            expiry_time = time.time() - days * 86400  # 86400 seconds in a day
-            query = {
-                "timestamp": {"$lt": expiry_time},
-                "user_id": {"$nin": exempt_user_ids},
-                "context_id": {"$nin": exempt_context_ids}
-            }
-            
-            result = messages_collection.delete_many(query)
-            logger.info(f"Deleted {result.deleted_count} old documents")
-        except Exception as e:
-            logger.error(f"Error cleaning old messages: {e}")
+    def _delete_stored_messages(self, message_ids):
+        result = self.db['messages'].delete_many({"_id": {"$in": message_ids}})
+        return result.deleted_count
+
+    def load_state(self, name):
+        """读取维护任务的进度记录"""
+        state = self.db['maintenance'].find_one({'_id': name})
+        if state:
+            state.pop('_id')
+        return state
+
+    def save_state(self, name, state):
+        self.db['maintenance'].replace_one({'_id': name}, dict(state, _id=name), upsert=True)
+
+    def load_summary(self, name):
+        summary = self.db['summaries'].find_one({'_id': name})
+        if summary:
+            summary.pop('_id')
+        return summary
+
+    def save_summary(self, name, summary):
+        self.db['summaries'].replace_one({'_id': name}, dict(summary, _id=name), upsert=True)
 
     def clean_old_contexts(self, days=1):
         try:
@@ -191,18 +272,82 @@ class MongoDB:
         except Exception as e:
             logger.error(f"Error cleaning old contexts: {e}")
 
-    def delete_message(self, message_id):
-        try:
-            messages_collection = self.get_collection('messages')
-            result = messages_collection.delete_one({'_id': ObjectId(message_id)})
-            if result.deleted_count == 1:
-                logger.info(f"Deleted message with _id {message_id}")
-        except Exception as e:
-            logger.error(f"Error deleting message: {e}")
 
-    def delete_messages(self, messages_list):
-        try:
-            for message in messages_list:
-                self.delete_message(message['_id'])
-        except Exception as e:
-            logger.error(f"Error deleting messages: {e}")
+def _plan_stages(plan):
+    """按执行顺序展开 explain() 计划树中的所有阶段"""
+    stages = []
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages.extend(_plan_stages(child))
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+    return stages
+
+
+class AsyncDatabase:
+    """存储后端的协程版本：每个方法都在专用的有界线程池里执行，事件循环不会被数据库阻塞"""
+
+    def __init__(self, database, max_workers=4):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='database')
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(attr, *args, **kwargs))
+
+        setattr(self, name, method)  # 缓存包装好的协程方法
+        return method
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+DB_BACKENDS = ('mongodb', 'sqlite')
+
+_database = None
+_async_database = None
+_database_lock = threading.Lock()
+
+def create_database(backend=None):
+    """按 config.json 中的 db_backend 创建存储后端"""
+    backend = backend or config.DB_BACKEND
+    if backend == 'mongodb':
+        return MongoDB()
+    if backend == 'sqlite':
+        from app.sqlite_database import SQLiteDatabase
+        return SQLiteDatabase()
+    raise ValueError(f"Unsupported db_backend: {backend}, expected one of {DB_BACKENDS}")
+
+def get_database():
+    """进程内唯一的存储后端实例，供同步代码（定时任务线程等）使用"""
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = create_database()
+            logger.info(f"Using {config.DB_BACKEND} storage backend")
+        return _database
+
+def get_async_database():
+    """进程内唯一的 AsyncDatabase 实例，供协程使用"""
+    global _async_database
+    if _async_database is None:
+        _async_database = AsyncDatabase(get_database(), max_workers=config.DB_EXECUTOR_WORKERS)
+    return _async_database
+
+def close_database():
+    """写入缓冲中的消息，并关闭线程池与数据库连接"""
+    # 先等线程池里已提交的写入进入写缓冲，再刷新写缓冲，否则这些写入会落到已关闭的缓冲上
+    if _async_database is not None:
+        _async_database.close()
+    if _database is not None:
+        _database.close()
+    with _shared_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        client.close()
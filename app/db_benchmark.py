@@ -0,0 +1,111 @@
+# 用法：在项目根目录执行 python -m app.db_benchmark [--backends mongodb sqlite] [--messages 5000]
+# 比较各存储后端的写入吞吐和 get_recent_messages 延迟，数据写入单独的测试库，结束后删除
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from pymongo import MongoClient
+from app.config import Config
+from app.database import MongoDB, DB_BACKENDS
+from app.sqlite_database import SQLiteDatabase
+
+config = Config.get_instance()
+
+BENCHMARK_DB_SUFFIX = '_benchmark'
+
+
+def open_backend(backend, workdir):
+    if backend == 'mongodb':
+        # 先用短超时探测，避免连不上时卡在默认的 30 秒服务器选择超时上
+        probe = MongoClient(config.MONGO_URI, serverSelectionTimeoutMS=2000)
+        try:
+            probe.admin.command('ping')
+        finally:
+            probe.close()
+        return MongoDB(db_name=config.MONGO_DB_NAME + BENCHMARK_DB_SUFFIX)
+    return SQLiteDatabase(os.path.join(workdir, 'benchmark.db'))
+
+
+def drop_backend(database):
+    if isinstance(database, MongoDB):
+        database.client.drop_database(database.db.name)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_benchmark(database, messages, contexts, reads, limit):
+    group_ids = [100000 + i for i in range(contexts)]
+    results = {}
+
+    # 写入：走正常的写缓冲路径，计时到全部落库为止
+    # 积压达到写缓冲上限的一半时同步刷新一次，否则超过 max_pending 的消息会被写缓冲丢弃，吞吐虚高
+    backpressure = max(1, database.write_buffer.max_pending // 2)
+    started = time.perf_counter()
+    for i in range(messages):
+        group_id = random.choice(group_ids)
+        database.insert_chat_message(random.randint(1, 1000), f"question {i} " * 8, f"answer {i} " * 16, 'group', group_id)
+        if (i + 1) % backpressure == 0:
+            database.flush()
+    database.flush()
+    elapsed = time.perf_counter() - started
+    landed = sum(sum(1 for _ in database.iter_context_messages(0, 'group', group_id)) for group_id in group_ids)
+    results['landed'] = landed
+    results['insert_per_second'] = landed / elapsed
+
+    # 冷读：直接查询数据库，不经过会话缓存
+    cold = []
+    for _ in range(reads):
+        group_id = random.choice(group_ids)
+        started = time.perf_counter()
+        database.fetch_recent_messages(0, 'group', group_id, limit)
+        cold.append(time.perf_counter() - started)
+
+    # 热读：get_recent_messages，第一次未命中后都由会话缓存返回
+    warm = []
+    for _ in range(reads):
+        group_id = random.choice(group_ids)
+        started = time.perf_counter()
+        database.get_recent_messages(0, 'group', group_id, limit)
+        warm.append(time.perf_counter() - started)
+
+    for name, samples in (('cold', cold), ('cached', warm)):
+        results[f'{name}_p50_ms'] = statistics.median(samples) * 1000
+        results[f'{name}_p95_ms'] = percentile(samples, 0.95) * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark storage backends')
+    parser.add_argument('--backends', nargs='+', choices=DB_BACKENDS, default=list(DB_BACKENDS))
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--contexts', type=int, default=50)
+    parser.add_argument('--reads', type=int, default=1000)
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in args.backends:
+            try:
+                database = open_backend(backend, workdir)
+            except Exception as e:
+                print(f"{backend}: skipped ({type(e).__name__})")
+                continue
+            try:
+                results = run_benchmark(database, args.messages, args.contexts, args.reads, args.limit)
+            finally:
+                database.close()
+                drop_backend(database)
+            print(
+                f"{backend}: {results['insert_per_second']:.0f} inserts/s ({results['landed']}/{args.messages} written), "
+                f"get_recent_messages cold p50 {results['cold_p50_ms']:.2f}ms p95 {results['cold_p95_ms']:.2f}ms, "
+                f"cached p50 {results['cached_p50_ms']:.3f}ms p95 {results['cached_p95_ms']:.3f}ms"
+            )
+
+
+if __name__ == '__main__':
+    main()
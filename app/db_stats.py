@@ -0,0 +1,71 @@
+# 用法：在项目根目录执行 python -m app.db_stats [--sample 1000]
+# 报告 messages 集合的平均文档大小和工作集大小，并抽样估算旧格式与紧凑格式的文档大小
+import argparse
+import bson
+from pymongo import MongoClient
+from app.config import Config
+from app.message_codec import FIELDS, encode_message, decode_message
+
+config = Config.get_instance()
+
+
+def collection_stats(db):
+    stats = db.command('collStats', 'messages')
+    return {
+        'count': stats.get('count', 0),
+        'avg_document_bytes': stats.get('avgObjSize', 0),
+        'data_bytes': stats.get('size', 0),
+        'storage_bytes': stats.get('storageSize', 0),
+        'index_bytes': stats.get('totalIndexSize', 0),
+        # 热点查询需要常驻内存的部分：未压缩的数据加全部索引
+        'working_set_bytes': stats.get('size', 0) + stats.get('totalIndexSize', 0),
+    }
+
+
+def sample_sizes(db, sample_size):
+    """抽样比较同一批消息在旧格式（长字段名、不压缩）和紧凑格式下的 BSON 大小"""
+    legacy_total = compact_total = count = 0
+    for document in db['messages'].aggregate([{'$sample': {'size': sample_size}}]):
+        message = decode_message(document)
+        legacy = {name: value for name, value in message.items() if name == '_id' or name in FIELDS}
+        legacy_total += len(bson.encode(legacy))
+        compact_total += len(bson.encode(encode_message(message, config.MESSAGE_COMPRESS_THRESHOLD)))
+        count += 1
+    if not count:
+        return None
+    return {'sampled': count, 'legacy_avg_bytes': legacy_total / count, 'compact_avg_bytes': compact_total / count}
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report messages collection size')
+    parser.add_argument('--sample', type=int, default=1000, help='number of documents sampled for the format comparison')
+    args = parser.parse_args()
+
+    client = MongoClient(config.MONGO_URI)
+    try:
+        db = client[config.MONGO_DB_NAME]
+        stats = collection_stats(db)
+        print(f"messages: {stats['count']} documents, average {format_bytes(stats['avg_document_bytes'])}")
+        print(f"  data {format_bytes(stats['data_bytes'])}, on disk {format_bytes(stats['storage_bytes'])}, "
+              f"indexes {format_bytes(stats['index_bytes'])}, working set {format_bytes(stats['working_set_bytes'])}")
+
+        sizes = sample_sizes(db, args.sample)
+        if sizes:
+            saved = 1 - sizes['compact_avg_bytes'] / sizes['legacy_avg_bytes']
+            print(f"sample of {sizes['sampled']}: legacy format {format_bytes(sizes['legacy_avg_bytes'])}/doc, "
+                  f"compact format {format_bytes(sizes['compact_avg_bytes'])}/doc ({saved:.0%} smaller)")
+            print(f"  estimated working set with compact format: "
+                  f"{format_bytes(stats['count'] * sizes['compact_avg_bytes'] + stats['index_bytes'])}")
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
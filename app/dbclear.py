@@ -1,6 +1,9 @@
+# 用法：在项目根目录执行 python -m app.dbclear
 import time
 import pymongo
 import logging
+from app.migrations import run_migrations
+from app.message_codec import field
 #from app.config import Config
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -10,31 +13,39 @@ class MongoDBCleaner:
         self.client = pymongo.MongoClient(uri)
         self.db = self.client[db_name]
 
+    def migrate(self):
+        # 把旧的 group_id 文档迁移为 context_type/context_id，并转换为紧凑格式
+        executed = run_migrations(self.db)
+        logging.info(f"Applied {len(executed)} migrations")
+
     def clean_empty_responses(self):
         messages_collection = self.db['messages']
         # 定义查询条件
-        query = {"$or": [{"response_text": {"$exists": False}}, {"response_text": ""}]}
+        response = field('response_text')
+        query = {"$or": [{field('timestamp'): {"$exists": True}, response: {"$exists": False}}, {response: ""}]}
         result = messages_collection.delete_many(query)
         logging.info(f"Deleted {result.deleted_count} documents containing empty responses")
 
-    def clean_old_messages(self, hours=2, exempt_user_ids=None, exempt_group_ids=None):
+    def clean_old_messages(self, hours=2, exempt_user_ids=None, exempt_context_ids=None):
         if exempt_user_ids is None:
             exempt_user_ids = []
-        if exempt_group_ids is None:
-            exempt_group_ids = []
+        if exempt_context_ids is None:
+            exempt_context_ids = []
 
         messages_collection = self.db['messages']
         expiry_time = time.time() - hours * 1
         query = {
-            "timestamp": {"$lt": expiry_time},
-            "user_id": {"$nin": exempt_user_ids},
-            "group_id": {"$nin": exempt_group_ids}
+            field('timestamp'): {"$lt": expiry_time},
+            field('user_id'): {"$nin": exempt_user_ids},
+            field('context_id'): {"$nin": exempt_context_ids}
         }
         result = messages_collection.delete_many(query)
         logging.info(f"Deleted {result.deleted_count} documents older than {hours} hours")
 if __name__ == "__main__":
     # 使用数据库连接 URI 和数据库名称初始化清理工具
     mongo_cleaner = MongoDBCleaner()
+    # 先执行迁移，保证旧文档都有 context_id
+    mongo_cleaner.migrate()
     # 清除包含空值的历史消息
     mongo_cleaner.clean_empty_responses()
     # 清除一段时间前的消息记录
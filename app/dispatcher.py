@@ -0,0 +1,116 @@
+# dispatcher.py
+# 按会话分发消息：每个会话一个邮箱，邮箱内严格按顺序处理，不同会话之间并行，同时活跃的会话数有上限
+import asyncio
+import time
+from collections import deque
+from app.logger import logger
+
+
+class _Mailbox:
+    __slots__ = ('key', 'events', 'scheduled', 'last_active', 'processed')
+
+    def __init__(self, key):
+        self.key = key
+        self.events = deque()
+        self.scheduled = False  # 在就绪队列中或正在处理
+        self.last_active = time.monotonic()
+        self.processed = 0
+
+
+class ContextDispatcher:
+    """会话调度器，TaskManager 负责实际执行
+
+    同一会话的消息依次处理，历史记录的读写不会互相穿插，回复也不会乱序；
+    一个会话连续处理 burst 条后让出位置，避免刷屏的群占满所有并发。
+    调用方应先 await wait_for_capacity() 再从消息队列取下一条，积压留在优先级队列里按通道和权重排序，
+    而不是堆在这里的先进先出就绪队列中。
+    """
+
+    def __init__(self, task_manager, handler, key_of, max_active=10, burst=4, idle_timeout=300):
+        self.task_manager = task_manager
+        self.handler = handler
+        self.key_of = key_of
+        self.max_active = max_active
+        self.burst = burst
+        self.idle_timeout = idle_timeout
+        self._mailboxes = {}
+        self._ready = deque()  # 有待处理消息、等待执行的邮箱
+        self._active = 0
+        self._capacity = asyncio.Event()  # 有空闲的处理名额
+        self._capacity.set()
+        self._last_eviction = time.monotonic()
+
+    def __repr__(self):
+        return f"<ContextDispatcher {self.stats()}>"
+
+    async def dispatch(self, event):
+        key = self.key_of(event)
+        mailbox = self._mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self._mailboxes[key] = _Mailbox(key)
+        mailbox.events.append(event)
+        if not mailbox.scheduled:
+            mailbox.scheduled = True
+            self._ready.append(mailbox)
+        await self._schedule()
+        self._evict_idle()
+
+    def has_capacity(self):
+        return self._active + len(self._ready) < self.max_active
+
+    async def wait_for_capacity(self):
+        """等到有会话处理完、空出处理名额"""
+        while not self.has_capacity():
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    def stats(self):
+        return {
+            'mailboxes': len(self._mailboxes),
+            'active': self._active,
+            'ready': len(self._ready),
+            'queued': sum(len(mailbox.events) for mailbox in self._mailboxes.values()),
+        }
+
+    async def _schedule(self):
+        while self._ready and self._active < self.max_active:
+            mailbox = self._ready.popleft()
+            self._active += 1
+            await self.task_manager.add_task(self._run(mailbox))
+
+    async def _run(self, mailbox):
+        try:
+            for _ in range(self.burst):
+                if not mailbox.events:
+                    break
+                event = mailbox.events.popleft()
+                try:
+                    await self.handler(event)
+                except Exception as e:
+                    logger.error(f"Error handling event for {mailbox.key}: {e}")
+                mailbox.processed += 1
+        finally:
+            mailbox.last_active = time.monotonic()
+            self._active -= 1
+            if mailbox.events:
+                self._ready.append(mailbox)  # 还有消息，排到队尾等下一轮
+            else:
+                mailbox.scheduled = False
+            await self._schedule()
+            if self.has_capacity():
+                self._capacity.set()
+
+    def _evict_idle(self):
+        """移除长时间没有消息的空邮箱"""
+        now = time.monotonic()
+        if now - self._last_eviction < self.idle_timeout / 2:
+            return
+        self._last_eviction = now
+        idle = [
+            key for key, mailbox in self._mailboxes.items()
+            if not mailbox.scheduled and now - mailbox.last_active > self.idle_timeout
+        ]
+        for key in idle:
+            del self._mailboxes[key]
+        if idle:
+            logger.debug(f"Evicted {len(idle)} idle mailboxes, {len(self._mailboxes)} remaining")
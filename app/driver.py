@@ -1,9 +1,14 @@
+import os
 from typing import Callable
 from app.config import Config
+from drivers.shard_driver import WORKER_ENV
 
 config = Config.get_instance()
 
-if config.CONNECTION_TYPE == 'http':
+if os.environ.get(WORKER_ENV):
+    # 分片工作进程：API 调用经入口进程转发
+    from drivers.shard_driver import ShardDriver as Driver
+elif config.CONNECTION_TYPE == 'http':
     from drivers.http_driver import HttpDriver as Driver
 elif config.CONNECTION_TYPE == 'ws':
     from drivers.ws_driver import WebSocketDriver as Driver
@@ -22,7 +22,7 @@ async def call_function(model_name, endpoint, payload):
         return None
 
 async def handle_command_request(user_input):
-    COMMAND_PATTERN = re.compile(r'^[!/](help|reset|character|history|clear|model|r18|music_list)(?:\s+(.+))?')
+    COMMAND_PATTERN = re.compile(r'^[!/](help|reset|character|history|clear|search|model|r18|music_list)(?:\s+(.+))?')
     match = COMMAND_PATTERN.match(user_input)
     if match:
         command = match.group(1)
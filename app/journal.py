@@ -0,0 +1,232 @@
+# journal.py
+# 入口日志：进入消息队列的事件先追加到磁盘日志，回复发出（或消息被丢弃）后再追加一条确认记录
+# 进程崩溃或重启后，没有确认的事件会被重新放回队列
+#
+# 目录结构：<journal_path>/<序号>.log，写满 segment_bytes 后换下一个段文件，所有事件都确认过的旧段直接删除
+# 记录格式：长度(4) + crc32(4) + 内容，内容第一个字节是类型
+#   事件：类型(1) + 编号(8) + 写入时间(8) + 事件 JSON
+#   确认：类型(1) + 编号(8)
+# 写入由后台线程批量完成，一批只 fsync 一次；末尾写了一半的记录在恢复时按 crc 校验丢弃
+import asyncio
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from app.logger import logger
+from app.storage import BackgroundFlusher
+
+HEADER = struct.Struct('<II')
+EVENT = struct.Struct('<BQd')
+ACK = struct.Struct('<BQ')
+KIND_EVENT = 1
+KIND_ACK = 2
+
+JOURNAL_ID_KEY = '_journal_id'  # 下划线开头，转发给工作进程时会被去掉
+SEGMENT_SUFFIX = '.log'
+EARLY_FLUSH_BYTES = 256 * 1024  # 积累这么多未写入的字节时不等时间间隔，立即写盘
+
+
+async def run_journaled(event, handle, done):
+    """执行 handle(event)，结束后调用 done(event, acknowledge)
+
+    只有被取消（如关闭时排空超时）时 acknowledge 为 False：消息还没有回复，留在日志里下次启动时重放。
+    handle 抛出其他异常时仍然确认，避免同一条消息每次重启都失败。
+    """
+    acknowledge = True
+    try:
+        await handle(event)
+    except asyncio.CancelledError:
+        acknowledge = False
+        raise
+    finally:
+        done(event, acknowledge)
+
+
+def _record(payload):
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_records(path):
+    """依次返回段文件中完整的记录内容，遇到不完整或校验失败的记录就停止"""
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, checksum = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                logger.warning(f"Journal segment {path} has a torn record at offset {offset}, ignoring the rest")
+                return
+            yield payload
+            offset = start + length
+
+
+class IngressJournal(BackgroundFlusher):
+    def __init__(self, root, segment_bytes=16 * 1024 * 1024, fsync_interval=0.05):
+        super().__init__(fsync_interval, name='ingress-journal')
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._buffer = []  # [(段序号, 字节)]
+        self._buffered_bytes = 0
+        self._segment_of = {}  # 未确认事件的编号 -> 段序号
+        self._live = {}  # 段序号 -> 其中未确认的事件数
+        self._recovered = []  # [(编号, 写入时间, 事件)]
+        self._files = {}
+        self._segment = 0
+        self._segments = []  # 磁盘上（或即将创建）的段，从旧到新
+        self._segment_size = 0
+        self._next_id = 1
+        self.fsyncs = 0
+        self.written_bytes = 0
+        os.makedirs(root, exist_ok=True)
+        self._recover()
+        self.start()
+
+    def _path(self, segment):
+        return os.path.join(self.root, f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.root) if name.endswith(SEGMENT_SUFFIX))
+        events = {}
+        acked = set()
+        for segment in segments:
+            for payload in _read_records(self._path(segment)):
+                if payload[0] == KIND_EVENT:
+                    _, event_id, written_at = EVENT.unpack_from(payload)
+                    events[event_id] = (segment, written_at, payload[EVENT.size:])
+                elif payload[0] == KIND_ACK:
+                    acked.add(ACK.unpack_from(payload)[1])
+                self._next_id = max(self._next_id, struct.unpack_from('<Q', payload, 1)[0] + 1)
+        for event_id, (segment, written_at, body) in sorted(events.items()):
+            if event_id in acked:
+                continue
+            self._segment_of[event_id] = segment
+            self._live[segment] = self._live.get(segment, 0) + 1
+            self._recovered.append((event_id, written_at, body))
+        # 总是从新的段开始写，不接在可能写坏的末尾后面
+        self._segment = (segments[-1] + 1) if segments else 1
+        self._segments = segments + [self._segment]
+        self._delete_acknowledged(self._segment)
+        if self._recovered:
+            logger.info(f"Journal recovered {len(self._recovered)} unacknowledged events from {len(self._live)} segments")
+
+    def replay(self, max_age):
+        """返回恢复出的未确认事件（按写入顺序），超过 max_age 秒的直接确认掉不再处理"""
+        now = time.time()
+        events = []
+        stale = 0
+        for event_id, written_at, body in self._recovered:
+            event = json.loads(body)
+            event[JOURNAL_ID_KEY] = event_id
+            if max_age and now - written_at > max_age:
+                self.ack(event)
+                stale += 1
+                continue
+            events.append(event)
+        self._recovered = []
+        if stale:
+            logger.info(f"Journal skipped {stale} events older than {max_age}s")
+        return events
+
+    def append(self, event):
+        """记录一个进入队列的事件，并在事件上标记编号"""
+        body = json.dumps({key: value for key, value in event.items() if not key.startswith('_')},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+            self._segment_of[event_id] = self._segment
+            self._live[self._segment] = self._live.get(self._segment, 0) + 1
+            self._write(EVENT.pack(KIND_EVENT, event_id, time.time()) + body)
+        event[JOURNAL_ID_KEY] = event_id
+
+    def ack(self, event):
+        """事件已经处理完（或被丢弃），以后不再重放"""
+        event_id = event.get(JOURNAL_ID_KEY)
+        if event_id is None:
+            return
+        with self._lock:
+            segment = self._segment_of.pop(event_id, None)
+            if segment is None:
+                return
+            self._live[segment] -= 1
+            self._write(ACK.pack(KIND_ACK, event_id))
+
+    def _write(self, payload):
+        record = _record(payload)
+        if self._segment_size >= self.segment_bytes:
+            self._segment += 1
+            self._segments.append(self._segment)
+            self._segment_size = 0
+        self._buffer.append((self._segment, record))
+        self._segment_size += len(record)
+        self._buffered_bytes += len(record)
+        if self._buffered_bytes >= EARLY_FLUSH_BYTES:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._segment_of)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_events': len(self._segment_of),
+                'segments': len(self._segments),
+                'buffered_bytes': self._buffered_bytes,
+                'written_bytes': self.written_bytes,
+                'fsyncs': self.fsyncs,
+            }
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+                self._buffered_bytes = 0
+                active = self._segment
+            if not batch:
+                return
+            touched = {}
+            for segment, record in batch:
+                f = self._files.get(segment)
+                if f is None:
+                    f = self._files[segment] = open(self._path(segment), 'ab')
+                f.write(record)
+                touched[segment] = f
+                self.written_bytes += len(record)
+            for f in touched.values():
+                f.flush()
+                os.fsync(f.fileno())
+            self.fsyncs += 1
+            for segment in list(self._files):
+                if segment < active:
+                    self._files.pop(segment).close()
+            self._delete_acknowledged(active)
+
+    def _delete_acknowledged(self, active):
+        """从最旧的段开始删除事件都已确认的段，遇到还有未确认事件的段就停止
+
+        确认记录只会出现在它所确认的事件之后，只删前缀就不会删掉还有用的确认记录。
+        """
+        while True:
+            with self._lock:
+                if not self._segments or self._segments[0] >= active or self._live.get(self._segments[0]):
+                    return
+                segment = self._segments.pop(0)
+                self._live.pop(segment, None)
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass  # 只有确认记录、还没来得及写入的段
+
+    def close(self):
+        super().close()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
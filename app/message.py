@@ -9,14 +9,24 @@ from app.config import Config
 from app.command import handle_command
 from app.decorators import select_connection_method
 from utils.voice_service import generate_voice
-from utils.model_request import get_chat_response
+from utils.model_request import get_chat_response, stream_chat_response, get_context_budget, cache_tags
+from app.context_builder import build_messages
 from app.function_calling import handle_image_request, handle_voice_request, handle_image_recognition, handle_command_request, handle_music_request
-from app.database import MongoDB
+from app.database import get_async_database
+from app.quick_reply import bind_quick_reply, release_quick_reply, try_quick_reply
+from app.task_manger import LatencyHistogram
+from app.summarizer import summarizer
 
 config = Config.get_instance()
 
-# 添加数据库连接实例
-db = MongoDB()
+# 进程内共享的异步数据库实例
+db = get_async_database()
+
+# 从开始处理消息到发出第一条回复的耗时，用户实际感受到的等待时间
+first_message_latency = LatencyHistogram()
+
+# 句末标点（英文句点后面要跟空白，避免拆开小数和网址），后面可能还跟着右引号或右括号
+SENTENCE_END = re.compile(r'(?:[。！？!?…\n]|\.(?=\s))+[」』”"’）)]*')
 
 # 超时重试装饰器
 def retry_on_timeout(retries=1, timeout=10):
@@ -55,6 +65,9 @@ async def send_msg(msg_type, number, msg, use_voice=False, is_error_message=Fals
         **({'group_id': number} if msg_type == 'group' else {'user_id': number})
     }
     if config.CONNECTION_TYPE == 'http':
+        # 事件上报的响应还在等待时，直接作为快速操作返回
+        if try_quick_reply(msg_type, number, msg):
+            return
         url = f"http://127.0.0.1:3000/send_{msg_type}_msg"
         try:
             response = await send_http_request(url, params)
@@ -80,6 +93,49 @@ async def send_msg(msg_type, number, msg, use_voice=False, is_error_message=Fals
             logger.error(f"HTTP error occurred: {e}")
             await send_msg(msg_type, number, f"HTTP 错误: {e}")
 
+class StreamingReply:
+    """流式回复：文本按整句发出，两次发送至少间隔 min_interval 秒，间隔内生成的句子合并成一条，避免触发 QQ 的发送频率限制"""
+
+    def __init__(self, send, min_interval, prefix='', started=None):
+        self.send = send
+        self.min_interval = min_interval
+        self.prefix = prefix
+        self.started = started if started is not None else time.monotonic()
+        self.text = ''
+        self._pending = ''
+        self._last_sent = None
+
+    async def feed(self, delta):
+        self.text += delta
+        self._pending += delta
+        if self._last_sent is not None and time.monotonic() - self._last_sent < self.min_interval:
+            return
+        # 紧挨着末尾的句末标点先不切，后面可能还有省略号的后半或右引号
+        ends = [match.end() for match in SENTENCE_END.finditer(self._pending) if match.end() < len(self._pending)]
+        if ends:
+            cut = ends[-1]
+            chunk, self._pending = self._pending[:cut], self._pending[cut:]
+            await self._send(chunk)
+
+    async def finish(self):
+        """发出剩下的文本，返回完整的回复"""
+        if self._pending.strip():
+            if self._last_sent is not None:
+                await asyncio.sleep(max(0.0, self.min_interval - (time.monotonic() - self._last_sent)))
+            await self._send(self._pending)
+        self._pending = ''
+        return self.text.strip()
+
+    async def _send(self, chunk):
+        chunk = chunk.strip()
+        if not chunk:
+            return
+        if self._last_sent is None:
+            chunk = self.prefix + chunk
+            first_message_latency.record(time.monotonic() - self.started)
+        self._last_sent = time.monotonic()
+        await self.send(chunk)
+
 def get_dialogue_response(user_input):
     for dialogue in config.DIALOGUES:
         if dialogue["user"] == user_input:
@@ -90,6 +146,8 @@ def process_chat_message(msg_type):
     def decorator(func):
         @wraps(func)
         async def wrapper(rev, *args, **kwargs):
+            quick_reply_token = bind_quick_reply(rev)
+            started = time.monotonic()
             try:
                 user_input = rev['raw_message']
                 user_id = rev['sender']['user_id']
@@ -99,7 +157,7 @@ def process_chat_message(msg_type):
                 context_id = recipient_id
 
                 user_info = {"user_id": user_id, "username": username}
-                db.insert_user_info(user_info)
+                await db.insert_user_info(user_info)
 
                 # 调用原始函数，可能会修改 user_input 或执行其他特定逻辑
                 modified_input = await func(rev, *args, **kwargs)
@@ -118,37 +176,62 @@ def process_chat_message(msg_type):
                 special_response = await handle_special_requests(user_input)
                 if special_response:
                     await send_msg(msg_type, recipient_id, special_response)
-                    db.insert_chat_message(user_id, user_input, special_response, context_type, context_id)
+                    await db.insert_chat_message(user_id, user_input, special_response, context_type, context_id)
                     return
 
-                recent_messages = db.get_recent_messages(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=10)
+                # 取会话缓存里的全部轮次，再按模型的 token 预算从新到旧截取
+                recent_turns = await db.get_recent_turns(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=config.CONTEXT_CACHE_TURNS)
                 system_message_text = "\n".join(config.SYSTEM_MESSAGE.values())
                 if user_id == config.ADMIN_ID:
                     admin_title = random.choice(config.ADMIN_TITLES)
                     user_input = f"{admin_title}: {user_input}"
                 else:
                     user_input = f"{username}: {user_input}"
-                messages = [{"role": "system", "content": system_message_text}] + recent_messages + [{"role": "user", "content": user_input}]
+                summary = await db.get_summary(recipient_id, context_type, context_id) if summarizer is not None else None
+                messages, prompt_tokens = build_messages(system_message_text, recent_turns, user_input, get_context_budget(), summary=summary)
+                logger.debug(f"Context for {context_type}:{context_id}: {len(messages)} messages, ~{prompt_tokens} tokens")
 
                 response_text = get_dialogue_response(user_input) if user_id == config.ADMIN_ID else None
-                if response_text is None:
-                    response_text = await get_chat_response(messages)
+                tags = cache_tags(context_type, context_id, user_id)
+                streamed = False
+                if response_text is None and config.STREAM_REPLY:
+                    # 边生成边按句发送，完整的回复在最后统一保存
+                    reply = StreamingReply(
+                        lambda chunk: send_msg(msg_type, recipient_id, chunk),
+                        config.STREAM_MIN_INTERVAL,
+                        prefix='' if user_id == config.ADMIN_ID else f"{username}，",
+                        started=started
+                    )
+                    async for delta in stream_chat_response(messages, cache_tags=tags):
+                        await reply.feed(delta)
+                    response_text = await reply.finish()
+                    streamed = True
+                elif response_text is None:
+                    response_text = await get_chat_response(messages, cache_tags=tags)
 
                 if response_text:
-                    db.insert_chat_message(user_id, user_input, response_text, context_type, context_id)
+                    await db.insert_chat_message(user_id, user_input, response_text, context_type, context_id)
+                    if summarizer is not None:
+                        summarizer.note(recipient_id, context_type, context_id)
                     # 添加一个参数来指示是否处理特殊响应
                     process_special = not user_input.startswith(('!history', '/history', '#history'))
                     await process_special_responses(response_text, msg_type, recipient_id, user_id, user_input, context_type, context_id, process_special=process_special)
 
+                if streamed:
+                    return
+
                 if user_id == config.ADMIN_ID:                    
                     response_with_username = response_text
                 else:
                     response_with_username = f"{username}，{response_text}"
 
                 await send_msg(msg_type, recipient_id, response_with_username)
+                first_message_latency.record(time.monotonic() - started)
             except Exception as e:
                 logger.error(f"Error in process_chat_message: {e}")
                 await send_msg(msg_type, recipient_id, "阿巴阿巴，出错了。")
+            finally:
+                release_quick_reply(quick_reply_token)
         
         return wrapper
     return decorator
@@ -195,7 +278,7 @@ async def process_special_responses(response_text, msg_type, recipient_id, user_
                 logger.info(f"Audio filename: {audio_filename}")
                 if (audio_filename):
                     await send_msg(msg_type, recipient_id, f"[CQ:record,file=http://localhost:4321/data/voice/{audio_filename}]")
-                    db.insert_chat_message(user_id, user_input, f"[CQ:record,file=http://localhost:4321/data/voice/{audio_filename}]", context_type, context_id)
+                    await db.insert_chat_message(user_id, user_input, f"[CQ:record,file=http://localhost:4321/data/voice/{audio_filename}]", context_type, context_id)
                 else:
                     await send_msg(msg_type, recipient_id, "语音合成失败。")
                 return
@@ -206,7 +289,7 @@ async def process_special_responses(response_text, msg_type, recipient_id, user_
         recognition_result = await handle_image_recognition(response_text[10:].strip())
         if recognition_result:
             await send_msg(msg_type, recipient_id, f"识别结果：{recognition_result}")
-            db.insert_chat_message(user_id, user_input, f"识别结果：{recognition_result}", context_type, context_id)
+            await db.insert_chat_message(user_id, user_input, f"识别结果：{recognition_result}", context_type, context_id)
         return
     elif process_special and '#draw' in response_text:
         logger.info("Draw request detected")
@@ -230,7 +313,7 @@ async def process_special_responses(response_text, msg_type, recipient_id, user_
             draw_result = await handle_image_request(response_text)
             if draw_result:
                 await send_msg(msg_type, recipient_id, f"[CQ:image,file={draw_result}]")
-                db.insert_chat_message(user_id, user_input, f"[CQ:image,file={draw_result}]", context_type, context_id)
+                await db.insert_chat_message(user_id, user_input, f"[CQ:image,file={draw_result}]", context_type, context_id)
             else:
                 await send_msg(msg_type, recipient_id, "抱歉，我无法生成这个图片。可能是提示词不够清晰或具体。")
         except Exception as e:
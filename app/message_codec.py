@@ -0,0 +1,74 @@
+# message_codec.py
+# messages 集合的紧凑存储格式：短字段名、数字会话类型，超过阈值的正文用 zlib 压缩后以二进制保存
+# 调用方始终使用长字段名的字典，编码和解码只发生在 MongoDB 后端内部
+import zlib
+
+# 长字段名 -> 存储字段名
+FIELDS = {
+    'user_id': 'u',
+    'user_input': 'i',
+    'response_text': 'r',
+    'context_type': 't',
+    'context_id': 'c',
+    'timestamp': 'ts',
+    'tokens': 'n',  # 这一轮对话的估计 token 数，组装上下文时使用
+}
+LONG_FIELDS = {short: name for name, short in FIELDS.items()}
+
+CONTEXT_TYPES = {'private': 0, 'group': 1}
+CONTEXT_TYPE_NAMES = {number: name for name, number in CONTEXT_TYPES.items()}
+
+TEXT_FIELDS = ('user_input', 'response_text')
+DEFAULT_COMPRESS_THRESHOLD = 1024  # 字节，正文超过这个长度才压缩
+COMPRESSION_LEVEL = 6
+
+
+def field(name):
+    return FIELDS[name]
+
+
+def context_type_code(context_type):
+    return CONTEXT_TYPES.get(context_type, context_type)
+
+
+def projection(*names):
+    return {FIELDS[name]: 1 for name in names}
+
+
+def encode_message(message, compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+    """长字段名的消息 -> 存储格式；空正文不保存"""
+    document = {}
+    if '_id' in message:
+        document['_id'] = message['_id']
+    for name, value in message.items():
+        short = FIELDS.get(name)
+        if short is None or value is None:
+            continue
+        if name == 'context_type':
+            value = context_type_code(value)
+        elif name in TEXT_FIELDS:
+            if value == '':
+                continue
+            raw = value.encode('utf-8')
+            if len(raw) > compress_threshold:
+                compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+                if len(compressed) < len(raw):
+                    value = compressed  # bytes 会以 BSON 二进制保存，读取时据此判断是否压缩过
+        document[short] = value
+    return document
+
+
+def decode_message(document):
+    """存储格式 -> 长字段名的消息；没有转换过的旧文档原样返回"""
+    message = {}
+    for key, value in document.items():
+        name = LONG_FIELDS.get(key)
+        if name is None:
+            message[key] = value
+            continue
+        if name == 'context_type':
+            value = CONTEXT_TYPE_NAMES.get(value, value)
+        elif isinstance(value, bytes):
+            value = zlib.decompress(value).decode('utf-8')
+        message[name] = value
+    return message
@@ -0,0 +1,309 @@
+# message_queue.py
+# 多通道优先级消息队列：命令 > @/私聊 > 随机插话，低优先级通道只在高优先级通道空闲时出队
+# 每个通道内部按会话做加权的赤字轮询（DRR），一个刷屏的群不会让其他会话一直排队
+import asyncio
+import time
+from collections import Counter, OrderedDict, deque
+from app.logger import logger
+
+LANE_COMMAND = 0   # 管理员消息与命令
+LANE_DIRECT = 1    # @机器人、提到昵称和私聊
+LANE_CHATTER = 2   # 按 reply_probability 随机插话的群聊
+LANE_NAMES = ('command', 'direct', 'chatter')
+
+# 队列满时的处理策略
+OVERFLOW_BLOCK = 'block'                        # 等待空位（会阻塞上报连接）
+OVERFLOW_DROP_OLDEST = 'drop_oldest'            # 丢弃等待最久的消息
+OVERFLOW_DROP_LOWEST = 'drop_lowest_priority'   # 丢弃最低优先级通道里积压最多的会话中最旧的消息
+OVERFLOW_COALESCE = 'coalesce'                  # 同一会话只保留最新一条，否则按最低优先级丢弃
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_LOWEST, OVERFLOW_COALESCE)
+
+# 丢弃原因
+DROP_OVERFLOW = 'overflow'
+DROP_COALESCED = 'coalesced'
+DROP_EXPIRED = 'expired'
+DROP_CLEARED = 'cleared'
+DROP_SHUTDOWN = 'shutdown'  # 关闭程序时丢弃，重启后从入口日志重放
+
+WAIT_SAMPLES = 256          # 每个会话保留最近多少次排队时间
+MAX_TRACKED_CONTEXTS = 1000
+MIN_WEIGHT = 0.01           # 权重为 0 的会话也会被慢慢处理，不会让轮询空转
+
+
+class _FairLane:
+    """一个优先级通道：每个会话一个子队列，按权重轮流出队"""
+
+    def __init__(self, weight_of):
+        self.weight_of = weight_of
+        self.queues = {}  # 会话 -> deque[(入队时间, 消息)]
+        self.active = deque()  # 有积压的会话，轮询顺序
+        self.deficit = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, context, entry):
+        queue = self.queues.get(context)
+        if queue is None:
+            queue = self.queues[context] = deque()
+            self.active.append(context)
+            self.deficit[context] = 0.0
+        queue.append(entry)
+        self.size += 1
+
+    def pop(self, eligible):
+        """按 DRR 取出下一条；eligible(context) 为 False 的会话本轮跳过，全都不可取时返回 None"""
+        while self.active:
+            found_eligible = False
+            for _ in range(len(self.active)):
+                context = self.active[0]
+                if not eligible(context):
+                    self.active.rotate(-1)
+                    continue
+                found_eligible = True
+                if self.deficit[context] < 1:
+                    # 每轮轮到时补充一次额度，权重小于 1 的会话要攒几轮才能出队一条
+                    self.deficit[context] += max(self.weight_of(context), MIN_WEIGHT)
+                    if self.deficit[context] < 1:
+                        self.active.rotate(-1)
+                        continue
+                self.deficit[context] -= 1
+                entry = self._popleft(context)
+                if context in self.queues and self.deficit[context] < 1:
+                    self.active.rotate(-1)
+                return context, entry
+            if not found_eligible:
+                return None
+        return None
+
+    def remove_oldest(self, context):
+        return self._popleft(context)
+
+    def oldest(self):
+        """(入队时间, 会话)，通道为空时返回 None"""
+        return min(((queue[0][0], context) for context, queue in self.queues.items()), default=None, key=lambda item: item[0])
+
+    def longest(self):
+        return max(self.queues, key=lambda context: len(self.queues[context]))
+
+    def drain(self):
+        for context in list(self.queues):
+            while context in self.queues:
+                yield context, self._popleft(context)
+
+    def _popleft(self, context):
+        queue = self.queues[context]
+        entry = queue.popleft()
+        self.size -= 1
+        if not queue:
+            del self.queues[context]
+            del self.deficit[context]
+            self.active.remove(context)
+        return entry
+
+
+class PriorityMessageQueue:
+    """与 asyncio.Queue 接口兼容的多通道队列
+
+    weight_of(context) 给出会话的权重，默认都是 1；max_inflight 限制每个会话已出队但还没
+    task_done() 的消息数，达到上限的会话暂时不出队，积压留在队列里接受溢出策略的约束。
+    消息真正开始处理时调用 start(item)，排队时间统计的是从入队到开始处理，包括出队后在调度器里等待的时间；
+    max_age 在出队和开始处理时各检查一次，start() 返回 False 表示消息已超时丢弃，调用方仍需 task_done()。
+    """
+
+    def __init__(self, maxsize=0, lane_of=None, context_of=None, overflow_policy=OVERFLOW_BLOCK, max_age=0, on_drop=None,
+                 weight_of=None, max_inflight=0):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unsupported overflow policy: {overflow_policy}")
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self.max_age = max_age
+        self.max_inflight = max_inflight
+        self._lane_of = lane_of or (lambda item: LANE_CHATTER)
+        self._context_of = context_of or (lambda item: None)
+        self._on_drop = on_drop
+        self._lanes = [_FairLane(weight_of or (lambda context: 1)) for _ in LANE_NAMES]
+        self._size = 0
+        self._inflight = Counter()  # 会话 -> 已出队未完成的消息数
+        self._changed = asyncio.Event()  # 有新消息或有会话完成了一条消息
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self.dropped = Counter()  # 按 "原因:通道" 计数
+        self._waits = OrderedDict()  # 会话 -> 最近的排队时间（秒）
+        self._started = {}  # id(已出队未开始处理的消息) -> (会话, 入队时间)
+
+    def __repr__(self):
+        return f"<PriorityMessageQueue size={self._size} lanes={self.lane_depths()}>"
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self._size
+
+    def lane_depths(self):
+        """各通道当前的积压深度"""
+        return {name: len(lane) for name, lane in zip(LANE_NAMES, self._lanes)}
+
+    def drop_counts(self):
+        return dict(self.dropped)
+
+    def wait_stats(self):
+        """各会话最近的排队时间（从入队到开始处理）统计（毫秒），用来调整权重"""
+        stats = {}
+        for context, samples in self._waits.items():
+            ordered = sorted(samples)
+            stats[_context_name(context)] = {
+                'count': len(ordered),
+                'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                'max_ms': round(ordered[-1] * 1000, 1),
+            }
+        return stats
+
+    def put_nowait(self, item):
+        lane = self._lane_of(item)
+        context = self._context_of(item)
+        if self.full() and not self._make_room(item, lane, context):
+            return
+        self._lanes[lane].append(context, (time.monotonic(), item))
+        self._size += 1
+        self._changed.set()
+        self._update_events()
+
+    async def put(self, item):
+        while self.full() and self.overflow_policy == OVERFLOW_BLOCK:
+            self._not_full.clear()
+            await self._not_full.wait()
+        self.put_nowait(item)
+
+    def get_nowait(self):
+        now = time.monotonic()
+        for index, lane in enumerate(self._lanes):
+            while True:
+                popped = lane.pop(self._can_dispatch)
+                if popped is None:
+                    break
+                context, (enqueued_at, item) = popped
+                self._size -= 1
+                if self.max_age and now - enqueued_at > self.max_age:
+                    self._drop(item, index, DROP_EXPIRED)
+                    continue
+                self._inflight[context] += 1
+                self._started[id(item)] = (context, enqueued_at)
+                self._update_events()
+                return item
+        self._update_events()
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        while True:
+            self._changed.clear()
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                # 队列为空，或者剩下的会话都达到了并发上限
+                await self._changed.wait()
+
+    def start(self, item):
+        """出队的消息开始处理，记录它的排队时间；等待超过 max_age 时丢弃并返回 False"""
+        entry = self._started.pop(id(item), None)
+        if entry is None:
+            return True
+        context, enqueued_at = entry
+        waited = time.monotonic() - enqueued_at
+        if self.max_age and waited > self.max_age:
+            self._drop(item, self._lane_of(item), DROP_EXPIRED)
+            return False
+        self._record_wait(context, waited)
+        return True
+
+    def task_done(self, item):
+        """一条出队的消息处理完毕，释放它所在会话的并发名额"""
+        self._started.pop(id(item), None)
+        context = self._context_of(item)
+        if self._inflight[context] > 1:
+            self._inflight[context] -= 1
+        else:
+            self._inflight.pop(context, None)
+        self._changed.set()
+
+    def clear(self, reason=DROP_CLEARED):
+        """清空所有通道，返回被丢弃的消息数"""
+        count = self._size
+        for index, lane in enumerate(self._lanes):
+            for _, (_, item) in lane.drain():
+                self._drop(item, index, reason)
+        self._size = 0
+        self._update_events()
+        return count
+
+    def _can_dispatch(self, context):
+        return not self.max_inflight or self._inflight[context] < self.max_inflight
+
+    def _record_wait(self, context, seconds):
+        samples = self._waits.get(context)
+        if samples is None:
+            samples = self._waits[context] = deque(maxlen=WAIT_SAMPLES)
+            if len(self._waits) > MAX_TRACKED_CONTEXTS:
+                self._waits.popitem(last=False)
+        else:
+            self._waits.move_to_end(context)
+        samples.append(seconds)
+
+    def _make_room(self, item, lane, context):
+        """队列已满时按策略腾出一个位置，返回 False 表示丢弃新消息本身"""
+        if self.overflow_policy == OVERFLOW_BLOCK:
+            raise asyncio.QueueFull
+
+        if self.overflow_policy == OVERFLOW_COALESCE and context is not None:
+            for index, queued in enumerate(self._lanes):
+                if context in queued.queues:
+                    _, queued_item = queued.remove_oldest(context)
+                    self._size -= 1
+                    self._drop(queued_item, index, DROP_COALESCED)
+                    return True
+
+        if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            candidates = [(queued.oldest(), index) for index, queued in enumerate(self._lanes) if len(queued)]
+            (_, victim_context), victim_lane = min(candidates, key=lambda candidate: candidate[0][0])
+        else:
+            victim_lane = max(index for index, queued in enumerate(self._lanes) if len(queued))
+            if lane > victim_lane:
+                # 新消息的优先级比队列里所有消息都低
+                self._drop(item, lane, DROP_OVERFLOW)
+                return False
+            # 同一通道里由积压最多的会话承担丢弃
+            victim_context = self._lanes[victim_lane].longest()
+
+        _, victim = self._lanes[victim_lane].remove_oldest(victim_context)
+        self._size -= 1
+        self._drop(victim, victim_lane, DROP_OVERFLOW)
+        return True
+
+    def _drop(self, item, lane, reason):
+        self.dropped[f"{reason}:{LANE_NAMES[lane]}"] += 1
+        if reason not in (DROP_CLEARED, DROP_SHUTDOWN):
+            logger.warning(f"Dropped queued message ({reason}, lane={LANE_NAMES[lane]}), drop counts: {self.drop_counts()}")
+        if self._on_drop is not None:
+            try:
+                self._on_drop(item, reason)
+            except Exception as e:
+                logger.error(f"Error in queue drop callback: {e}")
+
+    def _update_events(self):
+        if self.full():
+            self._not_full.clear()
+        else:
+            self._not_full.set()
+
+
+def _context_name(context):
+    """('group', 123) -> "group:123"，与配置中的键格式一致"""
+    if isinstance(context, tuple):
+        return ':'.join(str(part) for part in context)
+    return str(context)
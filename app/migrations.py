@@ -0,0 +1,119 @@
+# migrations.py
+# 数据库迁移：每个迁移有版本号、可重复执行，只运行一次，完成后记录在 migrations 集合里
+import time
+import pymongo
+from pymongo.errors import OperationFailure
+from app.logger import logger
+from app.message_codec import FIELDS, encode_message
+
+MIGRATIONS = []
+
+
+class Migration:
+    def __init__(self, version, name, apply):
+        self.version = version
+        self.name = name
+        self.apply = apply  # apply(db, batch_size) -> 修改的文档数
+
+    def __repr__(self):
+        return f"<Migration {self.version}: {self.name}>"
+
+
+def migration(version, name):
+    """注册一个迁移，版本号必须唯一且递增"""
+    def decorator(func):
+        if any(existing.version == version for existing in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version: {version}")
+        MIGRATIONS.append(Migration(version, name, func))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return func
+    return decorator
+
+
+def _bulk_update(collection, query, projection, build_update, batch_size):
+    """分批读取满足条件的文档并用 bulk_write 更新"""
+    modified = 0
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query['_id'] = {'$gt': last_id}
+        batch = list(collection.find(batch_query, projection).sort('_id', pymongo.ASCENDING).limit(batch_size))
+        if not batch:
+            return modified
+        operations = [pymongo.UpdateOne({'_id': doc['_id']}, build_update(doc)) for doc in batch]
+        result = collection.bulk_write(operations, ordered=False)
+        modified += result.modified_count
+        last_id = batch[-1]['_id']
+
+
+@migration(1, 'backfill context_type and context_id')
+def backfill_context_fields(db, batch_size):
+    def build_update(message):
+        message_type = 'private' if 'group_id' not in message else 'group'
+        context_id = message['user_id'] if message_type == 'private' else message.get('group_id')
+        return {'$set': {'context_type': message_type, 'context_id': context_id}}
+
+    return _bulk_update(
+        db['messages'],
+        {'context_type': {'$exists': False}, 'timestamp': {'$exists': True}},  # 只处理长字段名的旧文档
+        {'user_id': 1, 'group_id': 1},
+        build_update,
+        batch_size
+    )
+
+
+@migration(2, 'drop legacy group_id field')
+def drop_group_id(db, batch_size):
+    # 旧版本（见 app/dbclear.py）按 group_id 存群号，迁移 1 之后它和 context_id 重复
+    return _bulk_update(
+        db['messages'],
+        {'group_id': {'$exists': True}, 'context_id': {'$exists': True}},
+        {'_id': 1},
+        lambda message: {'$unset': {'group_id': ''}},
+        batch_size
+    )
+
+
+@migration(3, 'compact message schema')
+def compact_messages(db, batch_size):
+    # 长字段名 -> 短字段名，较长的正文压缩；压缩阈值使用默认值，新写入的消息按 message_compress_threshold
+    def build_update(message):
+        compact = encode_message(message)
+        compact.pop('_id')
+        update = {'$unset': {name: '' for name in FIELDS if name in message}}
+        if compact:
+            update['$set'] = compact
+        return update
+
+    modified = _bulk_update(db['messages'], {'timestamp': {'$exists': True}}, None, build_update, batch_size)
+    # 旧字段上的索引已经用不到了，新索引由 MongoDB.ensure_indexes 创建
+    # 'timestamp' 是早期版本建的单字段索引，后来被 timestamp_id 取代但没有删除
+    for name in ('context_id_timestamp', 'user_id_timestamp', 'timestamp_id', 'timestamp'):
+        try:
+            db['messages'].drop_index(name)
+        except OperationFailure:
+            pass
+    return modified
+
+
+def pending_migrations(db):
+    applied = {doc['_id'] for doc in db['migrations'].find({}, {'_id': 1})}
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def run_migrations(db, batch_size=1000):
+    """按版本顺序执行所有尚未完成的迁移，返回本次执行的迁移"""
+    executed = []
+    for m in pending_migrations(db):
+        logger.info(f"Running migration {m.version}: {m.name}")
+        started = time.monotonic()
+        modified = m.apply(db, batch_size)
+        db['migrations'].replace_one(
+            {'_id': m.version},
+            {'_id': m.version, 'name': m.name, 'applied_at': time.time(), 'modified': modified},
+            upsert=True
+        )
+        logger.info(f"Migration {m.version} finished: {modified} documents modified in {time.monotonic() - started:.1f}s")
+        executed.append(m)
+    return executed
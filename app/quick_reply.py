@@ -0,0 +1,80 @@
+# quick_reply.py
+# OneBot v11 快速操作：把回复直接放进事件上报请求的 HTTP 响应里，省掉一次 send_*_msg 调用
+import asyncio
+import contextvars
+import json
+from app.logger import logger
+
+_current_quick_reply = contextvars.ContextVar('quick_reply', default=None)
+
+# 事件字典中保存快速回复句柄的键，下划线开头表示仅在进程内部使用
+QUICK_REPLY_KEY = '_quick_reply'
+
+
+class QuickReply:
+    def __init__(self, msg_type, number):
+        self.msg_type = msg_type
+        self.number = number
+        self._future = asyncio.get_running_loop().create_future()
+
+    def __repr__(self):
+        return f"<QuickReply {self.msg_type}:{self.number} done={self._future.done()}>"
+
+    def try_send(self, msg_type, number, msg):
+        """还在等待时接管这条回复，返回 False 表示需要走正常发送流程"""
+        if self._future.done() or msg_type != self.msg_type or number != self.number:
+            return False
+        self._future.set_result(msg)
+        return True
+
+    def cancel(self):
+        if not self._future.done():
+            self._future.cancel()
+
+    async def wait(self, timeout):
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            return None
+        finally:
+            # 超时之后的回复都走正常发送流程
+            self.cancel()
+
+    def response_body(self, msg):
+        return json.dumps({'reply': msg, 'auto_escape': False, 'at_sender': False}, ensure_ascii=False).encode('utf-8')
+
+
+def create_quick_reply(rev_json):
+    """为一条消息事件创建快速回复句柄并挂在事件上"""
+    if rev_json.get('post_type') != 'message':
+        return None
+    msg_type = rev_json.get('message_type')
+    if msg_type == 'private':
+        number = rev_json.get('sender', {}).get('user_id')
+    elif msg_type == 'group':
+        number = rev_json.get('group_id')
+    else:
+        return None
+    quick_reply = QuickReply(msg_type, number)
+    rev_json[QUICK_REPLY_KEY] = quick_reply
+    return quick_reply
+
+
+def bind_quick_reply(rev):
+    """在处理事件的任务里绑定它的快速回复句柄"""
+    return _current_quick_reply.set(rev.get(QUICK_REPLY_KEY))
+
+
+def release_quick_reply(token):
+    quick_reply = _current_quick_reply.get()
+    if quick_reply is not None:
+        quick_reply.cancel()
+    _current_quick_reply.reset(token)
+
+
+def try_quick_reply(msg_type, number, msg):
+    quick_reply = _current_quick_reply.get()
+    if quick_reply is not None and quick_reply.try_send(msg_type, number, msg):
+        logger.info(f"\nquick_reply_{msg_type}_msg: {msg}\n")
+        return True
+    return False
@@ -0,0 +1,131 @@
+# retention.py
+# 消息保留策略：按 (timestamp, _id) 分批清理过期消息（启用归档时先写入冷存储），批次之间暂停，进度写入数据库以便重启后继续
+import time
+from app.logger import logger
+from app.config import Config
+
+config = Config.get_instance()
+
+STATE_NAME = 'retention'
+DAY_SECONDS = 86400
+
+
+class RetentionPolicy:
+    """决定每条消息保留多少天，返回 None 表示永久保留"""
+
+    def __init__(self, default_days=1, context_days=None, user_days=None, exempt_user_ids=None, exempt_context_ids=None):
+        self.default_days = default_days
+        # 键形如 "group:123456" 或 "private:987654"
+        self.context_days = {str(key): days for key, days in (context_days or {}).items()}
+        self.user_days = {str(key): days for key, days in (user_days or {}).items()}
+        self.exempt_user_ids = list(exempt_user_ids or [])
+        self.exempt_context_ids = list(exempt_context_ids or [])
+
+    @classmethod
+    def from_config(cls):
+        settings = config.RETENTION
+        exempt_user_ids = list(settings.get('exempt_users', []))
+        if config.ADMIN_ID is not None and config.ADMIN_ID not in exempt_user_ids:
+            exempt_user_ids.append(config.ADMIN_ID)  # 管理员的消息始终保留
+        return cls(
+            default_days=settings.get('default_days', 1),
+            context_days=settings.get('contexts'),
+            user_days=settings.get('users'),
+            exempt_user_ids=exempt_user_ids,
+            exempt_context_ids=settings.get('exempt_contexts', [])
+        )
+
+    @property
+    def shortest_days(self):
+        return min([self.default_days, *self.context_days.values(), *self.user_days.values()])
+
+    def days_for(self, message):
+        if message.get('user_id') in self.exempt_user_ids or message.get('context_id') in self.exempt_context_ids:
+            return None
+        matched = [
+            days for days in (
+                self.context_days.get(f"{message.get('context_type')}:{message.get('context_id')}"),
+                self.user_days.get(str(message.get('user_id'))),
+            ) if days is not None
+        ]
+        # 同时命中会话和用户策略时取较长的保留期
+        return max(matched) if matched else self.default_days
+
+
+class RetentionEngine:
+    def __init__(self, database, policy=None, batch_size=500, batch_pause=0.2):
+        self.database = database
+        self.policy = policy or RetentionPolicy.from_config()
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+
+    @classmethod
+    def from_config(cls, database):
+        settings = config.RETENTION
+        return cls(
+            database,
+            batch_size=settings.get('batch_size', 500),
+            batch_pause=settings.get('batch_pause', 0.2)
+        )
+
+    def has_unfinished_run(self):
+        state = self.database.load_state(STATE_NAME)
+        return bool(state) and state.get('status') == 'running'
+
+    def run(self, should_stop=None):
+        """执行（或继续上次中断的）一轮清理，返回删除的文档数"""
+        state = self.database.load_state(STATE_NAME) or {}
+        if state.get('status') == 'running':
+            logger.info(f"Resuming retention run started at {time.ctime(state['started_at'])}, {state.get('deleted', 0)} documents already removed")
+        else:
+            state = {'status': 'running', 'started_at': time.time(), 'after': None, 'deleted': 0, 'scanned': 0}
+            self.database.save_state(STATE_NAME, state)
+
+        # 用本轮开始的时间计算过期线，中断后继续时结果保持一致
+        started_at = state['started_at']
+        candidate_cutoff = started_at - self.policy.shortest_days * DAY_SECONDS
+        after = tuple(state['after']) if state.get('after') else None
+        run_start = time.monotonic()
+        run_deleted = 0
+        run_scanned = 0
+
+        while not (should_stop and should_stop()):
+            batch = self.database.find_expiring_messages(
+                candidate_cutoff,
+                after=after,
+                limit=self.batch_size,
+                exempt_user_ids=self.policy.exempt_user_ids,
+                exempt_context_ids=self.policy.exempt_context_ids
+            )
+            if not batch:
+                state['status'] = 'finished'
+                break
+
+            expired = []
+            for message in batch:
+                days = self.policy.days_for(message)
+                if days is not None and message.get('timestamp', 0) < started_at - days * DAY_SECONDS:
+                    expired.append(message)
+            deleted = self.database.expire_messages(expired)
+
+            run_deleted += deleted
+            run_scanned += len(batch)
+            after = (batch[-1].get('timestamp', 0), batch[-1]['_id'])
+            state.update(after=list(after), deleted=state.get('deleted', 0) + deleted, scanned=state.get('scanned', 0) + len(batch))
+            self.database.save_state(STATE_NAME, state)
+
+            if len(batch) < self.batch_size:
+                state['status'] = 'finished'
+                break
+            time.sleep(self.batch_pause)
+
+        elapsed = time.monotonic() - run_start
+        rate = run_deleted / elapsed if elapsed > 0 else 0.0
+        state['finished_at'] = time.time() if state['status'] == 'finished' else None
+        state['docs_per_second'] = round(rate, 1)
+        self.database.save_state(STATE_NAME, state)
+        logger.info(
+            f"Retention {state['status']}: removed {run_deleted} documents in {elapsed:.1f}s "
+            f"({rate:.1f} docs/s), {run_scanned} scanned"
+        )
+        return run_deleted
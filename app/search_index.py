@@ -0,0 +1,225 @@
+# search_index.py
+# 聊天记录全文检索：每个会话一个内存倒排索引，中文按单字和二元组（bigram）切分、英文数字按单词切分，BM25 排序
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
+CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+WORD_RUN = re.compile(r'[0-9a-z]+')
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """建索引用：中文连续片段切成单字和相邻两字的二元组，英文数字转小写后按单词切分"""
+    if not text:
+        return []
+    text = text.lower()
+    tokens = WORD_RUN.findall(text)
+    for run in CJK_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def query_terms(query):
+    """搜索用：中文片段只取二元组（单个汉字按单字查），比逐字匹配准确得多"""
+    if not query:
+        return []
+    query = query.lower()
+    terms = WORD_RUN.findall(query)
+    for run in CJK_RUN.findall(query):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return list(dict.fromkeys(terms))
+
+
+class _Postings:
+    """一个词的倒排表：文档序号升序排列，与词频一一对应"""
+    __slots__ = ('ordinals', 'frequencies')
+
+    def __init__(self):
+        self.ordinals = array('I')
+        self.frequencies = array('H')
+
+    def frequency(self, ordinal):
+        index = bisect_left(self.ordinals, ordinal)
+        if index < len(self.ordinals) and self.ordinals[index] == ordinal:
+            return self.frequencies[index]
+        return 0
+
+
+class _ContextIndex:
+    def __init__(self):
+        self.postings = {}  # 词 -> _Postings
+        self.ids = []  # 序号 -> 消息 _id，序号按时间递增
+        self.lengths = array('H')  # 序号 -> 词数
+        self.ordinals = {}  # 消息 _id -> 序号
+        self.deleted = set()
+        self.total_length = 0
+        self.size = 0
+
+    def add(self, doc):
+        if doc['_id'] in self.ordinals:
+            return 0
+        ordinal = len(self.ids)
+        counts = Counter(tokenize(doc.get('user_input')) + tokenize(doc.get('response_text')))
+        for term, count in counts.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = _Postings()
+            postings.ordinals.append(ordinal)
+            postings.frequencies.append(min(count, 0xFFFF))
+        length = min(sum(counts.values()), 0xFFFF)
+        self.ids.append(doc['_id'])
+        self.lengths.append(length)
+        self.ordinals[doc['_id']] = ordinal
+        self.total_length += length
+        # 每个倒排项 6 字节，再加上每条消息的 _id、序号映射等固定开销
+        added = 6 * len(counts) + 160
+        self.size += added
+        return added
+
+    def discard(self, doc_id):
+        ordinal = self.ordinals.pop(doc_id, None)
+        if ordinal is None:
+            return False
+        self.deleted.add(ordinal)
+        return True
+
+    def search(self, terms, max_candidates):
+        """返回 ([(分数, 序号)], 命中总数)；所有词都出现的消息才算命中
+
+        从最新的消息开始最多给 max_candidates 条命中打分，之后的命中只计数。
+        """
+        postings = [self.postings.get(term) for term in terms]
+        if not postings or any(p is None for p in postings):
+            return [], 0
+        postings.sort(key=lambda p: len(p.ordinals))
+        rarest, others = postings[0], postings[1:]
+
+        live = len(self.ordinals) or 1
+        average_length = self.total_length / max(len(self.ids), 1) or 1
+        idf = [math.log(1 + (live - len(p.ordinals) + 0.5) / (len(p.ordinals) + 0.5)) for p in postings]
+
+        scored = []
+        total = 0
+        for position in range(len(rarest.ordinals) - 1, -1, -1):
+            ordinal = rarest.ordinals[position]
+            if ordinal in self.deleted:
+                continue
+            frequencies = [rarest.frequencies[position]]
+            for other in others:
+                frequency = other.frequency(ordinal)
+                if not frequency:
+                    break
+                frequencies.append(frequency)
+            else:
+                total += 1
+                if len(scored) >= max_candidates:
+                    continue
+                norm = K1 * (1 - B + B * self.lengths[ordinal] / average_length)
+                score = sum(weight * tf * (K1 + 1) / (tf + norm) for weight, tf in zip(idf, frequencies))
+                scored.append((score, ordinal))
+        return scored, total
+
+
+class SearchIndex:
+    """按会话维护倒排索引，整体按 LRU 淘汰并受总内存上限约束
+
+    索引在第一次搜索某个会话时从数据库构建，之后随新消息增量更新。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_candidates=10000):
+        self.max_bytes = max_bytes
+        self.max_candidates = max_candidates
+        self._contexts = OrderedDict()
+        self._loading = {}  # 会话键 -> (构建期间写入的新消息, 构建期间删除的 _id)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def is_indexed(self, key):
+        with self._lock:
+            return key in self._contexts
+
+    def begin_load(self, key):
+        with self._lock:
+            self._loading.setdefault(key, ([], set()))
+
+    def finish_load(self, key, docs):
+        """用数据库里的全部消息（按时间正序）构建索引，构建期间写入的消息随后补上"""
+        index = _ContextIndex()
+        for doc in docs:
+            index.add(doc)
+        with self._lock:
+            added, discarded = self._loading.pop(key, ([], set()))
+            for doc in added:
+                index.add(doc)
+            for doc_id in discarded:
+                index.discard(doc_id)
+            self._remove(key)
+            self._contexts[key] = index
+            self._size += index.size
+            self._evict()
+
+    def abort_load(self, key):
+        with self._lock:
+            self._loading.pop(key, None)
+
+    def add(self, key, doc):
+        """新消息写入时调用；没有索引的会话等第一次搜索时再构建"""
+        with self._lock:
+            if key in self._loading:
+                self._loading[key][0].append(doc)
+            index = self._contexts.get(key)
+            if index is not None:
+                self._size += index.add(doc)
+                self._evict()
+
+    def discard(self, doc_ids):
+        """消息被删除时从索引中移除（标记删除，不再出现在结果里）"""
+        with self._lock:
+            for doc_id in doc_ids:
+                for _, discarded in self._loading.values():
+                    discarded.add(doc_id)
+                for index in self._contexts.values():
+                    if index.discard(doc_id):
+                        break
+
+    def search(self, key, query):
+        """返回按相关度（相同时按时间倒序）排好的 ([(分数, _id)], 命中总数)，会话未建索引时返回 None"""
+        terms = query_terms(query)
+        with self._lock:
+            index = self._contexts.get(key)
+            if index is None:
+                return None
+            self._contexts.move_to_end(key)
+            if not terms:
+                return [], 0
+            scored, total = index.search(terms, self.max_candidates)
+            scored.sort(key=lambda item: (-item[0], -item[1]))
+            return [(score, index.ids[ordinal]) for score, ordinal in scored], total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'contexts': len(self._contexts),
+                'messages': sum(len(index.ordinals) for index in self._contexts.values()),
+                'bytes': self._size,
+            }
+
+    def _remove(self, key):
+        index = self._contexts.pop(key, None)
+        if index is not None:
+            self._size -= index.size
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._contexts) > 1:
+            self._remove(next(iter(self._contexts)))
@@ -0,0 +1,303 @@
+# sharding.py
+# 多进程分片模式：入口进程只负责接收事件和排队，按会话哈希把消息转发给 N 个工作进程处理
+# 同一会话总是落在同一个工作进程上，进程内再由 ContextDispatcher 保证按顺序处理
+import asyncio
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import threading
+import zlib
+from app.logger import logger
+from app.config import Config
+from app.driver import call_api
+from drivers.shard_driver import WORKER_ENV
+
+config = Config.get_instance()
+
+STOP_GRACE = 10  # 工作进程排空之外，留给它写入数据库缓冲并退出的时间（秒）
+
+
+def _context_name(context):
+    return f"{context[0]}:{context[1]}"
+
+
+def _strip_local(event):
+    """去掉只在进程内有意义的字段（如快速回复句柄），其余都是可序列化的 JSON 数据"""
+    return {key: value for key, value in event.items() if not key.startswith('_')}
+
+
+class Channel:
+    """管道的一端：阻塞的收发放在后台线程里，帧是 pickle 编码的元组"""
+
+    def __init__(self, conn, loop, on_frame):
+        self.conn = conn
+        self.loop = loop
+        self.on_frame = on_frame
+        self._outbox = queue.SimpleQueue()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+
+    def start(self):
+        self._reader.start()
+        self._writer.start()
+
+    def send(self, *frame):
+        self._outbox.put(frame)
+
+    def close(self, timeout=5):
+        """发完已排队的帧后关闭写端"""
+        self._outbox.put(None)
+        self._writer.join(timeout)
+
+    def _write(self):
+        while True:
+            frame = self._outbox.get()
+            if frame is None:
+                break
+            try:
+                self.conn.send_bytes(pickle.dumps(frame, pickle.HIGHEST_PROTOCOL))
+            except (OSError, EOFError, ValueError) as e:
+                logger.error(f"Shard channel write failed: {e}")
+                break
+
+    def _read(self):
+        while True:
+            try:
+                frame = pickle.loads(self.conn.recv_bytes())
+            except (OSError, EOFError):
+                frame = ('closed',)
+            try:
+                self.loop.call_soon_threadsafe(self.on_frame, frame)
+            except RuntimeError:
+                break  # 事件循环已经关闭
+            if frame[0] == 'closed':
+                break
+
+
+class _Shard:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.channel = None
+        self.stopped = None
+        self.forwarded = 0
+
+
+class ShardRouter:
+    """入口进程一侧：启动工作进程，按会话转发事件，并代为执行工作进程的 API 调用
+
+    同时转发给工作进程、还没处理完的消息最多 max_pending 条，调用方先 await wait_for_capacity() 再取下一条。
+    on_done(event, acknowledge) 在工作进程处理完一条消息时调用，用来释放消息队列的并发名额；
+    工作进程崩溃或排空超时丢下的消息 acknowledge 为 False，它们留在入口日志里，下次启动时重放。
+    """
+
+    def __init__(self, num_shards, key_of, on_done=None, max_pending=0):
+        self.num_shards = num_shards
+        self.key_of = key_of
+        self.on_done = on_done
+        self.max_pending = max_pending
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        self._shards = [_Shard(index) for index in range(num_shards)]
+        self._pending = {}  # 序号 -> (分片序号, 事件)
+        self._seq = itertools.count()
+        self._stopping = False
+        self._mp = multiprocessing.get_context('spawn')
+
+    def __repr__(self):
+        return f"<ShardRouter {self.stats()}>"
+
+    def start(self):
+        for shard in self._shards:
+            self._spawn(shard)
+        logger.info(f"Started {self.num_shards} shard worker processes")
+
+    def shard_of(self, context):
+        # 不用 hash()：字符串哈希在每个进程里都不一样
+        return self._shards[zlib.crc32(_context_name(context).encode('utf-8')) % self.num_shards]
+
+    def has_capacity(self):
+        return not self.max_pending or len(self._pending) < self.max_pending
+
+    async def wait_for_capacity(self):
+        while not self.has_capacity():
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    async def dispatch(self, event):
+        shard = self.shard_of(self.key_of(event))
+        seq = next(self._seq)
+        self._pending[seq] = (shard.index, event)
+        shard.forwarded += 1
+        shard.channel.send('event', seq, _strip_local(event))
+
+    def stats(self):
+        inflight = [0] * self.num_shards
+        for index, _ in self._pending.values():
+            inflight[index] += 1
+        return {
+            f"shard-{shard.index}": {
+                'alive': shard.process is not None and shard.process.is_alive(),
+                'forwarded': shard.forwarded,
+                'inflight': inflight[shard.index],
+            }
+            for shard in self._shards
+        }
+
+    async def stop(self, timeout):
+        """通知所有工作进程排空并退出，返回 True 表示全部正常结束"""
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        for shard in self._shards:
+            shard.stopped = loop.create_future()
+            shard.channel.send('stop', timeout)
+        done, _ = await asyncio.wait([shard.stopped for shard in self._shards], timeout=timeout + STOP_GRACE)
+        clean = len(done) == self.num_shards and all(future.result() for future in done)
+        for shard in self._shards:
+            await loop.run_in_executor(None, shard.process.join, 5)
+            if shard.process.is_alive():
+                logger.warning(f"Shard {shard.index} did not exit, terminating")
+                shard.process.terminate()
+                clean = False
+            shard.channel.close()
+        self._release(lambda index: True)
+        return clean
+
+    def _spawn(self, shard):
+        parent_conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(target=run_worker, args=(shard.index, child_conn), name=f"shard-{shard.index}", daemon=True)
+        # 子进程启动时复制环境变量，app.driver 看到它就会使用转发 API 的驱动
+        os.environ[WORKER_ENV] = str(shard.index)
+        try:
+            process.start()
+        finally:
+            del os.environ[WORKER_ENV]
+        child_conn.close()
+        shard.process = process
+        shard.channel = Channel(parent_conn, asyncio.get_running_loop(), lambda frame: self._on_frame(shard, frame))
+        shard.channel.start()
+
+    def _on_frame(self, shard, frame):
+        kind = frame[0]
+        if kind == 'done':
+            entry = self._pending.pop(frame[1], None)
+            if entry is not None and self.on_done is not None:
+                self.on_done(entry[1], True)
+            if self.has_capacity():
+                self._capacity.set()
+        elif kind == 'api':
+            _, request_id, action, params = frame
+            asyncio.create_task(self._call_api(shard, request_id, action, params))
+        elif kind == 'stopped':
+            if shard.stopped is not None and not shard.stopped.done():
+                shard.stopped.set_result(frame[1])
+        elif kind == 'closed':
+            if shard.stopped is not None and not shard.stopped.done():
+                shard.stopped.set_result(False)
+            if self._stopping:
+                return
+            lost = self._release(lambda index: index == shard.index)
+            shard.channel.close(timeout=0)
+            logger.error(f"Shard {shard.index} exited unexpectedly, {lost} messages left for journal replay, restarting")
+            self._spawn(shard)
+
+    async def _call_api(self, shard, request_id, action, params):
+        try:
+            result = await call_api(action, **params)
+            shard.channel.send('api_result', request_id, result, None)
+        except Exception as e:
+            shard.channel.send('api_result', request_id, None, f"{type(e).__name__}: {e}")
+
+    def _release(self, matches):
+        """放弃还没处理完的消息：释放它们占用的并发名额，但不确认"""
+        lost = [seq for seq, (index, _) in self._pending.items() if matches(index)]
+        for seq in lost:
+            _, event = self._pending.pop(seq)
+            if self.on_done is not None:
+                self.on_done(event, False)
+        if self.has_capacity():
+            self._capacity.set()
+        return len(lost)
+
+
+def run_worker(index, conn):
+    """工作进程入口"""
+    # 终端的 Ctrl+C 会发给整个进程组，工作进程忽略它，由入口进程决定何时排空退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_main(index, conn))
+
+
+async def _worker_main(index, conn):
+    # 在函数内导入：utils.receive 会导入本模块，而这些模块又间接导入了 utils.receive
+    from app.database import close_database
+    from app.dispatcher import ContextDispatcher
+    from app.driver import driver_instance
+    from app.message import process_group_message, process_private_message
+    from app.summarizer import summarizer
+    from app.task_manger import task_manager
+    from utils.model_request import warm_up_client, close_client
+    from utils.receive import context_of
+
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def on_frame(frame):
+        # API 结果直接交给驱动，排空期间也要能收到
+        if frame[0] == 'api_result':
+            driver_instance.resolve(*frame[1:])
+        else:
+            inbox.put_nowait(frame)
+
+    channel = Channel(conn, loop, on_frame)
+    driver_instance.attach(channel)
+
+    async def handle(item):
+        _, seq, event = item
+        cancelled = False
+        try:
+            if event.get('message_type') == 'private':
+                await process_private_message(event)
+            elif event.get('message_type') == 'group':
+                await process_group_message(event)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # 排空超时被取消的消息不回报完成，入口进程停止时放弃它而不确认
+            if not cancelled:
+                channel.send('done', seq)
+
+    dispatcher = ContextDispatcher(task_manager, handle, key_of=lambda item: item[0], max_active=task_manager.num_workers)
+    channel.start()
+    await task_manager.start()
+    if summarizer is not None:
+        summarizer.start()
+    if config.MODEL_HTTP_WARMUP:
+        asyncio.create_task(warm_up_client())
+    logger.info(f"Shard {index} started (pid {os.getpid()})")
+
+    timeout = 0
+    while True:
+        frame = await inbox.get()
+        kind = frame[0]
+        if kind == 'event':
+            _, seq, event = frame
+            await dispatcher.dispatch((context_of(event), seq, event))
+        elif kind == 'stop':
+            timeout = frame[1]
+            break
+        elif kind == 'closed':
+            logger.error(f"Shard {index} lost its channel to the ingress process")
+            break
+
+    drained = await task_manager.stop(timeout=timeout)
+    if summarizer is not None:
+        await summarizer.stop()
+    await close_client()
+    close_database()  # 写入缓冲中的聊天记录
+    channel.send('stopped', drained)
+    channel.close()
+    logger.info(f"Shard {index} stopped")
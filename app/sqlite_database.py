@@ -0,0 +1,346 @@
+# sqlite_database.py
+# SQLite 存储后端：WAL 模式，每个线程一个连接，SQL 语句固定只换参数（sqlite3 会缓存编译好的语句）
+import json
+import os
+import sqlite3
+import threading
+import time
+from bson import ObjectId
+from app.logger import logger
+from app.config import Config
+from app.context_cache import ConversationCache
+from app.archive import MessageArchive
+from app.search_index import SearchIndex
+from app.storage import Storage, MessageWriteBuffer, UserRegistry
+
+config = Config.get_instance()
+
+# 表结构按版本递增，当前版本记录在 PRAGMA user_version 里
+SCHEMA_MIGRATIONS = [
+    (1, 'create tables', [
+        '''CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            user_input TEXT,
+            response_text TEXT,
+            context_type TEXT,
+            context_id INTEGER,
+            timestamp REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            info TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS contexts (
+            context_type TEXT NOT NULL,
+            context_id INTEGER NOT NULL,
+            messages TEXT NOT NULL,
+            oldest_timestamp REAL,
+            PRIMARY KEY (context_type, context_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS maintenance (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL
+        )''',
+    ]),
+    (2, 'cache token counts', [
+        'ALTER TABLE messages ADD COLUMN tokens INTEGER',
+    ]),
+    (3, 'conversation summaries', [
+        '''CREATE TABLE IF NOT EXISTS summaries (
+            name TEXT PRIMARY KEY,
+            summary TEXT NOT NULL
+        )''',
+    ]),
+]
+
+# 与 MongoDB 的 MESSAGE_INDEXES 一一对应
+MESSAGE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS context_id_timestamp ON messages (context_type, context_id, timestamp DESC)',
+    'CREATE INDEX IF NOT EXISTS user_id_timestamp ON messages (context_type, user_id, timestamp DESC)',
+    'CREATE INDEX IF NOT EXISTS timestamp_id ON messages (timestamp, id)',
+]
+
+INSERT_MESSAGE_SQL = '''INSERT OR IGNORE INTO messages
+    (id, user_id, user_input, response_text, context_type, context_id, timestamp, tokens)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+
+UPSERT_USER_SQL = '''INSERT INTO users (user_id, username, info) VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, info = excluded.info'''
+
+RECENT_GROUP_MESSAGES_SQL = '''SELECT id, user_input, response_text, timestamp, tokens FROM messages
+    WHERE context_type = ? AND context_id = ? ORDER BY timestamp DESC LIMIT ?'''
+
+RECENT_PRIVATE_MESSAGES_SQL = '''SELECT id, user_input, response_text, timestamp, tokens FROM messages
+    WHERE context_type = ? AND user_id = ? ORDER BY timestamp DESC LIMIT ?'''
+
+CONTEXT_GROUP_MESSAGES_SQL = '''SELECT id, user_input, response_text, timestamp, tokens FROM messages
+    WHERE context_type = ? AND context_id = ? ORDER BY timestamp'''
+
+CONTEXT_PRIVATE_MESSAGES_SQL = '''SELECT id, user_input, response_text, timestamp, tokens FROM messages
+    WHERE context_type = ? AND user_id = ? ORDER BY timestamp'''
+
+
+def _message_row(row):
+    return {'_id': ObjectId(row[0]), 'user_input': row[1], 'response_text': row[2], 'timestamp': row[3], 'tokens': row[4]}
+
+
+class SQLiteDatabase(Storage):
+    def __init__(self, path=None):
+        self.path = path or config.SQLITE_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._apply_schema()
+        self.ensure_indexes()
+        super().__init__(
+            MessageWriteBuffer(self.write_messages, flush_size=config.DB_FLUSH_SIZE, flush_interval=config.DB_FLUSH_INTERVAL),
+            UserRegistry(self.write_users, flush_interval=config.USER_FLUSH_INTERVAL),
+            ConversationCache(turns_per_context=config.CONTEXT_CACHE_TURNS, max_bytes=config.CONTEXT_CACHE_MAX_BYTES),
+            SearchIndex(max_bytes=config.SEARCH_INDEX_MAX_BYTES),
+            MessageArchive(config.ARCHIVE_PATH) if config.ARCHIVE_ENABLED else None
+        )
+
+    @property
+    def connection(self):
+        """当前线程的连接，第一次使用时创建"""
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')  # WAL 模式下只在检查点时 fsync
+            self._local.connection = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        super().close()
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Error closing SQLite connection: {e}")
+
+    def _apply_schema(self):
+        """执行尚未应用的表结构版本，返回本次执行的版本名"""
+        conn = self.connection
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        executed = []
+        for version, name, statements in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Applying SQLite schema {version}: {name}")
+            with conn:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+            executed.append(name)
+        return executed
+
+    def ensure_indexes(self):
+        try:
+            with self.connection as conn:
+                for statement in MESSAGE_INDEXES:
+                    conn.execute(statement)
+        except Exception as e:
+            logger.error(f"Error ensuring indexes: {e}")
+
+    def run_migrations(self):
+        try:
+            return self._apply_schema()
+        except Exception as e:
+            logger.error(f"Error running migrations: {e}")
+            return []
+
+    def check_query_plans(self):
+        """对热点查询执行 EXPLAIN QUERY PLAN，全表扫描或需要临时排序时给出警告"""
+        expiring_sql, expiring_params = self._expiring_messages_query(time.time() - 86400, None, 500, [config.ADMIN_ID], [])
+        hot_queries = {
+            'recent_group_messages': (RECENT_GROUP_MESSAGES_SQL, ('group', 0, 10)),
+            'recent_private_messages': (RECENT_PRIVATE_MESSAGES_SQL, ('private', 0, 10)),
+            'expiring_messages': (expiring_sql, expiring_params),
+        }
+        problems = {}
+        for name, (sql, params) in hot_queries.items():
+            try:
+                details = [row[3] for row in self.connection.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+            except Exception as e:
+                logger.error(f"Error explaining query {name}: {e}")
+                continue
+            issues = []
+            if any(detail.startswith('SCAN') and 'INDEX' not in detail for detail in details):
+                issues.append('table scan')
+            if any('TEMP B-TREE' in detail for detail in details):
+                issues.append('temporary sort')
+            if issues:
+                problems[name] = issues
+                logger.warning(f"Query {name} is not served by an index ({', '.join(issues)}), plan: {details}")
+            else:
+                logger.debug(f"Query {name} uses index, plan: {details}")
+        return problems
+
+    def write_messages(self, documents):
+        rows = [
+            (str(doc['_id']), doc.get('user_id'), doc.get('user_input'), doc.get('response_text'),
+             doc.get('context_type'), doc.get('context_id'), doc.get('timestamp', 0), doc.get('tokens'))
+            for doc in documents
+        ]
+        with self.connection as conn:
+            cursor = conn.executemany(INSERT_MESSAGE_SQL, rows)
+        return cursor.rowcount
+
+    def write_users(self, users):
+        rows = [
+            (user_id, user_info.get('username'), json.dumps(user_info, ensure_ascii=False))
+            for user_id, user_info in users.items()
+        ]
+        with self.connection as conn:
+            conn.executemany(UPSERT_USER_SQL, rows)
+
+    def deduplicate_users(self):
+        # users 表以 user_id 为主键，不会产生重复记录
+        logger.info("Deduplicated 0 user records")
+
+    def get_context(self, context_type, context_id):
+        try:
+            row = self.connection.execute(
+                'SELECT messages FROM contexts WHERE context_type = ? AND context_id = ?',
+                (context_type, context_id)
+            ).fetchone()
+            return json.loads(row[0]) if row else []
+        except Exception as e:
+            logger.error(f"Error getting context: {e}")
+            return []
+
+    def update_context(self, context_type, context_id, new_message):
+        try:
+            with self.connection as conn:
+                row = conn.execute(
+                    'SELECT messages FROM contexts WHERE context_type = ? AND context_id = ?',
+                    (context_type, context_id)
+                ).fetchone()
+                messages = json.loads(row[0]) if row else []
+                messages.append(new_message)
+                timestamps = [msg['timestamp'] for msg in messages if isinstance(msg, dict) and 'timestamp' in msg]
+                conn.execute(
+                    'INSERT OR REPLACE INTO contexts (context_type, context_id, messages, oldest_timestamp) VALUES (?, ?, ?, ?)',
+                    (context_type, context_id, json.dumps(messages, ensure_ascii=False), min(timestamps) if timestamps else None)
+                )
+        except Exception as e:
+            logger.error(f"Error updating context: {e}")
+
+    def fetch_recent_messages(self, user_id, context_type, context_id, limit):
+        if context_type == 'private':
+            rows = self.connection.execute(RECENT_PRIVATE_MESSAGES_SQL, (context_type, user_id, limit))
+        else:
+            rows = self.connection.execute(RECENT_GROUP_MESSAGES_SQL, (context_type, context_id, limit))
+        return [
+            _message_row(row) for row in rows
+        ]
+
+    def iter_context_messages(self, user_id, context_type, context_id):
+        # 单独的连接：逐批读取期间不占用当前线程的连接
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if context_type == 'private':
+                cursor = conn.execute(CONTEXT_PRIVATE_MESSAGES_SQL, (context_type, user_id))
+            else:
+                cursor = conn.execute(CONTEXT_GROUP_MESSAGES_SQL, (context_type, context_id))
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    return
+                for row in rows:
+                    yield _message_row(row)
+        finally:
+            conn.close()
+
+    def fetch_messages_by_ids(self, message_ids):
+        if not message_ids:
+            return []
+        rows = self.connection.execute(
+            f"SELECT id, user_input, response_text, timestamp, tokens FROM messages WHERE id IN ({', '.join('?' * len(message_ids))})",
+            [str(message_id) for message_id in message_ids]
+        )
+        return [
+            _message_row(row) for row in rows
+        ]
+
+    def clean_empty_responses(self):
+        try:
+            with self.connection as conn:
+                cursor = conn.execute("DELETE FROM messages WHERE response_text IS NULL OR response_text = ''")
+            logger.info(f"Deleted {cursor.rowcount} documents containing empty responses")
+        except Exception as e:
+            logger.error(f"Error cleaning empty responses: {e}")
+
+    def _expiring_messages_query(self, cutoff, after, limit, exempt_user_ids, exempt_context_ids):
+        conditions = ['timestamp < ?']
+        params = [cutoff]
+        if exempt_user_ids:
+            conditions.append(f"user_id NOT IN ({', '.join('?' * len(exempt_user_ids))})")
+            params.extend(exempt_user_ids)
+        if exempt_context_ids:
+            conditions.append(f"context_id NOT IN ({', '.join('?' * len(exempt_context_ids))})")
+            params.extend(exempt_context_ids)
+        if after is not None:
+            # 按 (timestamp, id) 做键集分页，从上一批的最后一条之后继续
+            last_timestamp, last_id = after
+            conditions.append('(timestamp > ? OR (timestamp = ? AND id > ?))')
+            params.extend([last_timestamp, last_timestamp, str(last_id)])
+        sql = (
+            'SELECT id, user_id, context_type, context_id, timestamp FROM messages WHERE '
+            + ' AND '.join(conditions) + ' ORDER BY timestamp, id LIMIT ?'
+        )
+        params.append(limit)
+        return sql, tuple(params)
+
+    def find_expiring_messages(self, cutoff, after=None, limit=500, exempt_user_ids=(), exempt_context_ids=()):
+        sql, params = self._expiring_messages_query(cutoff, after, limit, list(exempt_user_ids), list(exempt_context_ids))
+        return [
+            {'_id': ObjectId(row[0]), 'user_id': row[1], 'context_type': row[2], 'context_id': row[3], 'timestamp': row[4]}
+            for row in self.connection.execute(sql, params)
+        ]
+
+    def _delete_stored_messages(self, message_ids):
+        with self.connection as conn:
+            cursor = conn.executemany('DELETE FROM messages WHERE id = ?', [(str(message_id),) for message_id in message_ids])
+        return cursor.rowcount
+
+    def load_state(self, name):
+        row = self.connection.execute('SELECT state FROM maintenance WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_state(self, name, state):
+        with self.connection as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO maintenance (name, state) VALUES (?, ?)',
+                (name, json.dumps(state, default=str))
+            )
+
+    def load_summary(self, name):
+        row = self.connection.execute('SELECT summary FROM summaries WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_summary(self, name, summary):
+        with self.connection as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO summaries (name, summary) VALUES (?, ?)',
+                (name, json.dumps(summary, ensure_ascii=False))
+            )
+
+    def clean_old_contexts(self, days=1):
+        try:
+            expiry_time = time.time() - days * 86400  # 86400 seconds in a day
+            with self.connection as conn:
+                cursor = conn.execute('DELETE FROM contexts WHERE oldest_timestamp < ?', (expiry_time,))
+            logger.info(f"Deleted {cursor.rowcount} old contexts")
+        except Exception as e:
+            logger.error(f"Error cleaning old contexts: {e}")
@@ -0,0 +1,495 @@
+# storage.py
+# 存储后端的公共部分：写缓冲、用户信息缓存、会话缓存，以及各后端都要实现的接口
+import itertools
+import time
+import threading
+from collections import OrderedDict
+from bson import ObjectId
+from app.logger import logger
+from app.context_builder import turn_tokens
+
+SUMMARY_CACHE_SIZE = 10000  # 内存中最多保留多少个会话的摘要
+
+
+class BackgroundFlusher:
+    """后台线程按时间间隔（或被提前唤醒时）调用 flush()，关闭时再做最后一次 flush"""
+
+    def __init__(self, flush_interval, name):
+        self.flush_interval = flush_interval
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(timeout=self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class MessageWriteBuffer(BackgroundFlusher):
+    """消息写缓冲：攒够数量或到达时间间隔后由 write_batch 一次写入，写库不再占用事件循环
+
+    write_batch(documents) 返回写入的条数，抛出异常时整批放回缓冲等待重试
+    """
+
+    def __init__(self, write_batch, flush_size=50, flush_interval=1.0, max_pending=5000):
+        super().__init__(flush_interval, name='message-write-buffer')
+        self.write_batch = write_batch
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self._pending = []
+        self._inflight = []  # 正在写入的批次，写完之前读操作仍然可以看到
+        self._lock = threading.Lock()
+        self.start()
+
+    def add(self, document):
+        document.setdefault('_id', ObjectId())
+        with self._lock:
+            self._pending.append(document)
+            if len(self._pending) > self.max_pending:
+                dropped = self._pending.pop(0)
+                logger.error(f"Write buffer overflow, dropped message {dropped['_id']}")
+            if len(self._pending) >= self.flush_size:
+                self._wakeup.set()
+        return document['_id']
+
+    def pending(self, match):
+        """返回满足条件、尚未落库的文档"""
+        with self._lock:
+            return [doc for doc in self._inflight + self._pending if match(doc)]
+
+    def remove(self, document_id):
+        """从缓冲中删除尚未落库的文档并返回 True
+
+        文档所在的批次正在写入时先等这一批写完，再返回 False 由调用方从数据库删除，
+        否则删除可能先于写入执行，消息又会出现；写入失败时整批放回缓冲，下一轮从缓冲中删除。
+        """
+        while True:
+            with self._lock:
+                for doc in self._pending:
+                    if doc['_id'] == document_id:
+                        self._pending.remove(doc)
+                        return True
+                writing = any(doc['_id'] == document_id for doc in self._inflight)
+            if not writing:
+                return False
+            with self._flush_lock:
+                pass
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._inflight, self._pending = self._pending, []
+            batch = self._inflight
+            try:
+                return self.write_batch(batch)
+            except Exception as e:
+                logger.error(f"Error flushing chat messages, will retry: {e}")
+                with self._lock:
+                    self._pending[:0] = batch  # 放回队首，下次重试
+                return 0
+            finally:
+                with self._lock:
+                    self._inflight = []
+
+
+class UserRegistry(BackgroundFlusher):
+    """用户信息缓存：昵称没变时不写库，变化的记录由后台线程定期交给 write_users 批量 upsert
+
+    write_users(users) 的参数为 {user_id: user_info}，抛出异常时这些记录等待下次重试
+    """
+
+    def __init__(self, write_users, flush_interval=5.0, max_users=100000):
+        super().__init__(flush_interval, name='user-registry')
+        self.write_users = write_users
+        self.max_users = max_users
+        self._known = OrderedDict()  # user_id -> 已写入数据库的用户信息
+        self._dirty = {}  # user_id -> 等待写入的用户信息
+        self._lock = threading.Lock()
+        self.start()
+
+    def update(self, user_info):
+        """记录一次用户信息，返回是否有变化需要写库"""
+        user_id = user_info['user_id']
+        with self._lock:
+            if self._dirty.get(user_id, self._known.get(user_id)) == user_info:
+                if user_id in self._known:
+                    self._known.move_to_end(user_id)
+                return False
+            self._dirty[user_id] = dict(user_info)
+            return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                batch, self._dirty = self._dirty, {}
+            try:
+                self.write_users(batch)
+            except Exception as e:
+                logger.error(f"Error flushing user info, will retry: {e}")
+                with self._lock:
+                    for user_id, user_info in batch.items():
+                        self._dirty.setdefault(user_id, user_info)
+                return 0
+            with self._lock:
+                for user_id, user_info in batch.items():
+                    self._known[user_id] = user_info
+                    self._known.move_to_end(user_id)
+                while len(self._known) > self.max_users:
+                    self._known.popitem(last=False)
+            return len(batch)
+
+
+class Storage:
+    """存储后端接口
+
+    写入、最近消息读取和删除的缓存逻辑在这里统一实现，
+    各后端（MongoDB、SQLite）只需实现下面标注“后端实现”的方法。
+    消息的 _id 统一使用 ObjectId，由写缓冲在入队时生成。
+    """
+
+    def __init__(self, write_buffer, user_registry, conversation_cache, search_index, archive=None):
+        self.write_buffer = write_buffer
+        self.user_registry = user_registry
+        self.conversation_cache = conversation_cache
+        self.search_index = search_index
+        self.archive = archive  # 为 None 时过期消息直接删除
+        self._search_build_lock = threading.Lock()
+        self._summaries = OrderedDict()  # 会话键 -> 摘要（None 表示没有）
+        self._summary_lock = threading.Lock()
+
+    # ---- 公共实现 ----
+
+    def insert_user_info(self, user_info):
+        try:
+            # 只有信息变化时才会在下次刷新时 upsert
+            self.user_registry.update(user_info)
+        except Exception as e:
+            logger.error(f"Error inserting/updating user info: {e}")
+
+    def insert_chat_message(self, user_id, user_input, response_text, context_type, context_id):
+        try:
+            if response_text:  # 仅保存有回复的消息
+                message_data = {
+                    'user_id': user_id,
+                    'user_input': user_input,
+                    'response_text': response_text,
+                    'context_type': context_type,  # "group" 或 "private"
+                    'context_id': context_id,
+                    'timestamp': time.time(),  # 添加时间戳
+                }
+                message_data['tokens'] = turn_tokens(message_data)  # 保存估计的 token 数，组装上下文时不用重新计算
+                # 先进入写缓冲，由后台线程批量写入，同时更新会话缓存
+                self.write_buffer.add(message_data)
+                key = self._context_key(user_id, context_type, context_id)
+                self.conversation_cache.append(key, cached_turn(message_data))
+                self.search_index.add(key, message_data)
+        except Exception as e:
+            logger.error(f"Error inserting chat message: {e}")
+
+    def get_recent_messages(self, user_id, context_type, context_id, limit=10):
+        return _chat_messages(self.get_recent_turns(user_id, context_type, context_id, limit))
+
+    def get_recent_turns(self, user_id, context_type, context_id, limit=10):
+        """最近 limit 轮对话（按时间正序），每轮带有 user_input、response_text 和估计的 tokens"""
+        try:
+            if context_type == 'group' and not context_id:
+                logger.warning("Context ID is required for group messages.")
+                return []
+            key = self._context_key(user_id, context_type, context_id)
+            turns = self.conversation_cache.get(key, limit)
+            if turns is None:
+                turns = self._load_recent_messages(key, user_id, context_type, context_id, limit)
+            return turns
+        except Exception as e:
+            logger.error(f"Error getting recent messages: {e}")
+            return []
+
+    def get_summary(self, user_id, context_type, context_id):
+        """会话的滚动摘要 {'text', 'until', 'turns', 'tokens', 'updated_at'}，没有时返回 None"""
+        key = self._context_key(user_id, context_type, context_id)
+        with self._summary_lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+        try:
+            summary = self.load_summary(f"{key[0]}:{key[1]}")
+        except Exception as e:
+            logger.error(f"Error loading summary: {e}")
+            return None
+        self._remember_summary(key, summary)
+        return summary
+
+    def update_summary(self, user_id, context_type, context_id, summary):
+        key = self._context_key(user_id, context_type, context_id)
+        self.save_summary(f"{key[0]}:{key[1]}", summary)
+        self._remember_summary(key, summary)
+
+    def _remember_summary(self, key, summary):
+        with self._summary_lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > SUMMARY_CACHE_SIZE:
+                self._summaries.popitem(last=False)
+
+    def get_archived_messages(self, user_id, context_type, context_id, limit=10):
+        """归档中最近的 limit 轮对话，格式与 get_recent_messages 相同"""
+        if self.archive is None:
+            return []
+        try:
+            key = self._context_key(user_id, context_type, context_id)
+            return _chat_messages(self.archive.read_recent(key, limit))
+        except Exception as e:
+            logger.error(f"Error reading archived messages: {e}")
+            return []
+
+    def delete_messages_by_ids(self, message_ids):
+        if not message_ids:
+            return 0
+        deleted = self._delete_stored_messages(list(message_ids))
+        for message_id in message_ids:
+            self.conversation_cache.discard(message_id)
+        self.search_index.discard(message_ids)
+        return deleted
+
+    def expire_messages(self, messages):
+        """删除过期消息，启用归档时先把完整内容写入归档；messages 为 find_expiring_messages 返回的文档"""
+        if not messages:
+            return 0
+        message_ids = [msg['_id'] for msg in messages]
+        if self.archive is None:
+            return self.delete_messages_by_ids(message_ids)
+
+        contents = {doc['_id']: doc for doc in self.fetch_messages_by_ids(message_ids)}
+        by_context = {}
+        for msg in messages:
+            content = contents.get(msg['_id'])
+            if content is None:
+                continue  # 已经被删除
+            doc = dict(msg, user_input=content.get('user_input'), response_text=content.get('response_text'))
+            key = self._context_key(msg.get('user_id'), msg.get('context_type'), msg.get('context_id'))
+            by_context.setdefault(key, []).append(doc)
+        for key, docs in by_context.items():
+            self.archive.append(key, docs)
+
+        # 归档后的消息仍然可以被搜索到，所以只从会话缓存里移除
+        deleted = self._delete_stored_messages(message_ids)
+        for message_id in message_ids:
+            self.conversation_cache.discard(message_id)
+        return deleted
+
+    def delete_message(self, message_id):
+        try:
+            self.conversation_cache.discard(ObjectId(message_id))
+            self.search_index.discard([ObjectId(message_id)])
+            if self.write_buffer.remove(ObjectId(message_id)):
+                logger.info(f"Deleted pending message with _id {message_id}")
+                return
+            if self._delete_stored_messages([ObjectId(message_id)]) == 1:
+                logger.info(f"Deleted message with _id {message_id}")
+        except Exception as e:
+            logger.error(f"Error deleting message: {e}")
+
+    def delete_messages(self, messages_list):
+        try:
+            for message in messages_list:
+                self.delete_message(message['_id'])
+        except Exception as e:
+            logger.error(f"Error deleting messages: {e}")
+
+    def search_messages(self, user_id, context_type, context_id, query, offset=0, limit=5):
+        """在当前会话的聊天记录中搜索，返回 (本页结果, 可翻页的结果数, 命中总数)，结果按相关度排序
+
+        命中太多时只有最新的一部分参与排序和翻页，可翻页的结果数会小于命中总数。
+        """
+        try:
+            key = self._context_key(user_id, context_type, context_id)
+            started = time.perf_counter()
+            ranked = self.search_index.search(key, query)
+            if ranked is None:
+                self._build_search_index(key, user_id, context_type, context_id)
+                ranked = self.search_index.search(key, query)
+            hits, total = ranked
+            page = hits[offset:offset + limit]
+            logger.debug(f"Search {query!r} in {key}: {total} hits in {(time.perf_counter() - started) * 1000:.2f}ms")
+            if not page:
+                return [], len(hits), total
+
+            # 索引里只有 _id，本页的内容从数据库（和写缓冲）读取
+            wanted = {doc_id for _, doc_id in page}
+            docs = {doc['_id']: doc for doc in self.write_buffer.pending(lambda doc: doc['_id'] in wanted)}
+            for doc in self.fetch_messages_by_ids(list(wanted - docs.keys())):
+                docs[doc['_id']] = doc
+            if self.archive is not None and wanted - docs.keys():
+                for doc in self.archive.fetch(key, wanted - docs.keys()):
+                    docs[doc['_id']] = doc
+            results = [dict(cached_turn(docs[doc_id]), score=round(score, 3)) for score, doc_id in page if doc_id in docs]
+            return results, len(hits), total
+        except Exception as e:
+            logger.error(f"Error searching messages: {e}")
+            return [], 0, 0
+
+    def flush(self):
+        """立即写入缓冲中的消息和用户信息"""
+        return self.write_buffer.flush() + self.user_registry.flush()
+
+    def close(self):
+        """写入缓冲中的消息和用户信息，之后不再接受写入"""
+        self.write_buffer.close()
+        self.user_registry.close()
+
+    def _context_key(self, user_id, context_type, context_id):
+        return (context_type, user_id if context_type == 'private' else context_id)
+
+    def _load_recent_messages(self, key, user_id, context_type, context_id, limit):
+        """会话缓存未命中时从数据库加载，顺便把整个环形缓冲填满"""
+        fetch_limit = max(limit, self.conversation_cache.turns_per_context)
+        turns = None
+        self.conversation_cache.begin_load(key)
+        try:
+            messages = self.fetch_recent_messages(user_id, context_type, context_id, fetch_limit)
+            complete = len(messages) < fetch_limit
+
+            # 合并写缓冲中属于该会话、尚未落库的消息
+            pending = self.write_buffer.pending(lambda doc: self._context_key(
+                doc.get('user_id'), doc.get('context_type'), doc.get('context_id')) == key)
+            if pending:
+                seen_ids = {msg['_id'] for msg in messages}
+                messages.extend(doc for doc in pending if doc['_id'] not in seen_ids)
+                messages = sorted(messages, key=lambda msg: msg.get('timestamp', 0), reverse=True)[:fetch_limit]
+
+            # 跳过未回复的消息
+            turns = [
+                cached_turn(msg) for msg in reversed(messages)
+                if msg.get('user_input') and msg.get('response_text') and msg['response_text'] != '(no response)'
+            ]
+            return turns[-limit:]
+        finally:
+            self.conversation_cache.finish_load(key, turns, complete=turns is not None and complete)
+
+    def _build_search_index(self, key, user_id, context_type, context_id):
+        """第一次搜索某个会话时读取它的全部消息建立索引"""
+        with self._search_build_lock:
+            if self.search_index.is_indexed(key):
+                return
+            started = time.monotonic()
+            self.search_index.begin_load(key)
+            try:
+                pending = self.write_buffer.pending(lambda doc: self._context_key(
+                    doc.get('user_id'), doc.get('context_type'), doc.get('context_id')) == key)
+                archived = self.archive.iter_messages(key) if self.archive is not None else ()
+                docs = itertools.chain(archived, self.iter_context_messages(user_id, context_type, context_id), pending)
+                self.search_index.finish_load(key, docs)
+            except Exception:
+                self.search_index.abort_load(key)
+                raise
+            logger.info(f"Built search index for {key} in {time.monotonic() - started:.2f}s, index stats: {self.search_index.stats()}")
+
+    # ---- 后端实现 ----
+
+    def ensure_indexes(self):
+        raise NotImplementedError
+
+    def check_query_plans(self):
+        """检查热点查询是否走索引，返回 {查询名: [问题]}"""
+        raise NotImplementedError
+
+    def deduplicate_users(self):
+        raise NotImplementedError
+
+    def get_context(self, context_type, context_id):
+        raise NotImplementedError
+
+    def update_context(self, context_type, context_id, new_message):
+        raise NotImplementedError
+
+    def clean_empty_responses(self):
+        raise NotImplementedError
+
+    def clean_old_contexts(self, days=1):
+        raise NotImplementedError
+
+    def run_migrations(self):
+        """执行尚未完成的数据库迁移，返回本次执行的迁移"""
+        raise NotImplementedError
+
+    def fetch_recent_messages(self, user_id, context_type, context_id, limit):
+        """按时间倒序返回会话中已落库的最近 limit 条消息，不经过缓存"""
+        raise NotImplementedError
+
+    def iter_context_messages(self, user_id, context_type, context_id):
+        """按时间正序逐条返回会话中已落库的全部消息（建立搜索索引用）"""
+        raise NotImplementedError
+
+    def fetch_messages_by_ids(self, message_ids):
+        """按 _id 读取消息，不存在的 _id 直接忽略"""
+        raise NotImplementedError
+
+    def find_expiring_messages(self, cutoff, after=None, limit=500, exempt_user_ids=(), exempt_context_ids=()):
+        """按时间顺序取一批早于 cutoff 的消息，after 为上一批最后一条的 (timestamp, _id)"""
+        raise NotImplementedError
+
+    def load_state(self, name):
+        """读取维护任务的进度记录"""
+        raise NotImplementedError
+
+    def save_state(self, name, state):
+        raise NotImplementedError
+
+    def load_summary(self, name):
+        """读取会话摘要，name 形如 group:123456"""
+        raise NotImplementedError
+
+    def save_summary(self, name, summary):
+        raise NotImplementedError
+
+    def write_messages(self, documents):
+        """批量写入消息，返回写入的条数（写缓冲的 write_batch）"""
+        raise NotImplementedError
+
+    def write_users(self, users):
+        """批量 upsert 用户信息（用户信息缓存的 write_users）"""
+        raise NotImplementedError
+
+    def _delete_stored_messages(self, message_ids):
+        """删除已落库的消息，返回删除的条数"""
+        raise NotImplementedError
+
+
+def _chat_messages(turns):
+    """把对话轮次展开成 user/assistant 两条消息"""
+    messages_list = []
+    for turn in turns:
+        msg_id = str(turn["_id"])  # 将 ObjectId 转换为字符串
+        messages_list.append({"_id": msg_id, "role": "user", "content": turn['user_input']})
+        messages_list.append({"_id": msg_id, "role": "assistant", "content": turn['response_text']})
+    return messages_list
+
+def cached_turn(doc):
+    """会话缓存里只保留构造上下文需要的字段"""
+    return {
+        '_id': doc['_id'],
+        'user_input': doc.get('user_input'),
+        'response_text': doc.get('response_text'),
+        'timestamp': doc.get('timestamp'),
+        'tokens': turn_tokens(doc),  # 旧文档没有保存 token 数，在这里补上
+    }
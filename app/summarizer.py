@@ -0,0 +1,164 @@
+# summarizer.py
+# 滚动摘要：会话中还没摘要的对话超过阈值后，在空闲时把较早的轮次交给模型并入该会话的摘要
+# 回复路径上只读取已保存的摘要，生成摘要的模型调用都在后台协程里完成
+import asyncio
+import time
+from collections import OrderedDict
+from app.logger import logger
+from app.config import Config
+from app.context_builder import estimate_tokens
+from app.database import get_async_database
+from app.task_manger import task_manager, LOOP_LAG_THRESHOLD
+from utils.model_request import get_summary_response
+
+config = Config.get_instance()
+
+SUMMARY_PROMPT = ("你负责维护一段聊天的摘要。把新的对话并入已有摘要，保留人物、事实、约定和还没解决的问题，"
+                  "省略寒暄和重复内容。只输出更新后的摘要，不超过{max_chars}字。")
+IDLE_CHECK_INTERVAL = 1.0  # 忙碌时每隔多久再看一次是否空闲（秒）
+MAX_TRACKED = 10000        # 最多记录多少个会话的未摘要轮数
+
+
+def _context_key(user_id, context_type, context_id):
+    return (context_type, user_id if context_type == 'private' else context_id)
+
+
+def task_manager_idle():
+    """没有排队的任务、一半以上的工作协程空闲且事件循环不卡时才算空闲"""
+    return (task_manager.task_queue.qsize() == 0
+            and task_manager.busy < max(1, task_manager.num_workers // 2)
+            and task_manager.loop_lag < LOOP_LAG_THRESHOLD)
+
+
+class ConversationSummarizer:
+    """按会话增量更新摘要：只把上次摘要之后、最近 keep_turns 轮之前的对话并入已有摘要
+
+    note() 在每轮对话保存后调用，只更新计数；某个会话新增的轮数达到 min_turns 时才排进待处理队列。
+    只读取会话缓存里的 window 轮（不会因为缓存放不下而每次都查数据库），
+    一次最多并入 max_batch 轮，积压超出缓存的更早部分不再进入摘要。
+    """
+
+    def __init__(self, db, summarize, is_idle=task_manager_idle, window=20, keep_turns=10, min_turns=10,
+                 max_batch=30, max_chars=500, interval=5.0):
+        self.db = db
+        self.summarize = summarize
+        self.is_idle = is_idle
+        self.window = window
+        if keep_turns + min_turns > window:
+            logger.warning(f"summary_keep_turns + summary_min_turns exceeds context_cache_turns ({window}), "
+                           f"keeping {max(0, window - min_turns)} turns verbatim")
+            keep_turns = max(0, window - min_turns)
+        self.keep_turns = keep_turns
+        self.min_turns = min_turns
+        self.max_batch = max(max_batch, min_turns)
+        self.max_chars = max_chars
+        self.interval = interval
+        self._tracked = OrderedDict()  # 会话键 -> 上次检查之后新增的轮数，不在其中表示还没检查过
+        self._ready = OrderedDict()  # 会话键 -> (user_id, context_type, context_id)
+        self._wakeup = None
+        self._task = None
+        self.folded_turns = 0
+        self.updates = 0
+        self.failures = 0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """放弃正在生成的摘要：已保存的摘要不受影响，下次启动后会重新并入"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def note(self, user_id, context_type, context_id):
+        """记录会话新保存了一轮对话"""
+        key = _context_key(user_id, context_type, context_id)
+        count = self._tracked.pop(key, None)
+        if count is not None:
+            count += 1
+            self._tracked[key] = count
+            if count < self.min_turns:
+                return
+        # 第一次见到的会话先检查一次，看历史里是否已经有需要摘要的部分
+        self._ready[key] = (user_id, context_type, context_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self):
+        return {
+            'pending_contexts': len(self._ready),
+            'updates': self.updates,
+            'folded_turns': self.folded_turns,
+            'failures': self.failures,
+        }
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            while self._ready:
+                if not self.is_idle():
+                    await asyncio.sleep(IDLE_CHECK_INTERVAL)
+                    continue
+                key, context = self._ready.popitem(last=False)
+                try:
+                    await self._fold(key, context)
+                except Exception as e:
+                    self.failures += 1
+                    self._track(key, 0)
+                    logger.error(f"Error summarizing {key[0]}:{key[1]}: {e}")
+                # 两次摘要之间留出间隔，控制后台调用模型的频率
+                await asyncio.sleep(self.interval)
+            self._wakeup.clear()
+
+    def _track(self, key, count):
+        self._tracked[key] = count
+        self._tracked.move_to_end(key)
+        while len(self._tracked) > MAX_TRACKED:
+            self._tracked.popitem(last=False)
+
+    async def _fold(self, key, context):
+        user_id, context_type, context_id = context
+        summary = await self.db.get_summary(user_id, context_type, context_id) or {}
+        until = summary.get('until', 0)
+        turns = await self.db.get_recent_turns(user_id, context_type, context_id,
+                                               limit=min(self.window, self.keep_turns + self.max_batch))
+        fresh = [turn for turn in turns if (turn.get('timestamp') or 0) > until]
+        foldable = fresh[:max(0, len(fresh) - self.keep_turns)]
+        if len(foldable) < self.min_turns:
+            self._track(key, len(foldable))
+            return
+
+        started = time.monotonic()
+        dialogue = "\n".join(f"{turn['user_input']}\n机器人：{turn['response_text']}" for turn in foldable)
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=self.max_chars)},
+            {"role": "user", "content": f"已有摘要：\n{summary.get('text') or '（无）'}\n\n新的对话：\n{dialogue}"},
+        ]
+        text = (await self.summarize(messages)).strip()
+        if not text:
+            raise ValueError("empty summary")
+        await self.db.update_summary(user_id, context_type, context_id, {
+            'text': text,
+            'until': foldable[-1]['timestamp'],
+            'turns': summary.get('turns', 0) + len(foldable),
+            'tokens': estimate_tokens(text),
+            'updated_at': time.time(),
+        })
+        self._track(key, 0)
+        self.updates += 1
+        self.folded_turns += len(foldable)
+        logger.info(f"Folded {len(foldable)} turns into the summary of {key[0]}:{key[1]} in {time.monotonic() - started:.1f}s")
+
+
+summarizer = ConversationSummarizer(
+    get_async_database(),
+    get_summary_response,
+    window=config.CONTEXT_CACHE_TURNS,
+    keep_turns=config.SUMMARY_KEEP_TURNS,
+    min_turns=config.SUMMARY_MIN_TURNS,
+    max_batch=config.SUMMARY_MAX_BATCH,
+    max_chars=config.SUMMARY_MAX_CHARS,
+    interval=config.SUMMARY_INTERVAL
+) if config.SUMMARY_ENABLED else None
@@ -1,33 +1,174 @@
 import asyncio
+import bisect
+import time
 from app.logger import logger
+from app.config import Config
+
+config = Config.get_instance()
+
+# 直方图桶的上界（毫秒），最后一个桶收集所有更慢的任务
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+SCALE_INTERVAL = 1.0        # 每隔多少秒检查一次是否需要增减工作协程
+LOOP_LAG_THRESHOLD = 0.1    # 事件循环延迟超过这个值（秒）说明已经忙不过来，再加协程也没用
+SCALE_DOWN_AFTER = 30       # 连续多少次检查都有空闲协程才回收一个
+
+_RETIRE = object()  # 放进任务队列让一个空闲的工作协程退出
+
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图，记录和读取都是 O(桶数)"""
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self.counts = [0] * (len(buckets_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets_ms, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction):
+        """返回该分位所在桶的上界（毫秒），不超过实际的最大值"""
+        if not self.count:
+            return 0
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                if index < len(self.buckets_ms):
+                    return min(self.buckets_ms[index], round(self.max, 1))
+                return round(self.max, 1)
+        return round(self.max, 1)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count, 1) if self.count else 0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 1),
+        }
+
 
 class TaskManager:
-    def __init__(self, num_workers=10):
+    """工作协程池，工作协程数在 min_workers 和 num_workers 之间按积压和事件循环延迟自动调整"""
+
+    def __init__(self, num_workers=10, min_workers=None):
         self.task_queue = asyncio.Queue()
-        self.num_workers = num_workers
-        self.workers = []
+        self.num_workers = num_workers  # 工作协程数上限
+        self.min_workers = min(min_workers or num_workers, num_workers)
+        self.workers = set()
+        self.busy = 0
+        self.loop_lag = 0.0
+        self.queue_wait = LatencyHistogram()
+        self.service_time = LatencyHistogram()
+        self._monitor = None
+        self._idle_checks = 0
 
     async def start(self):
-        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+        self._add_workers(self.min_workers)
+        self._monitor = asyncio.create_task(self._autoscale())
         # logger.info(f"Task manager started with {self.num_workers} workers")
 
-    async def stop(self):
-        await self.task_queue.join()
-        for worker in self.workers:
+    async def stop(self, timeout=None):
+        """等待已提交的任务完成（最多 timeout 秒），然后结束所有工作协程，返回 True 表示全部完成
+
+        调用前应先停止消息接收；排空期间正在处理的任务提交的后续任务（如同一会话的下一条消息）仍会执行。
+        """
+        if self._monitor is not None:
+            self._monitor.cancel()
+        drained = True
+        try:
+            await asyncio.wait_for(self.task_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            drained = False
+            logger.warning(f"Task manager drain timed out after {timeout}s, "
+                           f"{self.busy} running and {self.task_queue.qsize()} queued tasks abandoned")
+        workers = list(self.workers)
+        for worker in workers:
             worker.cancel()
-        await asyncio.gather(*self.workers, return_exceptions=True)
+        await asyncio.gather(*workers, return_exceptions=True)
+        self.workers.clear()
+        if self._monitor is not None:
+            await asyncio.gather(self._monitor, return_exceptions=True)
+        return drained
+
+    async def add_task(self, task):
+        await self.task_queue.put((time.monotonic(), task))
+        # 积压超过空闲协程数时立即补一个，不等下一次检查
+        idle = len(self.workers) - self.busy
+        if self.task_queue.qsize() > idle and len(self.workers) < self.num_workers and self.loop_lag < LOOP_LAG_THRESHOLD:
+            self._add_workers(1)
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'busy': self.busy,
+            'queued': self.task_queue.qsize(),
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+            'queue_wait': self.queue_wait.snapshot(),
+            'service_time': self.service_time.snapshot(),
+        }
 
     async def _worker(self):
         while True:
-            task = await self.task_queue.get()
+            entry = await self.task_queue.get()
+            if entry is _RETIRE:
+                self.task_queue.task_done()
+                self.workers.discard(asyncio.current_task())
+                return
+            enqueued_at, task = entry
+            started_at = time.monotonic()
+            self.queue_wait.record(started_at - enqueued_at)
+            self.busy += 1
             try:
                 await task
             except Exception as e:
                 logger.error(f"Error processing task: {e}")
             finally:
+                self.busy -= 1
+                self.service_time.record(time.monotonic() - started_at)
                 self.task_queue.task_done()
 
-    async def add_task(self, task):
-        await self.task_queue.put(task)
+    def _add_workers(self, count):
+        for _ in range(count):
+            self.workers.add(asyncio.create_task(self._worker()))
+
+    async def _autoscale(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(SCALE_INTERVAL)
+            # sleep 超出预期的部分就是事件循环的延迟
+            self.loop_lag = max(0.0, loop.time() - started_at - SCALE_INTERVAL)
+            self._rescale()
+
+    def _rescale(self):
+        backlog = self.task_queue.qsize()
+        idle = len(self.workers) - self.busy
+        if backlog and len(self.workers) < self.num_workers:
+            self._idle_checks = 0
+            if self.loop_lag < LOOP_LAG_THRESHOLD:
+                added = min(backlog, self.num_workers - len(self.workers))
+                self._add_workers(added)
+                logger.debug(f"Task manager scaled up by {added} to {len(self.workers)} workers")
+        elif not backlog and idle > 0 and len(self.workers) > self.min_workers:
+            self._idle_checks += 1
+            if self._idle_checks >= SCALE_DOWN_AFTER:
+                self._idle_checks = 0
+                self.task_queue.put_nowait(_RETIRE)
+                logger.debug(f"Task manager scaling down from {len(self.workers)} workers")
+        else:
+            self._idle_checks = 0
+
 
-task_manager = TaskManager()
\ No newline at end of file
+# 工作协程数上限就是同时处理消息的会话数上限
+task_manager = TaskManager(num_workers=config.MAX_ACTIVE_CONTEXTS, min_workers=config.MIN_TASK_WORKERS)
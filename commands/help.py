@@ -15,5 +15,6 @@ async def handle_help_command(msg_type, number, send_msg):
             "11. 使用'music_list'命令获取可用的音乐列表。\n"
             "12. 使用'r18'+[0, 1, 2]命令切换涩图接口r18模式。0为关闭r18，1为开启，2为随机\n"
             "13. 使用'model'+模型名命令切换AI模型。对应模型需先再model.json中配置好。\n"
+            "14. 使用'search'+关键词搜索当前会话的历史消息，可在最后接页码翻页。\n"
         )
         await  send_msg(msg_type, number, help_message)
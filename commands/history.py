@@ -1,7 +1,7 @@
 # commands/history.py
-from app.database import MongoDB
+from app.database import get_async_database
 
-db = MongoDB()
+db = get_async_database()
 
 DEFAULT_HISTORY_COUNT = 10
 MAX_HISTORY_COUNT = 50
@@ -21,7 +21,12 @@ async def handle_history_command(msg_type, recipient_id, context_type, context_i
         else:
             count = DEFAULT_HISTORY_COUNT
 
-        recent_messages = db.get_recent_messages(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=count)
+        recent_messages = await db.get_recent_messages(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=count)
+        if len(recent_messages) // 2 < count:
+            # 数据库里不够时从归档中补上更早的记录
+            archived_messages = await db.get_archived_messages(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=count - len(recent_messages) // 2)
+            recent_ids = {msg['_id'] for msg in recent_messages}
+            recent_messages = [msg for msg in archived_messages if msg['_id'] not in recent_ids] + recent_messages
         if recent_messages:
             message_texts = [f"{msg['role']}: {msg['content']}" for msg in recent_messages]
             history_message = "\n".join(message_texts)
@@ -44,9 +49,9 @@ async def handle_clear_history_command(msg_type, recipient_id, context_type, con
         else:
             count = DEFAULT_CLEAR_COUNT
 
-        recent_messages = db.get_recent_messages(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=count)
+        recent_messages = await db.get_recent_messages(user_id=recipient_id, context_type=context_type, context_id=context_id, limit=count)
         if recent_messages:
-            db.delete_messages(recent_messages)
+            await db.delete_messages(recent_messages)
             await send_msg(msg_type, recipient_id, f"最近的 {len(recent_messages)//2} 条消息已删除。")
         else:
             await send_msg(msg_type, recipient_id, "没有找到可以删除的消息。")
@@ -2,6 +2,7 @@
 import json
 import os
 from app.config import Config
+from utils.model_request import reload_response_cache
 
 config = Config.get_instance()
 
@@ -32,6 +33,7 @@ async def handle_model_command(msg_type, number, new_model, send_msg):
 
         # 重新加载配置
         config.reload_config()
+        reload_response_cache()
 
         await send_msg(msg_type, number, f"模型已更新为 {new_model} 并且配置已成功重新加载。")
     except FileNotFoundError:
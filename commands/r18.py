@@ -2,6 +2,7 @@
 import json
 import os
 from app.config import Config
+from utils.model_request import reload_response_cache
 
 config = Config.get_instance()
 
@@ -26,6 +27,7 @@ async def handle_r18_command(msg_type, recipient_id, r18_mode, send_msg):
 
         # 重新加载配置
         config.reload_config()
+        reload_response_cache()
 
         await send_msg(msg_type, recipient_id, f"r18模式已更新为 {r18_mode}")
     except FileNotFoundError:
@@ -2,6 +2,7 @@ import asyncio
 from app.logger import logger
 from utils.receive import message_queue  # 导入消息队列
 from app.config import Config
+from utils.model_request import invalidate_response_cache, reload_response_cache
 # 定义会话超时时间（以秒为单位），例如 15 分钟
 SESSION_TIMEOUT = 15 * 60
 
@@ -17,12 +18,14 @@ def reset_session():
     logger.info("会话已重置。消息队列已清空。")
 
 def clear_message_queue():
-    while not message_queue.empty():
-        message_queue.get_nowait()
+    message_queue.clear()
 
-async def handle_reset_command(msg_type, recipient_id, send_msg):
+async def handle_reset_command(msg_type, recipient_id, context_type, context_id, send_msg):
     reset_session()
+    # 重置后同样的提问不再返回这个会话之前缓存的回复
+    invalidate_response_cache(f"{context_type}:{context_id}")
     config.reload_config()
+    reload_response_cache()
     reset_message = "当前会话已重置。"
     await send_msg(msg_type, recipient_id, reset_message)
 
@@ -0,0 +1,50 @@
+# commands/search.py
+import time
+from app.database import get_async_database
+
+db = get_async_database()
+
+PAGE_SIZE = 5
+SNIPPET_LENGTH = 60
+
+def _snippet(text):
+    text = (text or '').replace('\n', ' ')
+    return text if len(text) <= SNIPPET_LENGTH else text[:SNIPPET_LENGTH] + '…'
+
+def parse_search_args(args):
+    """拆出关键词和页码：最后一个词是数字且前面还有关键词时视为页码"""
+    parts = args.split()
+    if len(parts) > 1 and parts[-1].isdigit():
+        return ' '.join(parts[:-1]), int(parts[-1])
+    return ' '.join(parts), 1
+
+async def handle_search_command(msg_type, recipient_id, context_type, context_id, send_msg, args):
+    keywords, page = parse_search_args(args)
+    if not keywords:
+        await send_msg(msg_type, recipient_id, "Usage: /search <关键词> [页码]")
+        return
+    if page <= 0:
+        await send_msg(msg_type, recipient_id, "请输入一个大于0的页码。")
+        return
+
+    results, pageable, total = await db.search_messages(
+        user_id=recipient_id, context_type=context_type, context_id=context_id,
+        query=keywords, offset=(page - 1) * PAGE_SIZE, limit=PAGE_SIZE
+    )
+    if not total:
+        await send_msg(msg_type, recipient_id, f"没有找到包含“{keywords}”的消息记录。")
+        return
+    pages = (pageable + PAGE_SIZE - 1) // PAGE_SIZE
+    if not results:
+        await send_msg(msg_type, recipient_id, f"“{keywords}”的搜索结果只有 {pages} 页。")
+        return
+
+    # 命中太多时只能翻看最相关的一部分
+    count = f"共 {total} 条结果" if pageable == total else f"共 {total} 条结果，可查看最新的 {pageable} 条中最相关的"
+    lines = [f"“{keywords}”{count}（第 {page}/{pages} 页）："]
+    for number, msg in enumerate(results, start=(page - 1) * PAGE_SIZE + 1):
+        sent_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(msg.get('timestamp', 0)))
+        lines.append(f"{number}. [{sent_at}] user: {_snippet(msg['user_input'])}\n   assistant: {_snippet(msg['response_text'])}")
+    if page < pages:
+        lines.append(f"发送 /search {keywords} {page + 1} 查看下一页")
+    await send_msg(msg_type, recipient_id, "\n".join(lines))
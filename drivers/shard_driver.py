@@ -0,0 +1,62 @@
+import asyncio
+import itertools
+from app.logger import logger
+
+# 分片工作进程启动时带上这个环境变量，app.driver 据此换成本驱动
+WORKER_ENV = 'QBOT_SHARD_WORKER'
+
+
+class ShardDriver:
+    """分片工作进程使用的驱动：API 调用经管道交给入口进程，由它通过唯一的 OneBot 连接发出"""
+
+    def __init__(self):
+        self._channel = None
+        self._ids = itertools.count()
+        self._futures = {}
+
+    def attach(self, channel):
+        self._channel = channel
+
+    async def start_server(self, host, port, handler):
+        raise RuntimeError("Shard workers do not accept connections")
+
+    async def receive_msg(self, handler):
+        pass  # 事件由入口进程转发
+
+    async def call_api(self, action, **params):
+        if self._channel is None:
+            raise ConnectionError("Shard channel is not attached")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[request_id] = future
+        try:
+            self._channel.send('api', request_id, action, params)
+            return await asyncio.wait_for(future, timeout=15)
+        except asyncio.TimeoutError:
+            logger.error(f"API call timed out: {action}")
+            raise
+        finally:
+            self._futures.pop(request_id, None)
+
+    def resolve(self, request_id, result, error):
+        """入口进程返回了 API 调用结果"""
+        future = self._futures.get(request_id)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(ConnectionError(error))
+        else:
+            future.set_result(result)
+
+    async def send_msg(self, msg_type, number, msg, use_voice=False):
+        if msg_type == 'private':
+            response = await self.call_api('send_private_msg', user_id=number, message=msg)
+        elif msg_type == 'group':
+            response = await self.call_api('send_group_msg', group_id=number, message=msg)
+        else:
+            raise ValueError(f"Unsupported message type: {msg_type}")
+        logger.info(f"\nsend_{msg_type}_msg: {msg}\n")
+        return response
+
+    async def close(self):
+        pass  # 连接属于入口进程
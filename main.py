@@ -9,12 +9,18 @@ import time
 from wsgiref.simple_server import make_server
 from utils.file import app
 import schedule
-from app.message import process_group_message, process_private_message
+from app.message import process_group_message, process_private_message, first_message_latency
 from app.config import Config
-from app.database import MongoDB
-from utils.receive import start_http_server, start_reverse_ws, rev_msg, close_connection
+from app.database import get_database, get_async_database, close_database
+from app.retention import RetentionEngine
+from utils.receive import start_http_server, start_reverse_ws, rev_msg, close_connection, message_queue, context_of, shard_router, journal, message_done, replay_journal
+from app.message_queue import DROP_SHUTDOWN
+from app.journal import run_journaled
+from utils.model_request import client as model_client, warm_up_client, close_client, response_cache
 from commands.reset import session_timeout_check
 from app.task_manger import task_manager
+from app.dispatcher import ContextDispatcher
+from app.summarizer import summarizer
 
 # 定义全局线程池
 thread_pool = ThreadPoolExecutor(max_workers=10)
@@ -51,17 +57,43 @@ class FlaskServer:
         if self.thread.is_alive():
             logger.warning("Flask 应用程序未能在预期时间内关闭")
 
+async def process_message_event(rev_message):
+    message_type = rev_message.get('message_type')
+    if message_type == "private":
+        await process_private_message(rev_message)
+    elif message_type == "group":
+        await process_group_message(rev_message)
+
+async def handle_message_event(rev_message):
+    if not message_queue.start(rev_message):
+        # 在调度器里等待超时，丢弃时已在入口日志中确认
+        message_done(rev_message, acknowledge=False)
+        return
+    # 结束后释放该会话在消息队列中的并发名额；排空超时被取消的消息不在入口日志中确认
+    await run_journaled(rev_message, process_message_event, message_done)
+
+# 同一会话的消息按顺序处理，不同会话由 task_manager 的工作协程并行处理
+dispatcher = ContextDispatcher(
+    task_manager,
+    handle_message_event,
+    key_of=context_of,
+    max_active=task_manager.num_workers,  # 工作协程数的上限，实际协程数按负载伸缩
+    idle_timeout=Config.get_instance().MAILBOX_IDLE_TIMEOUT
+)
+
 async def process_message(rev_message):
     if not CONNECTION_ENABLED.is_set():
         logger.debug("连接已禁用，忽略消息")
+        if rev_message:
+            message_done(rev_message)
         return
     if rev_message and 'post_type' in rev_message:
         if rev_message['post_type'] == 'message':
-            message_type = rev_message.get('message_type')
-            if message_type == "private":
-                asyncio.create_task(process_private_message(rev_message))
-            elif message_type == "group":
-                asyncio.create_task(process_group_message(rev_message))
+            # 多进程模式下按会话转发给工作进程，排队时间只统计到转发为止
+            if shard_router is not None and not message_queue.start(rev_message):
+                message_done(rev_message, acknowledge=False)
+                return
+            await (shard_router or dispatcher).dispatch(rev_message)
         elif rev_message['post_type'] == 'meta_event':
             if rev_message['meta_event_type'] == 'heartbeat':
                 logger.debug("Received heartbeat")
@@ -70,12 +102,17 @@ async def process_message(rev_message):
     else:
         logger.warning(f"Received unexpected message format: {rev_message}")
 
+async def next_message():
+    """有空闲的处理名额时才从消息队列取下一条：积压留在优先级队列里，命令可以插到闲聊前面，溢出策略也能生效"""
+    await (shard_router or dispatcher).wait_for_capacity()
+    return await rev_msg()
+
 async def main_loop():
     logger.info("HTTP 轮询进程已启动，正在监听消息...")
     while not shutdown_event.is_set():
         try:
-            rev_message = await asyncio.wait_for(rev_msg(), timeout=1.0)           
-            await task_manager.add_task(process_message(rev_message))
+            rev_message = await asyncio.wait_for(next_message(), timeout=1.0)
+            await process_message(rev_message)
             #logger.info(f"放入任务队列: {rev_message}")
         except asyncio.TimeoutError:
             continue
@@ -86,8 +123,8 @@ async def main_loop():
 async def ws_process():
     while not shutdown_event.is_set():
         try:
-            rev_message = await rev_msg()
-            await task_manager.add_task(process_message(rev_message))
+            rev_message = await next_message()
+            await process_message(rev_message)
             #logger.info(f"放入任务队列: {rev_message}")
         except Exception as e:
             logger.error(f"Error in WebSocket process: {e}")
@@ -96,24 +133,58 @@ async def ws_process():
 
 # 定义定期清理任务
 def schedule_jobs():
-    mongo_db = MongoDB()
-    exempt_users = [config.ADMIN_ID]
-    exempt_groups = []
+    mongo_db = get_database()
+    retention_engine = RetentionEngine.from_config(mongo_db)
 
     schedule.every().day.at(config.DISABLE_TIME).do(disable_connection)
     schedule.every().day.at(config.ENABLE_TIME).do(enable_connection)
 
+    # 启动时执行尚未完成的数据库迁移，上次清理被中断（重启等）时先把它做完
+    mongo_db.run_migrations()
+    try:
+        if retention_engine.has_unfinished_run():
+            run_retention(retention_engine)
+    except Exception as e:
+        logger.error(f"Error checking retention state: {e}")
 
-    schedule.every().day.at("02:00").do(mongo_db.clean_old_messages, days=1, exempt_user_ids=exempt_users, exempt_context_ids=exempt_groups)
+    schedule.every().day.at("02:00").do(run_retention, retention_engine=retention_engine)
     schedule.every().day.at("03:00").do(clean_old_logs, days=14)
 
     voice_directory = os.path.join(os.getcwd(), config.AUDIO_SAVE_PATH)
     schedule.every(60).minutes.do(clean_voice_directory, directory=voice_directory)
+    schedule.every(60).minutes.do(log_runtime_stats, mongo_db=mongo_db)
     
     while not shutdown_event.is_set():
         schedule.run_pending()
         time.sleep(5)  # 减少睡眠时间，以便更快地响应关闭信号
 
+def run_retention(retention_engine):
+    try:
+        retention_engine.run(should_stop=shutdown_event.is_set)
+    except Exception as e:
+        logger.error(f"Error running retention: {e}")
+
+def log_runtime_stats(mongo_db):
+    logger.info(f"会话缓存: {mongo_db.conversation_cache.stats()}")
+    logger.info(f"搜索索引: {mongo_db.search_index.stats()}")
+    logger.info(f"消息队列: 积压 {message_queue.lane_depths()}, 丢弃 {message_queue.drop_counts()}")
+    logger.info(f"会话调度: {dispatcher.stats()}")
+    logger.info(f"任务管理: {task_manager.stats()}")
+    if shard_router is None:
+        logger.info(f"模型接口: {model_client.stats()}")
+        logger.info(f"首条回复耗时: {first_message_latency.snapshot()}")
+        if response_cache is not None:
+            logger.info(f"回复缓存: {response_cache.stats()}")
+        if summarizer is not None:
+            logger.info(f"会话摘要: {summarizer.stats()}")
+    if journal is not None:
+        logger.info(f"入口日志: {journal.stats()}")
+    if shard_router is not None:
+        logger.info(f"工作进程: {shard_router.stats()}")
+    waits = sorted(message_queue.wait_stats().items(), key=lambda item: item[1]['p95_ms'], reverse=True)
+    if waits:
+        logger.info(f"排队时间最长的会话: {dict(waits[:5])}")
+
 def enable_connection():
     if not CONNECTION_ENABLED.is_set():
         CONNECTION_ENABLED.set()
@@ -136,7 +207,18 @@ async def main():
     schedule_thread.start()
 
     flask_server.start()
+    if shard_router is not None:
+        shard_router.start()
     await task_manager.start()
+    # 多进程模式下每个工作进程为自己负责的会话生成摘要
+    if shard_router is None and summarizer is not None:
+        summarizer.start()
+    install_signal_handlers(asyncio.get_running_loop())
+    # 多进程模式下由工作进程调用模型接口，各自预热
+    if shard_router is None and config.MODEL_HTTP_WARMUP:
+        asyncio.create_task(warm_up_client())
+    # 在后台检查热点查询是否都走了索引，不阻塞启动
+    asyncio.create_task(get_async_database().check_query_plans())
 
     try:
         if config.CONNECTION_TYPE == 'http':
@@ -145,21 +227,22 @@ async def main():
             ws_server_task = asyncio.create_task(start_reverse_ws())
 
         timeout_check_task = asyncio.create_task(session_timeout_check())
+        if journal is not None:
+            asyncio.create_task(replay_journal())
 
         while not shutdown_event.is_set():
             if CONNECTION_ENABLED.is_set():
                 try:
-                    if config.CONNECTION_TYPE == 'http':
-                        rev_message = await asyncio.wait_for(rev_msg(), timeout=1.0)
-                    else:  # ws_reverse
-                        rev_message = await rev_msg()
-                    
-                    await task_manager.add_task(process_message(rev_message))
+                    # 带超时等待，收到关闭信号后能及时退出循环
+                    rev_message = await asyncio.wait_for(next_message(), timeout=1.0)
+                    await process_message(rev_message)
                 except asyncio.TimeoutError:
                     continue
                 except Exception as e:
                     logger.error(f"Error in message processing: {e}", exc_info=True)
                     await asyncio.sleep(1)  # 在错误发生后短暂暂停，避免rapid failing
+            else:
+                await asyncio.sleep(1)
 
 
     except asyncio.CancelledError:
@@ -171,26 +254,43 @@ async def main():
         elif config.CONNECTION_TYPE == 'ws_reverse':
             ws_server_task.cancel()
         timeout_check_task.cancel()
-        await close_connection()  # 确保关闭连接
+        message_queue.clear(DROP_SHUTDOWN)  # 还没开始处理的积压留在入口日志里，下次启动时重放
+        # 等待正在处理的消息回复完，超过期限的放弃；回复还要用到连接，排空后再关闭
+        if shard_router is not None:
+            if await shard_router.stop(timeout=config.SHUTDOWN_DRAIN_TIMEOUT):
+                logger.info("工作进程已全部退出")
+        if await task_manager.stop(timeout=config.SHUTDOWN_DRAIN_TIMEOUT):
+            logger.info("正在处理的消息已全部完成")
+        if summarizer is not None:
+            await summarizer.stop()
+        await close_connection()
+        await close_client()
+        close_database()  # 写入缓冲中尚未落库的聊天记录并关闭数据库连接
+        if journal is not None:
+            journal.close()
         flask_server.shutdown()
         thread_pool.shutdown(wait=False)  # 关闭线程池
         logger.info("程序关闭完成")
 
-def shutdown_handler(sig, frame):
+def request_shutdown(sig):
+    if shutdown_event.is_set():
+        # 第二次收到信号时不再等待排空
+        logger.warning(f"再次接收到信号 {sig}, 立即退出")
+        os._exit(1)
     logger.info(f"接收到信号 {sig}, 正在关闭程序...")
     shutdown_event.set()
-    # 给主循环一些时间来完成当前任务
-    time.sleep(2)
-    # 强制退出
-    os._exit(0)
-    
+
+def install_signal_handlers(loop):
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, sig)
+        except NotImplementedError:
+            # Windows 的事件循环不支持 add_signal_handler
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(request_shutdown, signum))
+
 if __name__ == '__main__':
     config = Config.get_instance()
 
-    # 注册信号处理程序
-    signal.signal(signal.SIGINT, shutdown_handler)
-    signal.signal(signal.SIGTERM, shutdown_handler)
-    
     try:
         asyncio.run(main())
     except Exception as e:
@@ -0,0 +1,75 @@
+import asyncio
+from app.dispatcher import ContextDispatcher
+from app.message_queue import PriorityMessageQueue, LANE_COMMAND, LANE_CHATTER
+from app.task_manger import TaskManager
+
+
+def test_command_overtakes_queued_chatter():
+    async def run():
+        order = []
+        queue = PriorityMessageQueue(lane_of=lambda item: item['lane'], context_of=lambda item: item['context'], max_inflight=2)
+        task_manager = TaskManager(num_workers=2, min_workers=2)
+
+        async def handle(item):
+            await asyncio.sleep(0.01)
+            order.append(item['name'])
+            queue.task_done(item)
+
+        dispatcher = ContextDispatcher(task_manager, handle, key_of=lambda item: item['context'], max_active=2)
+        await task_manager.start()
+
+        async def pump():
+            # 与 main.next_message 相同：有空闲名额才从队列取下一条
+            while True:
+                await dispatcher.wait_for_capacity()
+                await dispatcher.dispatch(await queue.get())
+
+        pumping = asyncio.create_task(pump())
+        for index in range(20):
+            await queue.put({'name': f'chatter-{index}', 'context': ('group', index), 'lane': LANE_CHATTER})
+        await asyncio.sleep(0)
+        await queue.put({'name': 'command', 'context': ('private', 1), 'lane': LANE_COMMAND})
+        assert queue.qsize() > 0  # 积压留在优先级队列里
+
+        while len(order) < 21:
+            await asyncio.sleep(0.01)
+        pumping.cancel()
+        await task_manager.stop(timeout=1)
+        return order
+
+    order = asyncio.run(run())
+    # 只有命令入队前已经开始处理的两条闲聊排在它前面
+    assert order.index('command') <= 2
+
+
+def test_wait_is_measured_until_the_handler_starts():
+    async def run():
+        queue = PriorityMessageQueue(context_of=lambda item: item['context'])
+        item = {'context': ('group', 1)}
+        await queue.put(item)
+        assert queue.get_nowait() is item
+        await asyncio.sleep(0.05)  # 出队后在调度器里等待
+        queue.start(item)
+        queue.task_done(item)
+        return queue.wait_stats()
+
+    stats = asyncio.run(run())
+    assert stats['group:1']['max_ms'] >= 50
+
+
+def test_event_expired_in_dispatcher_is_dropped_at_start():
+    async def run():
+        dropped = []
+        queue = PriorityMessageQueue(context_of=lambda item: item['context'], max_age=0.02,
+                                     on_drop=lambda item, reason: dropped.append(reason))
+        item = {'context': ('group', 1)}
+        await queue.put(item)
+        assert queue.get_nowait() is item  # 出队时还没有超时
+        await asyncio.sleep(0.05)
+        started = queue.start(item)
+        queue.task_done(item)
+        return started, dropped
+
+    started, dropped = asyncio.run(run())
+    assert not started
+    assert dropped == ['expired']
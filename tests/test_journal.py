@@ -0,0 +1,56 @@
+import asyncio
+from app.journal import IngressJournal, run_journaled
+from app.task_manger import TaskManager
+
+
+def _event(message_id):
+    return {'post_type': 'message', 'message_type': 'group', 'group_id': 1, 'message_id': message_id, 'raw_message': 'hi'}
+
+
+async def _drain(journal, handle, timeout):
+    """像主进程一样处理一条入口日志里的消息，然后关闭 task_manager，返回是否排空"""
+    task_manager = TaskManager(num_workers=1, min_workers=1)
+    await task_manager.start()
+    event = _event(1)
+    journal.append(event)
+
+    def done(event, acknowledge):
+        if acknowledge:
+            journal.ack(event)
+
+    await task_manager.add_task(run_journaled(event, handle, done))
+    await asyncio.sleep(0)
+    return await task_manager.stop(timeout=timeout)
+
+
+def test_drain_timeout_leaves_event_for_replay(tmp_path):
+    async def never_replies(event):
+        await asyncio.sleep(3600)
+
+    journal = IngressJournal(str(tmp_path))
+    assert asyncio.run(_drain(journal, never_replies, timeout=0.1)) is False
+    assert journal.pending() == 1
+    journal.close()
+
+    reopened = IngressJournal(str(tmp_path))
+    try:
+        events = reopened.replay(max_age=0)
+        assert [event['message_id'] for event in events] == [1]
+    finally:
+        reopened.close()
+
+
+def test_finished_event_is_not_replayed(tmp_path):
+    async def replies(event):
+        await asyncio.sleep(0)
+
+    journal = IngressJournal(str(tmp_path))
+    assert asyncio.run(_drain(journal, replies, timeout=1)) is True
+    assert journal.pending() == 0
+    journal.close()
+
+    reopened = IngressJournal(str(tmp_path))
+    try:
+        assert reopened.replay(max_age=0) == []
+    finally:
+        reopened.close()
@@ -0,0 +1,154 @@
+# http_server.py
+# 一个够用的 HTTP/1.1 请求解析器，供 OneBot HTTP 上报使用：
+# 支持 Content-Length 与 chunked 两种消息体，支持 keep-alive 与管线化请求。
+import asyncio
+
+HTTP_REASONS = {
+    100: 'Continue',
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    408: 'Request Timeout',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    501: 'Not Implemented',
+    505: 'HTTP Version Not Supported',
+}
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(message or HTTP_REASONS.get(status, ''))
+        self.status = status
+
+
+class HttpRequest:
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers  # 键统一为小写
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+
+def _parse_head(raw):
+    try:
+        lines = raw.decode('latin-1').split('\r\n')
+    except UnicodeDecodeError:
+        raise HttpError(400, 'Invalid request head')
+
+    try:
+        method, path, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise HttpError(400, f'Malformed request line: {lines[0]!r}')
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HttpError(505)
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HttpError(400, f'Malformed header line: {line!r}')
+        name = name.strip().lower()
+        value = value.strip()
+        # 重复的头按 RFC 7230 用逗号合并
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return method.upper(), path, version, headers
+
+
+async def _read_chunked(reader, max_body_size):
+    body = bytearray()
+    while True:
+        size_line = await reader.readuntil(b'\r\n')
+        size_field = size_line.split(b';', 1)[0].strip()  # 忽略 chunk 扩展
+        try:
+            size = int(size_field, 16)
+        except ValueError:
+            raise HttpError(400, f'Invalid chunk size: {size_field!r}')
+        if size == 0:
+            # 跳过 trailer，直到空行
+            while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                pass
+            return bytes(body)
+        if len(body) + size > max_body_size:
+            raise HttpError(413)
+        body += await reader.readexactly(size)
+        if await reader.readexactly(2) != b'\r\n':
+            raise HttpError(400, 'Missing CRLF after chunk data')
+
+
+async def read_request(reader, writer, max_body_size):
+    """读取一个完整请求，连接在请求之间正常关闭时返回 None"""
+    try:
+        raw_head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HttpError(400, 'Connection closed in the middle of request head')
+    except asyncio.LimitOverrunError:
+        raise HttpError(431)
+    if len(raw_head) > MAX_HEADER_SIZE:
+        raise HttpError(431)
+
+    method, path, version, headers = _parse_head(raw_head[:-4])
+
+    transfer_encoding = headers.get('transfer-encoding', '').lower()
+    content_length = headers.get('content-length')
+
+    if transfer_encoding and transfer_encoding != 'identity' and not transfer_encoding.endswith('chunked'):
+        raise HttpError(501, f'Unsupported transfer encoding: {transfer_encoding}')
+
+    if content_length is not None and not transfer_encoding.endswith('chunked'):
+        try:
+            length = int(content_length)
+        except ValueError:
+            raise HttpError(400, f'Invalid Content-Length: {content_length!r}')
+        if length < 0:
+            raise HttpError(400, f'Invalid Content-Length: {content_length!r}')
+        if length > max_body_size:
+            raise HttpError(413)
+    else:
+        length = None
+
+    if headers.get('expect', '').lower() == '100-continue' and (length or transfer_encoding):
+        writer.write(build_response(100, keep_alive=True, interim=True))
+        await writer.drain()
+
+    try:
+        if transfer_encoding.endswith('chunked'):
+            body = await _read_chunked(reader, max_body_size)
+        elif length is not None:
+            body = await reader.readexactly(length) if length else b''
+        elif method in ('POST', 'PUT', 'PATCH'):
+            raise HttpError(411)
+        else:
+            body = b''
+    except asyncio.IncompleteReadError:
+        raise HttpError(400, 'Connection closed in the middle of request body')
+    except asyncio.LimitOverrunError:
+        raise HttpError(400, 'Chunk size line too long')
+
+    return HttpRequest(method, path, version, headers, body)
+
+
+def build_response(status, body=b'', content_type='application/json', keep_alive=True, interim=False):
+    reason = HTTP_REASONS.get(status, '')
+    head = [f'HTTP/1.1 {status} {reason}']
+    if not interim:
+        if body:
+            head.append(f'Content-Type: {content_type}')
+        head.append(f'Content-Length: {len(body)}')
+        head.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
@@ -1,29 +1,148 @@
+import asyncio
 import base64
+import hashlib
 import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
 import httpx
 from app.logger import logger
 import os
 import aiohttp
 from app.config import Config
+from app.task_manger import LatencyHistogram
 from utils.cqimage import decode_cq_code, get_cq_image_base64
 
 config = Config.get_instance()
 
 class ModelClient:
+    """每个服务商一个长期复用的 aiohttp 会话，保持连接避免每次请求重新做 DNS、TCP 和 TLS 握手"""
+
     def __init__(self, api_key, base_url, timeout=120):
         self.api_key = api_key
         self.base_url = base_url
         self.timeout = timeout
+        self._session = None
+        # 每次请求的耗时分解：建立连接、首字节（收到响应头）、总耗时
+        self.connect_time = LatencyHistogram()
+        self.ttfb = LatencyHistogram()
+        self.total_time = LatencyHistogram()
+        self.requests = 0
+        self.reused_connections = 0
+
+    def _get_session(self):
+        # 会话绑定创建它的事件循环，所以在第一次请求时才创建
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.MODEL_HTTP_LIMIT,
+                limit_per_host=config.MODEL_HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=config.MODEL_HTTP_KEEPALIVE,
+                ttl_dns_cache=config.MODEL_HTTP_DNS_TTL,
+            )
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_start.append(self._on_connection_create_start)
+            trace_config.on_connection_create_end.append(self._on_connection_create_end)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+            trace_config.on_request_end.append(self._on_request_end)
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+        return self._session
 
     async def request(self, endpoint, payload):
         headers = {
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json'
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/{endpoint}", json=payload, headers=headers, timeout=self.timeout) as response:
-                response.raise_for_status()
-                return await response.json()
+        timing = {'start': time.perf_counter()}
+        session = self._get_session()
+        async with session.post(f"{self.base_url}/{endpoint}", json=payload, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=self.timeout), trace_request_ctx=timing) as response:
+            response.raise_for_status()
+            result = await response.json()
+        self._record(endpoint, timing)
+        return result
+
+    async def stream(self, endpoint, payload):
+        """以 SSE 方式请求，逐个返回每个 data 事件解析出的 JSON"""
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        }
+        timing = {'start': time.perf_counter()}
+        session = self._get_session()
+        async with session.post(f"{self.base_url}/{endpoint}", json={**payload, 'stream': True}, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=self.timeout), trace_request_ctx=timing) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue  # 空行、注释和 event: 行
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                yield json.loads(data)
+        self._record(endpoint, timing)
+
+    async def warm_up(self, connections=2):
+        """启动时预先建立几条连接，第一条消息不用再等握手"""
+        async def touch():
+            session = self._get_session()
+            async with session.get(f"{self.base_url}/models", headers={'Authorization': f'Bearer {self.api_key}'},
+                                   timeout=aiohttp.ClientTimeout(total=10)) as response:
+                await response.read()  # 读完响应体连接才会回到连接池
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(touch() for _ in range(connections)), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            logger.warning(f"Model API warm-up failed for {self.base_url}: {errors[0]!r}")
+        else:
+            logger.info(f"Warmed up {connections} connections to {self.base_url} in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'reused_connections': self.reused_connections,
+            'connect': self.connect_time.snapshot(),
+            'ttfb': self.ttfb.snapshot(),
+            'total': self.total_time.snapshot(),
+        }
+
+    def _record(self, endpoint, timing):
+        now = time.perf_counter()
+        connect = timing.get('connect', 0.0)
+        ttfb = timing.get('headers', now) - timing['start']
+        total = now - timing['start']
+        self.requests += 1
+        self.connect_time.record(connect)
+        self.ttfb.record(ttfb)
+        self.total_time.record(total)
+        logger.debug(f"Model API {endpoint}: connect {connect * 1000:.0f}ms"
+                     f"{' (reused)' if timing.get('reused') else ''}, ttfb {ttfb * 1000:.0f}ms, total {total * 1000:.0f}ms")
+
+    async def _on_connection_create_start(self, session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['connect_start'] = time.perf_counter()
+
+    async def _on_connection_create_end(self, session, context, params):
+        timing = context.trace_request_ctx
+        if timing is not None and 'connect_start' in timing:
+            timing['connect'] = time.perf_counter() - timing['connect_start']
+
+    async def _on_connection_reused(self, session, context, params):
+        self.reused_connections += 1
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['reused'] = True
+
+    async def _on_request_end(self, session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['headers'] = time.perf_counter()
 
 class OpenAIClient(ModelClient):
     async def chat_completion(self, model, messages, **kwargs):
@@ -34,6 +153,20 @@ class OpenAIClient(ModelClient):
         payload.update(kwargs)
         return await self.request('chat/completions', payload)
 
+    async def chat_completion_stream(self, model, messages, **kwargs):
+        """逐段返回生成的文本"""
+        payload = {
+            'model': model,
+            'messages': messages
+        }
+        payload.update(kwargs)
+        async for chunk in self.stream('chat/completions', payload):
+            choices = chunk.get('choices') or []
+            if choices:
+                content = (choices[0].get('delta') or {}).get('content')
+                if content:
+                    yield content
+
     async def image_generation(self, model, prompt, **kwargs):
         payload = {
             'model': model,
@@ -43,6 +176,104 @@ class OpenAIClient(ModelClient):
         return await self.request('images/generate', payload)
 
 
+def normalize_text(text):
+    """全角转半角、统一大小写和空白、去掉句末的标点和语气符号，"早上好！" 和 "早上好" 视为相同"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip(' !?.~,。，、…')
+
+class ResponseCache:
+    """模型回复缓存：按模型、系统提示、最近几条上下文和当前输入的哈希查找，整体按 LRU 淘汰
+
+    每条回复带着请求方的标签（会话类型、会话、用户，管理员另有 admin），
+    标签命中 exclude 的请求既不读也不写缓存；有效期取标签在 ttls 中的最小值，没有时用 ttls['default']。
+    """
+
+    def __init__(self, max_entries=1000, ttls=None, context_messages=2, exclude=()):
+        self.max_entries = max_entries
+        self.ttls = dict(ttls or {})
+        self.context_messages = context_messages
+        self.exclude = set(exclude)
+        self._entries = OrderedDict()  # 键 -> (过期时间, 回复, 标签)
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def ttl_for(self, tags):
+        """返回 0 表示不缓存"""
+        if tags is None or self.exclude & tags:
+            return 0
+        ttls = [self.ttls[tag] for tag in tags if tag in self.ttls]
+        return min(ttls) if ttls else self.ttls.get('default', 0)
+
+    def key(self, model, messages):
+        """用模型实际看到的内容计算：当前输入带着昵称前缀，回复里称呼的人不会被换成别人"""
+        system = [message['content'] for message in messages if message.get('role') == 'system']
+        history = [message for message in messages if message.get('role') != 'system']
+        last = history[-1]['content'] if history else ''
+        context = history[-1 - self.context_messages:-1] if self.context_messages else []
+        material = [
+            model,
+            system,
+            [(message['role'], normalize_text(message['content'])) for message in context],
+            normalize_text(last),
+        ]
+        return hashlib.sha1(json.dumps(material, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, response, tags, ttl):
+        self._entries[key] = (time.monotonic() + ttl, response, tags)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, tag):
+        """删除带有某个标签的全部缓存，例如某个群刚被加入排除列表"""
+        keys = [key for key, (_, _, tags) in self._entries.items() if tag in tags]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        count = len(self._entries)
+        self._entries.clear()
+        return count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+            'bypassed': self.bypassed,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
+
+def cache_tags(context_type, context_id, user_id):
+    """回复缓存的标签，格式与 response_cache_ttl、response_cache_exclude 中的键相同"""
+    tags = {context_type, f"{context_type}:{context_id}", f"user:{user_id}"}
+    if user_id == config.ADMIN_ID:
+        tags.add('admin')
+    return frozenset(tags)
+
 # 读取配置文件
 def load_config():
     config_dir = os.path.join(os.path.dirname(__file__), '../config')
@@ -95,26 +326,132 @@ def get_client(default_config, model_config):
 default_config, model_config = load_config()
 client, supports_image_recognition = get_client(default_config, model_config)
 
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_SIZE,
+    ttls=config.RESPONSE_CACHE_TTL,
+    context_messages=config.RESPONSE_CACHE_CONTEXT_MESSAGES,
+    exclude=config.RESPONSE_CACHE_EXCLUDE
+) if config.RESPONSE_CACHE_ENABLED else None
+
+def _persona():
+    return json.dumps(config.SYSTEM_MESSAGE, ensure_ascii=False, sort_keys=True)
 
+_cached_persona = _persona()
 
-async def get_chat_response(messages):
+def invalidate_response_cache(tag):
+    """删除某个标签下缓存的回复，例如会话被 /reset 时"""
+    if response_cache is None:
+        return 0
+    return response_cache.invalidate(tag)
+
+def reload_response_cache():
+    """配置重新加载后调用：应用新的缓存设置，删除新加入排除列表的标签下的缓存，人设变化时清空全部缓存"""
+    global _cached_persona
+    if response_cache is None:
+        return 0
+    response_cache.ttls = dict(config.RESPONSE_CACHE_TTL)
+    response_cache.context_messages = config.RESPONSE_CACHE_CONTEXT_MESSAGES
+    exclude = set(config.RESPONSE_CACHE_EXCLUDE)
+    removed = sum(response_cache.invalidate(tag) for tag in exclude - response_cache.exclude)
+    response_cache.exclude = exclude
+    persona = _persona()
+    if persona != _cached_persona:
+        _cached_persona = persona
+        removed += response_cache.clear()
+    if removed:
+        logger.info(f"Response cache: removed {removed} entries after config reload")
+    return removed
+
+async def warm_up_client():
+    await client.warm_up(config.MODEL_HTTP_WARMUP)
+
+async def close_client():
+    await client.close()
+
+
+def _add_system_message(messages):
+    # 调用方已经放了系统提示时不再重复添加
+    if messages and messages[0].get('role') == 'system':
+        return messages
     system_message = model_config.get('system_message', {}).get('character', '') or default_config.get('system_message', {}).get('character', '')
 
     if system_message:
         messages.insert(0, {"role": "system", "content": system_message})
+    return messages
+
+def get_context_budget():
+    """当前模型的上下文 token 预算
+
+    依次取 model.json 中服务商配置的 model_context_tokens[模型名]、服务商的 context_tokens，都没有时用 context_token_budget
+    """
+    model_name = config.MODEL_NAME
+    for settings in model_config.get('models', {}).values():
+        if model_name in settings.get('available_models', []):
+            budget = settings.get('model_context_tokens', {}).get(model_name) or settings.get('context_tokens')
+            if budget:
+                return budget
+    return config.CONTEXT_TOKEN_BUDGET
+
+def _completion_options():
+    return {
+        'model': model_config.get('model') or default_config.get('model', 'gpt-3.5-turbo'),
+        'temperature': 0.5,
+        'max_tokens': 2048,
+        'top_p': 0.95,
+        'stop': None,
+        'presence_penalty': 0
+    }
 
+def _cache_lookup(messages, options, tags):
+    """返回 (缓存键, 有效期, 缓存的回复)；不使用缓存时键为 None"""
+    if response_cache is None:
+        return None, 0, None
+    ttl = response_cache.ttl_for(tags)
+    if not ttl:
+        response_cache.bypassed += 1
+        return None, 0, None
+    key = response_cache.key(options['model'], messages)
+    cached = response_cache.get(key)
+    if cached is not None:
+        logger.debug(f"Response cache hit {key[:12]}")
+    return key, ttl, cached
+
+async def get_chat_response(messages, cache_tags=None):
+    """cache_tags 为 cache_tags() 的结果，不传时不使用回复缓存"""
     try:
-        response = await client.chat_completion(
-            model=model_config.get('model') or default_config.get('model', 'gpt-3.5-turbo'),
-            messages=messages,
-            temperature=0.5,
-            max_tokens=2048,
-            top_p=0.95,
-            stream=False,
-            stop=None,
-            presence_penalty=0
-        )
-        return response['choices'][0]['message']['content'].strip()
+        options = _completion_options()
+        messages = _add_system_message(messages)
+        key, ttl, cached = _cache_lookup(messages, options, cache_tags)
+        if cached is not None:
+            return cached
+        response = await client.chat_completion(messages=messages, stream=False, **options)
+        response_text = response['choices'][0]['message']['content'].strip()
+        if key is not None and response_text:
+            response_cache.put(key, response_text, cache_tags, ttl)
+        return response_text
+    except aiohttp.ClientConnectorError as e:
+        logger.error(f"Network connection error during API request: {e}")
+        raise Exception(f"网络连接错误，请检查网络状态后重试: {e}")
+    except Exception as e:
+        logger.error(f"Error during API request: {e}")
+        raise Exception(f"API 请求出错: {e}")
+
+async def stream_chat_response(messages, cache_tags=None):
+    """流式版本的 get_chat_response，逐段返回生成的文本；命中缓存时一次返回完整的回复"""
+    try:
+        options = _completion_options()
+        messages = _add_system_message(messages)
+        key, ttl, cached = _cache_lookup(messages, options, cache_tags)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for delta in client.chat_completion_stream(messages=messages, **options):
+            parts.append(delta)
+            yield delta
+        response_text = ''.join(parts).strip()
+        if key is not None and response_text:
+            response_cache.put(key, response_text, cache_tags, ttl)
     except aiohttp.ClientConnectorError as e:
         logger.error(f"Network connection error during API request: {e}")
         raise Exception(f"网络连接错误，请检查网络状态后重试: {e}")
@@ -122,6 +459,14 @@ async def get_chat_response(messages):
         logger.error(f"Error during API request: {e}")
         raise Exception(f"API 请求出错: {e}")
 
+async def get_summary_response(messages):
+    """后台生成会话摘要用：可以用 summary_model 换成更便宜的模型，出错直接抛出由调用方处理"""
+    options = dict(_completion_options(), temperature=0.3, max_tokens=1024)
+    if config.SUMMARY_MODEL:
+        options['model'] = config.SUMMARY_MODEL
+    response = await client.chat_completion(messages=messages, stream=False, **options)
+    return response['choices'][0]['message']['content']
+
 async def generate_image(prompt):
     if not supports_image_recognition:
         raise Exception("API does not support image generation.")
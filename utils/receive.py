@@ -1,48 +1,87 @@
 import json
+import os
 from loguru import logger
 import asyncio
 import re
-from app.database import MongoDB
 from app.config import Config
 from app.driver import close, start_reverse_ws_server, call_api
+from app.quick_reply import create_quick_reply, QUICK_REPLY_KEY
+from app.message_queue import PriorityMessageQueue, LANE_COMMAND, LANE_DIRECT, LANE_CHATTER, DROP_SHUTDOWN
+from app.journal import IngressJournal
+from app.sharding import ShardRouter
+from drivers.shard_driver import WORKER_ENV
+from utils.http_server import HttpError, read_request, build_response
 
 config = Config.get_instance()
 
-# 定义HTTP响应头
-HttpResponseHeader = '''HTTP/1.1 200 OK
-Content-Type: text/html
-'''
-
-# 解析请求内容为JSON
-def request_to_json(msg):
+# 解析请求体为JSON
+def request_to_json(body):
     try:
-        dicstrmsg = msg.split("\r\n\r\n")[-1]
-        return json.loads(dicstrmsg)
-    except json.JSONDecodeError as e:
+        return json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
         logger.info(f"Failed to parse JSON from request: {e}")
         return None
 
+COMMAND_PATTERN = re.compile(r'^[!/#](help|reset|character|history|clear|search|model|r18|music_list)\b')
+
+# 按消息类型划分优先级通道
+def classify_priority(rev_json):
+    user_input = rev_json.get('raw_message', '')
+    user_id = rev_json.get('sender', {}).get('user_id')
+    if user_id == config.ADMIN_ID or COMMAND_PATTERN.match(user_input):
+        return LANE_COMMAND
+    if rev_json.get('message_type') == 'private':
+        return LANE_DIRECT
+    if f"[CQ:at,qq={config.SELF_ID}]" in user_input or any(nickname in user_input for nickname in config.NICKNAMES):
+        return LANE_DIRECT
+    return LANE_CHATTER
+
+def context_of(rev_json):
+    if rev_json.get('message_type') == 'private':
+        return ('private', rev_json.get('sender', {}).get('user_id'))
+    return ('group', rev_json.get('group_id'))
+
+# 被队列丢弃的消息不会再有回复，立即结束它的快速回复等待
+def on_message_dropped(rev_json, reason):
+    quick_reply = rev_json.get(QUICK_REPLY_KEY)
+    if quick_reply is not None:
+        quick_reply.cancel()
+    # 关闭程序时丢弃的积压保留在日志里，下次启动重放
+    if journal is not None and reason != DROP_SHUTDOWN:
+        journal.ack(rev_json)
+
+# 会话权重，配置中的键形如 "group:123456"，未配置的会话权重为1
+def weight_of(context):
+    return config.CONTEXT_WEIGHTS.get(f"{context[0]}:{context[1]}", 1)
+
+# 一条消息处理完毕：释放会话的并发名额；acknowledge 为 False 时不在日志中确认，下次启动时重放
+def message_done(rev_json, acknowledge=True):
+    message_queue.task_done(rev_json)
+    if acknowledge and journal is not None:
+        journal.ack(rev_json)
+
 # 用于接收消息的队列
-message_queue = asyncio.Queue(maxsize=config.MESSAGE_QUEUE_SIZE)
-db = MongoDB()
-
-# 捕获并处理优先级命令
-async def handle_priority_command(rev_json):
-    command_pattern = re.compile(r'^[!/#](reset|character|clear)(?:\s+(.+))?')
-    user_input = rev_json.get('raw_message')
-    match = command_pattern.match(user_input)
-    if match:
-        logger.info(f"Detected priority command: {user_input}")
-        queue_with_priority = asyncio.Queue()
-        queue_with_priority.put_nowait(rev_json)  # 将优先级命令放入新队列的最前端
-        while not message_queue.empty():
-            msg = message_queue.get_nowait()
-            queue_with_priority.put_nowait(msg)
-        while not queue_with_priority.empty():
-            msg = queue_with_priority.get_nowait()
-            await message_queue.put(msg)
-        return True
-    return False
+message_queue = PriorityMessageQueue(
+    maxsize=config.MESSAGE_QUEUE_SIZE,
+    lane_of=classify_priority,
+    context_of=context_of,
+    overflow_policy=config.QUEUE_OVERFLOW_POLICY,
+    max_age=config.QUEUE_MAX_AGE,
+    on_drop=on_message_dropped,
+    weight_of=weight_of,
+    max_inflight=config.MAX_INFLIGHT_PER_CONTEXT
+)
+
+# 多进程模式下由工作进程处理消息和写入聊天记录，入口进程只负责接收和排队
+shard_router = None
+journal = None
+if not os.environ.get(WORKER_ENV):
+    if config.WORKER_PROCESSES > 1:
+        shard_router = ShardRouter(config.WORKER_PROCESSES, key_of=context_of, on_done=message_done,
+                                   max_pending=config.WORKER_PROCESSES * config.MAX_ACTIVE_CONTEXTS)
+    # 进入队列的消息先写入磁盘日志，处理完才确认，崩溃或重启后重放未确认的消息
+    if config.JOURNAL_ENABLED:
+        journal = IngressJournal(config.JOURNAL_PATH, fsync_interval=config.JOURNAL_FSYNC_INTERVAL)
 
 async def handle_message(rev_json):
     if 'post_type' not in rev_json:
@@ -53,21 +92,16 @@ async def handle_message(rev_json):
         user_input = rev_json.get('raw_message', '')
         user_id = rev_json.get('sender', {}).get('user_id')
         # username = rev_json.get('sender', {}).get('nickname')
-        group_id = rev_json.get('group_id')
-        context_type = 'private' if rev_json.get('message_type') == 'private' else 'group'
-        context_id = user_id if context_type == 'private' else group_id
 
         if user_input:
-            db.insert_chat_message(user_id, user_input, '', context_type, context_id)
-
-            if await handle_priority_command(rev_json):
-                return
-
             # 要屏蔽的id
             block_id = config.BLOCK_ID
 
             if user_id not in block_id:
+                if journal is not None:
+                    journal.append(rev_json)
                 await message_queue.put(rev_json)
+                return True
     
     elif rev_json['post_type'] == 'meta_event' and rev_json['meta_event_type'] == 'heartbeat':
         # 处理心跳事件
@@ -77,29 +111,82 @@ async def handle_message(rev_json):
         logger.debug(f"Received event: {rev_json['post_type']}")
 
 async def start_http_server():
+    async def respond(quick_reply, enqueued):
+        # 开启快速回复时，在截止时间内等待处理流程给出的第一条文本回复
+        if quick_reply is None:
+            return b''
+        if not enqueued:
+            quick_reply.cancel()
+            return b''
+        reply = await quick_reply.wait(config.HTTP_QUICK_REPLY_TIMEOUT)
+        return quick_reply.response_body(reply) if reply is not None else b''
+
+    async def write_responses(writer, pending):
+        # 管线化请求必须按到达顺序应答
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            response_task, keep_alive = item
+            body = await response_task
+            writer.write(build_response(200, body, keep_alive=keep_alive))
+            await writer.drain()
+
     async def handle_client(reader, writer):
+        # 同一连接上可以连续（或管线化）发送多个请求：按顺序交给 handle_message，
+        # 再按同样的顺序应答，等待快速回复时不会挡住后面的事件
+        pending = asyncio.Queue()
+        writer_task = asyncio.create_task(write_responses(writer, pending))
         try:
-            data = await reader.read(10240)
-            if not data:
-                logger.info("Received empty data.")
-                return  
-
-            request = data.decode('utf-8')
-            rev_json = request_to_json(request)
-            if rev_json is None:
-                logger.info("Failed to parse JSON from request.")
-                return  # 忽略无效请求
-
-            await handle_message(rev_json)
-
-            response = HttpResponseHeader + '\r\n\r\n'
-            writer.write(response.encode('utf-8'))
-            await writer.drain()
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(reader, writer, config.HTTP_MAX_BODY_SIZE),
+                        timeout=config.HTTP_KEEPALIVE_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    break  # 空闲连接超时
+                except HttpError as e:
+                    logger.warning(f"Bad HTTP request: {e.status} {e}")
+                    await pending.put(None)
+                    await asyncio.wait([writer_task])
+                    writer.write(build_response(e.status, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break  # 对端正常关闭连接
+
+                rev_json = request_to_json(request.body) if request.body else None
+                quick_reply = None
+                enqueued = False
+                if isinstance(rev_json, dict):
+                    # 回复由工作进程发出，多进程模式下不使用快速操作
+                    if config.HTTP_QUICK_REPLY and shard_router is None:
+                        quick_reply = create_quick_reply(rev_json)
+                    enqueued = await handle_message(rev_json)
+                else:
+                    logger.info("Failed to parse JSON from request.")
+
+                response_task = asyncio.create_task(respond(quick_reply, enqueued))
+                await pending.put((response_task, request.keep_alive))
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
         finally:
+            if not writer_task.done():
+                await pending.put(None)
+            try:
+                await writer_task
+            except ConnectionError:
+                pass
             writer.close()
-            await writer.wait_closed()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
-    server = await asyncio.start_server(handle_client, '127.0.0.1', port=3001)
+    server = await asyncio.start_server(handle_client, '127.0.0.1', port=3001, limit=64 * 1024)
     logger.info(f'Serving on {server.sockets[0].getsockname()}...')
     async with server:
         await server.serve_forever()
@@ -117,25 +204,29 @@ async def close_connection():
             # 关闭 WebSocket 连接
             await close()
         
-        # 清空消息队列
-        while not message_queue.empty():
-            try:
-                message_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
+        # 清空消息队列，未处理的消息留在日志里
+        message_queue.clear(DROP_SHUTDOWN)
         
         logger.info("连接已关闭")
     except Exception as e:
         logger.error(f"关闭连接时发生错误: {e}")
 
+# 把上次没有处理完的消息放回队列
+async def replay_journal():
+    events = journal.replay(config.JOURNAL_MAX_REPLAY_AGE)
+    if events:
+        logger.info(f"Replaying {len(events)} unacknowledged messages from the journal")
+    for rev_json in events:
+        await message_queue.put(rev_json)
+
 # 异步的消息接收函数
 async def rev_msg():
     try:
         message = await message_queue.get()
-        logger.debug(f"Retrieved message from queue: {message}")
+        logger.debug(f"Retrieved message from queue: {message}, lane depths: {message_queue.lane_depths()}")
         return message
     except Exception as e:
         logger.error(f"Error retrieving message from queue: {e}")
         return None
 
-__all__ = ['message_queue', 'start_http_server', 'start_reverse_ws', 'rev_msg', 'call_api', 'close_connection']
+__all__ = ['message_queue', 'shard_router', 'journal', 'message_done', 'replay_journal', 'start_http_server', 'start_reverse_ws', 'rev_msg', 'call_api', 'close_connection']